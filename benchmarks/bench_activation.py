@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Compares the latency of the activation strategies for environment kernels.
+
+Usage::
+
+    python benchmarks/bench_activation.py --conda ~/miniconda/envs/py39 --virtualenv ~/.virtualenvs/dev
+
+For each environment, the activation is run `--repeat` times with every strategy and the
+median and best wall clock time are printed.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import functools
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from environment_kernels.activate_helper import (ACTIVATION_STRATEGIES,  # noqa: E402
+                                                 source_env_vars_from_command,
+                                                 foreign_shell_data)
+from environment_kernels.envs_conda import (get_static_conda_activation,  # noqa: E402
+                                            _conda_activate_args, _conda_hooks_shell_kwargs)
+from environment_kernels.envs_virtualenv import (get_static_env_vars_for_virtualenv_env,  # noqa: E402
+                                                 _virtualenv_activate_args)
+
+
+def conda_static(env_path):
+    env, hooks = get_static_conda_activation(env_path)
+    if hooks:
+        env = foreign_shell_data(currenv=env, **_conda_hooks_shell_kwargs(hooks))
+    return env
+
+
+def conda_shell(env_path, strategy):
+    return source_env_vars_from_command(_conda_activate_args(env_path), strategy=strategy)
+
+
+def virtualenv_static(env_path):
+    env = get_static_env_vars_for_virtualenv_env(env_path)
+    if env is None:
+        raise RuntimeError("activate script of %s is customized" % env_path)
+    return env
+
+
+def virtualenv_shell(env_path, strategy):
+    return source_env_vars_from_command(_virtualenv_activate_args(env_path), strategy=strategy)
+
+
+STRATEGIES = {
+    "conda": [("static", conda_static)] + [
+        ("shell-" + strategy, functools.partial(conda_shell, strategy=strategy))
+        for strategy in ACTIVATION_STRATEGIES],
+    "virtualenv": [("static", virtualenv_static)] + [
+        ("shell-" + strategy, functools.partial(virtualenv_shell, strategy=strategy))
+        for strategy in ACTIVATION_STRATEGIES],
+}
+
+
+def bench(func, env_path, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(env_path)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), min(timings)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--conda", nargs="*", default=[], help="conda environments")
+    parser.add_argument("--virtualenv", nargs="*", default=[], help="virtualenv environments")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    print("%-40s %-17s %12s %12s" % ("environment", "strategy", "median [ms]", "best [ms]"))
+    for kind in ("conda", "virtualenv"):
+        for env_path in getattr(args, kind):
+            for name, func in STRATEGIES[kind]:
+                try:
+                    median, best = bench(func, env_path, args.repeat)
+                except Exception as e:
+                    print("%-40s %-17s failed: %s" % (env_path[-40:], name, e))
+                    continue
+                print("%-40s %-17s %12.1f %12.1f" % (env_path[-40:], name,
+                                                     median * 1000, best * 1000))
+
+
+if __name__ == "__main__":
+    main()
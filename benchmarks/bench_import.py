@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Measures how long importing environment_kernels takes.
+
+Usage::
+
+    python benchmarks/bench_import.py --repeat 5 --max-ms 300
+
+Imports the package `--repeat` times in a fresh interpreter with ``python -X importtime``
+and prints the median and best cumulative import time of the package and the slowest
+modules it pulls in. Exits with 1 if the median exceeds `--max-ms` or if a module which
+must only be imported on first use (conda, jupyterlab) was imported.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# importing these is slow, they must only be imported when they are needed
+LAZY_MODULES = ['conda', 'jupyterlab']
+
+
+def import_times(module):
+    """Returns {module name: cumulative import time in us} of importing module"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + env.get('PYTHONPATH', '').split(os.pathsep))
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                       env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--module', default='environment_kernels')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10,
+                        help="number of the slowest imported modules to print")
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help="fail if the median import time is higher")
+    args = parser.parse_args()
+
+    runs = [import_times(args.module) for _ in range(args.repeat)]
+    totals = [run[args.module] / 1000.0 for run in runs]
+    print("import %s: median %.1f ms, best %.1f ms" % (args.module, statistics.median(totals),
+                                                       min(totals)))
+    last = runs[-1]
+    for name, us in sorted(last.items(), key=lambda item: -item[1])[1:args.top + 1]:
+        print("  %8.1f ms  %s" % (us / 1000.0, name))
+
+    failed = False
+    for name in LAZY_MODULES:
+        if name in last:
+            print("%s is imported on import of %s" % (name, args.module))
+            failed = True
+    if args.max_ms is not None and statistics.median(totals) > args.max_ms:
+        print("Import takes longer than %.1f ms" % args.max_ms)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
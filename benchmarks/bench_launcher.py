@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Compares the 'server' and 'launcher' activation modes.
+
+Usage::
+
+    python benchmarks/bench_launcher.py --conda ~/miniconda/envs/py39 --virtualenv ~/.virtualenvs/dev
+
+For each environment and mode, prints the median time the notebook server spends before
+it can start the kernel process (activation vs. building the launcher argv), the memory the
+server keeps for it (the activated environment) and the median time until the interpreter
+of the environment runs (in the 'launcher' mode this includes the activation in the
+child process).
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from environment_kernels.envs_common import _find_python_exe  # noqa: E402
+from environment_kernels.envs_conda import _get_env_vars_for_conda_env  # noqa: E402
+from environment_kernels.envs_virtualenv import _get_env_vars_for_virtualenv_env  # noqa: E402
+from environment_kernels.launcher import launcher_argv, _Settings  # noqa: E402
+
+ACTIVATORS = {
+    "conda": _get_env_vars_for_conda_env,
+    "virtualenv": _get_env_vars_for_virtualenv_env,
+}
+
+
+def server_mode(kind, env_path, settings):
+    """Returns (argv, env) the server starts the kernel with"""
+    argv = [_find_python_exe(env_path), "-c", "pass"]
+    env = dict(os.environ)
+    env.update(ACTIVATORS[kind](settings, env_path))
+    return argv, env
+
+
+def launcher_mode(kind, env_path, settings):
+    argv = [_find_python_exe(env_path), "-c", "pass"]
+    return launcher_argv(kind, env_path, argv, timeout=settings.activation_timeout,
+                         static=settings.static_activation), None
+
+
+def measure(mode, kind, env_path, settings, repeat):
+    server, started, memory = [], [], 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        argv, env = mode(kind, env_path, settings)
+        server.append(time.perf_counter() - t0)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        t1 = time.perf_counter()
+        subprocess.check_call(argv, env=env)
+        # without the time spent in tracemalloc
+        started.append(server[-1] + time.perf_counter() - t1)
+    return statistics.median(server), memory, statistics.median(started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--conda", action="append", default=[], help="path of a conda env")
+    parser.add_argument("--virtualenv", action="append", default=[],
+                        help="path of a virtualenv")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--no-static", dest="static", action="store_false")
+    args = parser.parse_args()
+    if not args.conda and not args.virtualenv:
+        parser.error("give at least one env with --conda or --virtualenv")
+
+    logging.basicConfig()
+    settings = _Settings(args.static, 60, logging.getLogger("bench"))
+    print("%-40s %-9s %14s %14s %14s" % ("env", "mode", "server [ms]", "server [KiB]",
+                                         "started [ms]"))
+    for kind in ("conda", "virtualenv"):
+        for env_path in getattr(args, kind):
+            for name, mode in (("server", server_mode), ("launcher", launcher_mode)):
+                server, memory, started = measure(mode, kind, env_path, settings, args.repeat)
+                print("%-40s %-9s %14.1f %14.1f %14.1f" % (env_path, name, server * 1000,
+                                                            memory / 1024.0, started * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Measures finding the environments of python tools (uv, pyenv, poetry, pipenv).
+
+Usage::
+
+    python benchmarks/bench_tool_envs.py --envs 2000
+
+Creates `--envs` fake venvs with ipykernel (an interpreter symlink and a dist-info dir) in
+the uv, pyenv, poetry and pipenv dirs of a temporary home and prints how long finding the
+kernels takes and how many subprocesses were started (there should be none).
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from environment_kernels.envs_tools import (get_uv_env_data, get_pyenv_env_data,  # noqa: E402
+                                            get_poetry_env_data, get_pipenv_env_data)
+
+SUPPLIERS = [("uv", get_uv_env_data), ("pyenv", get_pyenv_env_data),
+             ("poetry", get_poetry_env_data), ("pipenv", get_pipenv_env_data)]
+
+
+def make_venv(env_path, uv=False):
+    bin_dir = os.path.join(env_path, "bin")
+    os.makedirs(bin_dir)
+    os.makedirs(os.path.join(env_path, "lib", "python3.11", "site-packages",
+                             "ipykernel-6.29.0.dist-info"))
+    os.symlink(sys.executable, os.path.join(bin_dir, "python"))
+    open(os.path.join(bin_dir, "ipython"), "w").close()
+    with open(os.path.join(env_path, "pyvenv.cfg"), "w") as f:
+        f.write("home = %s\nversion = 3.11.0\n" % os.path.dirname(sys.executable))
+        if uv:
+            f.write("uv = 0.4.0\n")
+
+
+class _Manager(object):
+    """The settings of the manager which the suppliers use"""
+
+    def __init__(self, root):
+        self.log = logging.getLogger("bench")
+        self.find_virtualenv_envs = False
+        self.use_installed_kernelspecs = True
+        self.find_uv_envs = True
+        self.find_pyenv_envs = self.find_poetry_envs = self.find_pipenv_envs = True
+        self.uv_project_dirs = [os.path.join(root, "uv")]
+        self.pyenv_root = os.path.join(root, "pyenv")
+        self.poetry_env_dirs = [os.path.join(root, "poetry")]
+        self.pipenv_env_dirs = [os.path.join(root, "pipenv")]
+        self.uv_prefix_template = "uv_{}"
+        self.pyenv_prefix_template = "pyenv_{}"
+        self.poetry_prefix_template = "poetry_{}"
+        self.pipenv_prefix_template = "pipenv_{}"
+        self.display_name_template = "Environment ({})"
+        self.dedupe_stats = {}
+        self.probe_timeout = 30
+        self.probe_cache = None
+
+        class _Quarantine(object):
+            def is_quarantined(self, key):
+                return False
+
+            def record_success(self, key):
+                pass
+
+        class _Usage(object):
+            def sort_env_paths(self, candidates, key):
+                return candidates
+
+        self.probe_quarantine = _Quarantine()
+        self.kernel_usage = _Usage()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--envs", type=int, default=1000,
+                        help="number of envs per tool")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    popen_calls = []
+    popen_init = subprocess.Popen.__init__
+
+    def counting_init(self, *a, **kw):
+        popen_calls.append(a[0] if a else kw.get("args"))
+        popen_init(self, *a, **kw)
+
+    try:
+        # the tool envs of `uv tool install` in the real home are not measured
+        os.environ["UV_TOOL_DIR"] = os.path.join(root, "uv-tools")
+        for i in range(args.envs):
+            make_venv(os.path.join(root, "uv", "project%d" % i, ".venv"), uv=True)
+            make_venv(os.path.join(root, "pyenv", "versions", "3.11.0", "envs", "env%d" % i))
+            make_venv(os.path.join(root, "poetry", "project%d-AbCdEf-py3.11" % i))
+            make_venv(os.path.join(root, "pipenv", "project%d-AbCdEf" % i))
+        mgr = _Manager(root)
+        subprocess.Popen.__init__ = counting_init
+        print("%-8s %8s %12s %14s %12s" % ("tool", "kernels", "total [ms]", "per env [us]",
+                                           "subprocesses"))
+        for name, supplier in SUPPLIERS:
+            del popen_calls[:]
+            start = time.perf_counter()
+            kernels = sum(1 for _ in supplier(mgr))
+            duration = time.perf_counter() - start
+            print("%-8s %8d %12.1f %14.1f %12d" % (name, kernels, duration * 1000,
+                                                    duration * 1e6 / max(1, kernels),
+                                                    len(popen_calls)))
+    finally:
+        subprocess.Popen.__init__ = popen_init
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
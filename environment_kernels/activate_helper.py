@@ -8,6 +8,7 @@ Copied from xonsh"""
 # - remove aliases and func handling -> we are only interested on environment variables
 # - remove xonsh special ENV thingy and "detype()"
 # - add source_bash and source_zsh
+# - add activation strategies and profile_shell
 # - Changed the default for "save" in all function definitions/parser to False to get exceptions
 
 # Original license:
@@ -44,49 +45,208 @@ from argparse import ArgumentParser
 import subprocess
 from tempfile import NamedTemporaryFile
 import re
+import time
 from itertools import chain
 
+from .subprocess_helper import TimeoutExpired, check_output, run
+from .tracing import span
 from .utils import FileNotFoundError, ON_WINDOWS
 
 
 ENV_SPLIT_RE = re.compile('^([^=]+)=([^=]*|[^\n]*)$',flags=re.DOTALL|re.MULTILINE)
 
+# How the shell which sources an activate script is started, from the cheapest to the one
+# which sees the most of the user's setup:
+# - hermetic: no rc files and only a minimal environment (see `hermetic_env`)
+# - login: a login shell (reads the profile files)
+# - interactive: an interactive shell (reads .bashrc/.zshrc)
+ACTIVATION_STRATEGIES = ['hermetic', 'login', 'interactive']
+
+_STRATEGY_ARGS = {
+    'bash': {'hermetic': ['--interactive=0', '--login=0', '--extra-args=--norc --noprofile'],
+             'login': ['--interactive=0', '--login=1'],
+             'interactive': ['--interactive=1', '--login=0']},
+    'zsh': {'hermetic': ['--interactive=0', '--login=0', '--extra-args=--no-rcs'],
+            'login': ['--interactive=0', '--login=1'],
+            'interactive': ['--interactive=1', '--login=0']},
+}
+
+# the variables a hermetic shell gets from the environment of the server
+_HERMETIC_ENV_VARS = ['PATH', 'HOME', 'USER', 'LOGNAME', 'SHELL', 'LANG', 'LANGUAGE', 'TERM',
+                      'TMPDIR', 'TZ']
+_HERMETIC_ENV_PREFIXES = ('LC_', 'CONDA_')
+
+
+def hermetic_env(environ=None):
+    """Returns the minimal environment a hermetic activation starts with"""
+    environ = os.environ if environ is None else environ
+    return {key: value for key, value in environ.items()
+            if key in _HERMETIC_ENV_VARS or key.startswith(_HERMETIC_ENV_PREFIXES)}
+
 
-def source_env_vars_from_command(args):
+def _strategy_args(shell, strategy):
+    """Returns (source_foreign args, currenv) to source with that strategy in shell"""
+    if strategy not in ACTIVATION_STRATEGIES:
+        raise ValueError("Unknown activation strategy: %s" % strategy)
+    currenv = hermetic_env() if strategy == 'hermetic' else None
+    return [shell, '--sourcer=source'] + _STRATEGY_ARGS[shell][strategy], currenv
+
+
+def source_env_vars_from_command(args, timeout=None, strategy='interactive'):
     if ON_WINDOWS:
-        return source_cmd(args)
+        return source_cmd(args, timeout=timeout)
     else:
         # bash is probably installed everywhere... if not...
         try:
-            return source_bash(args)
+            return source_bash(args, timeout=timeout, strategy=strategy)
+        except TimeoutExpired:
+            # bash is there but the activation hangs, zsh won't do better
+            raise
         except:
-            return source_zsh(args)
+            return source_zsh(args, timeout=timeout, strategy=strategy)
 
 
-def source_bash(args, stdin=None):
+async def source_env_vars_from_command_async(args, engine, timeout=None, strategy='interactive'):
+    """Like `source_env_vars_from_command`, but runs the shell on the asyncio engine"""
+    if ON_WINDOWS:
+        return await source_foreign_async(_source_cmd_args(args), engine, timeout=timeout)
+    try:
+        shell_args, currenv = _strategy_args('bash', strategy)
+        return await source_foreign_async(shell_args + list(args), engine, timeout=timeout,
+                                          currenv=currenv)
+    except TimeoutExpired:
+        raise
+    except Exception:
+        shell_args, currenv = _strategy_args('zsh', strategy)
+        return await source_foreign_async(shell_args + list(args), engine, timeout=timeout,
+                                          currenv=currenv)
+
+
+def source_bash(args, stdin=None, timeout=None, strategy='interactive'):
     """Simply bash-specific wrapper around source-foreign
 
     Returns a dict to be used as a new environment"""
-    args = list(args)
-    new_args = ['bash', '--sourcer=source']
+    new_args, currenv = _strategy_args('bash', strategy)
     new_args.extend(args)
-    return source_foreign(new_args, stdin=stdin)
+    return source_foreign(new_args, stdin=stdin, timeout=timeout, currenv=currenv)
 
-def source_zsh(args, stdin=None):
+def source_zsh(args, stdin=None, timeout=None, strategy='interactive'):
     """Simply zsh-specific wrapper around source-foreign
 
     Returns a dict to be used as a new environment"""
-    args = list(args)
-    new_args = ['zsh', '--sourcer=source']
+    new_args, currenv = _strategy_args('zsh', strategy)
     new_args.extend(args)
-    return source_foreign(new_args, stdin=stdin)
+    return source_foreign(new_args, stdin=stdin, timeout=timeout, currenv=currenv)
+
+
+# the startup files bash reads for a strategy (the system bashrc is a Debian extension)
+_STARTUP_FILES = {
+    'hermetic': [],
+    'login': ['/etc/profile', ['~/.bash_profile', '~/.bash_login', '~/.profile']],
+    'interactive': ['/etc/bash.bashrc', '~/.bashrc'],
+}
+
+# xtrace prefix: marker, timestamp, source file and line of each traced command
+_PROFILE_PS4 = "$'+\\x1eEK\\t${EPOCHREALTIME}\\t${BASH_SOURCE}\\t${LINENO}\\t'"
+_PROFILE_LINE_RE = re.compile('^\\++\x1eEK\t([0-9.,]+)\t([^\t]*)\t([0-9]*)\t(.*)$')
+
+
+def _startup_commands(strategy):
+    """Returns the commands which source the startup files of bash for that strategy"""
+    commands = []
+    for files in _STARTUP_FILES[strategy]:
+        # a login shell reads only the first existing of its personal profiles
+        files = [f.replace('~/', '"$HOME"/', 1) for f in
+                 (files if isinstance(files, list) else [files])]
+        commands.append('if ' + '; elif '.join('[ -r %s ]; then . %s' % (f, f) for f in files)
+                        + '; fi')
+    return commands
+
 
+def profile_shell(prevcmd, strategy='interactive', currenv=None, timeout=None):
+    """Runs prevcmd in bash with timestamped xtrace and returns where the time went.
 
-def source_cmd(args, stdin=None):
+    The startup files of the strategy are sourced explicitly (and so traced), bash itself
+    is started without them. Returns a dict with the wall clock `total`, the `startup` of
+    bash until the first traced command, the time spent in each file (`scripts`: file,
+    time and number of commands, slowest first; commands outside of files are listed as
+    '(command)') and the ten slowest single `commands`. Needs bash 5 (EPOCHREALTIME).
+
+    Raises `subprocess.TimeoutExpired` if the shell does not finish within timeout seconds.
+    """
+    if ON_WINDOWS:
+        raise RuntimeError("Profiling an activation needs bash.")
+    if strategy is not None and strategy not in ACTIVATION_STRATEGIES:
+        raise ValueError("Unknown activation strategy: %s" % strategy)
+    if strategy == 'hermetic' and currenv is None:
+        currenv = hermetic_env()
+    args = ['bash', '--norc', '--noprofile']
+    if strategy == 'interactive':
+        args.append('-i')
+    elif strategy == 'login':
+        args.append('-l')
+
+    tracefile = NamedTemporaryFile(suffix='.trace', delete=False)
+    tracefile.close()
+    script = '\n'.join(['exec 9>%s' % argvquote(tracefile.name, force=True),
+                        'BASH_XTRACEFD=9',
+                        'PS4=' + _PROFILE_PS4,
+                        'set -x'] +
+                       _startup_commands(strategy or 'hermetic') +
+                       [prevcmd, 'set +x'])
+    try:
+        start = time.time()
+        p = run(args + ['-c', script], timeout=timeout, env=currenv,
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        total = time.time() - start
+        with open(tracefile.name, encoding='utf-8', errors='replace') as f:
+            trace = f.read()
+    finally:
+        os.remove(tracefile.name)
+
+    entries = []
+    for line in trace.split('\n'):
+        m = _PROFILE_LINE_RE.match(line)
+        if m is not None:
+            timestamp, source, lineno, command = m.groups()
+            entries.append((float(timestamp.replace(',', '.')), source or '(command)',
+                            int(lineno or 0), command))
+    if not entries:
+        raise RuntimeError("Profiling an activation needs bash 5: %s"
+                           % p.stderr.decode(errors='replace').strip())
+
+    scripts, commands = {}, []
+    for (timestamp, source, lineno, command), following in zip(entries, entries[1:]):
+        duration = following[0] - timestamp
+        stats = scripts.setdefault(source, {'file': source, 'time': 0.0, 'commands': 0})
+        stats['time'] += duration
+        stats['commands'] += 1
+        commands.append({'file': source, 'line': lineno, 'time': duration, 'command': command})
+    commands.sort(key=lambda c: -c['time'])
+    return {'strategy': strategy,
+            'total': total,
+            'startup': max(0.0, entries[0][0] - start),
+            'returncode': p.returncode,
+            'scripts': sorted(scripts.values(), key=lambda stats: -stats['time']),
+            'commands': commands[:10]}
+
+
+def profile_source(args, strategy='interactive', currenv=None, timeout=None):
+    """Like `profile_shell`, but takes the args of `source_bash`"""
+    ns = _parse_source_foreign_args(['bash', '--sourcer=source'] + list(args))
+    return profile_shell(ns.prevcmd, strategy=strategy, currenv=currenv, timeout=timeout)
+
+
+def source_cmd(args, stdin=None, timeout=None):
     """Simple cmd.exe-specific wrapper around source-foreign.
 
     returns a dict to be used as a new environment
     """
+    return source_foreign(_source_cmd_args(args), stdin=stdin, timeout=timeout)
+
+
+def _source_cmd_args(args):
+    """Returns the source_foreign arguments to source args in cmd.exe"""
     args = list(args)
     fpath = locate_binary(args[0])
     args[0] = fpath if fpath else args[0]
@@ -102,7 +262,7 @@ def source_cmd(args, stdin=None):
     args.append('--envcmd=set')
     args.append('--seterrpostcmd=if errorlevel 1 exit 1')
     args.append('--use-tmpfile=1')
-    return source_foreign(args, stdin=stdin)
+    return args
 
 
 def locate_binary(name):
@@ -166,17 +326,14 @@ def escape_windows_cmd_string(s):
     return s
 
 
-def source_foreign(args, stdin=None):
-    """Sources a file written in a foreign shell language."""
-    parser = _ensure_source_foreign_parser()
-    ns = parser.parse_args(args)
-    if ns.prevcmd is not None:
-        pass  # don't change prevcmd if given explicitly
-    elif os.path.isfile(ns.files_or_code[0]):
-        # we have filename to source
-        ns.prevcmd = '{} "{}"'.format(ns.sourcer, '" "'.join(ns.files_or_code))
-    elif ns.prevcmd is None:
-        ns.prevcmd = ' '.join(ns.files_or_code)  # code to run, no files
+def source_foreign(args, stdin=None, timeout=None, currenv=None):
+    """Sources a file written in a foreign shell language.
+
+    If currenv is given, the shell is started with that environment and only the changes
+    to it are applied to the current environment.
+
+    Raises `subprocess.TimeoutExpired` if the shell does not finish within timeout seconds."""
+    ns = _parse_source_foreign_args(args)
     fsenv = foreign_shell_data(shell=ns.shell, login=ns.login,
                                           interactive=ns.interactive,
                                           envcmd=ns.envcmd,
@@ -188,17 +345,58 @@ def source_foreign(args, stdin=None):
                                           sourcer=ns.sourcer,
                                           use_tmpfile=ns.use_tmpfile,
                                           seterrprevcmd=ns.seterrprevcmd,
-                                          seterrpostcmd=ns.seterrpostcmd)
+                                          seterrpostcmd=ns.seterrpostcmd,
+                                          currenv=currenv,
+                                          timeout=timeout)
+    return _apply_foreign_env(fsenv, ns, currenv)
+
+
+async def source_foreign_async(args, engine, timeout=None, currenv=None):
+    """Like `source_foreign`, but runs the shell on the asyncio engine."""
+    ns = _parse_source_foreign_args(args)
+    fsenv = await foreign_shell_data_async(engine, shell=ns.shell, login=ns.login,
+                                           interactive=ns.interactive,
+                                           envcmd=ns.envcmd,
+                                           extra_args=ns.extra_args,
+                                           safe=ns.safe, prevcmd=ns.prevcmd,
+                                           postcmd=ns.postcmd,
+                                           use_tmpfile=ns.use_tmpfile,
+                                           seterrprevcmd=ns.seterrprevcmd,
+                                           seterrpostcmd=ns.seterrpostcmd,
+                                           currenv=currenv,
+                                           timeout=timeout)
+    return _apply_foreign_env(fsenv, ns, currenv)
+
+
+def _parse_source_foreign_args(args):
+    parser = _ensure_source_foreign_parser()
+    ns = parser.parse_args(args)
+    if ns.prevcmd is not None:
+        pass  # don't change prevcmd if given explicitly
+    elif os.path.isfile(ns.files_or_code[0]):
+        # we have filename to source
+        ns.prevcmd = '{} "{}"'.format(ns.sourcer, '" "'.join(ns.files_or_code))
+    elif ns.prevcmd is None:
+        ns.prevcmd = ' '.join(ns.files_or_code)  # code to run, no files
+    return ns
+
+
+def _apply_foreign_env(fsenv, ns, baseenv=None):
+    """Returns the new environment from the environment printed by the foreign shell.
+
+    baseenv is the environment the shell was started with (default: the current one).
+    """
     if fsenv is None:
         raise RuntimeError("Source failed: {}\n".format(ns.prevcmd), 1)
+    baseenv = os.environ if baseenv is None else baseenv
     # apply results
     env = os.environ.copy()
     for k, v in fsenv.items():
-        if k in env and v == env[k]:
+        if k in baseenv and v == baseenv[k]:
             continue  # no change from original
         env[k] = v
     # Remove any env-vars that were unset by the script.
-    for k in os.environ: # use os.environ again to prevent errors about changed size
+    for k in baseenv:
         if k not in fsenv:
             env.pop(k, None)
     return env
@@ -329,7 +527,8 @@ def foreign_shell_data(shell, interactive=True, login=False, envcmd=None,
                        aliascmd=None, extra_args=(), currenv=None,
                        safe=False, prevcmd='', postcmd='', funcscmd=None,
                        sourcer=None, use_tmpfile=False, tmpfile_ext=None,
-                       runcmd=None, seterrprevcmd=None, seterrpostcmd=None):
+                       runcmd=None, seterrprevcmd=None, seterrpostcmd=None,
+                       timeout=None):
     """Extracts data from a foreign (non-xonsh) shells. Currently this gets
     the environment, aliases, and functions but may be extended in the future.
 
@@ -386,6 +585,9 @@ def foreign_shell_data(shell, interactive=True, login=False, envcmd=None,
         of the script. For example, this is "if errorlevel 1 exit 1" in
         cmd.exe. To disable exit-on-error behavior, simply pass in an
         empty string.
+    timeout : float or None, optional
+        Seconds after which the shell (and everything it started) is killed and
+        `subprocess.TimeoutExpired` is raised. None waits forever.
 
     Returns
     -------
@@ -395,6 +597,80 @@ def foreign_shell_data(shell, interactive=True, login=False, envcmd=None,
         Dictionary of shell's alaiases, this includes foreign function
         wrappers.
     """
+    cmd, tmpfile = foreign_shell_command(shell, interactive=interactive, login=login,
+                                         envcmd=envcmd, extra_args=extra_args,
+                                         prevcmd=prevcmd, postcmd=postcmd,
+                                         use_tmpfile=use_tmpfile, tmpfile_ext=tmpfile_ext,
+                                         runcmd=runcmd, seterrprevcmd=seterrprevcmd,
+                                         seterrpostcmd=seterrpostcmd)
+
+    if currenv is not None:
+        currenv = dict(currenv)
+    with span("shell", "activation", shell=shell, prevcmd=prevcmd) as info:
+        try:
+            s = check_output(cmd, stderr=subprocess.PIPE, env=currenv,
+                             # start new session to avoid hangs
+                             start_new_session=True,
+                             universal_newlines=True,
+                             timeout=timeout)
+        except (subprocess.CalledProcessError, FileNotFoundError):
+            if not safe:
+                raise
+            return None, None
+        finally:
+            if tmpfile is not None:
+                os.remove(tmpfile)
+        env = parse_env(s)
+        info["variables"] = len(env)
+    return env
+
+
+async def foreign_shell_data_async(engine, shell, interactive=True, login=False, envcmd=None,
+                                   extra_args=(), currenv=None, safe=False, prevcmd='',
+                                   postcmd='', use_tmpfile=False, tmpfile_ext=None, runcmd=None,
+                                   seterrprevcmd=None, seterrpostcmd=None, timeout=None):
+    """Like `foreign_shell_data`, but runs the shell on the asyncio engine.
+
+    Returns the environment of the shell or None, if it failed and safe is True.
+    """
+    cmd, tmpfile = foreign_shell_command(shell, interactive=interactive, login=login,
+                                         envcmd=envcmd, extra_args=extra_args,
+                                         prevcmd=prevcmd, postcmd=postcmd,
+                                         use_tmpfile=use_tmpfile, tmpfile_ext=tmpfile_ext,
+                                         runcmd=runcmd, seterrprevcmd=seterrprevcmd,
+                                         seterrpostcmd=seterrpostcmd)
+    if currenv is not None:
+        currenv = dict(currenv)
+    with span("shell", "activation", shell=shell, prevcmd=prevcmd) as info:
+        try:
+            s = await engine.check_output(cmd, env=currenv, timeout=timeout)
+        except (subprocess.CalledProcessError, FileNotFoundError):
+            if not safe:
+                raise
+            return None
+        finally:
+            if tmpfile is not None:
+                os.remove(tmpfile)
+        env = parse_env(s.decode(errors='replace').replace('\r\n', '\n'))
+        info["variables"] = len(env)
+    return env
+
+
+def foreign_shell_command(shell, interactive=True, login=False, envcmd=None,
+                          extra_args=(), prevcmd='', postcmd='', use_tmpfile=False,
+                          tmpfile_ext=None, runcmd=None, seterrprevcmd=None,
+                          seterrpostcmd=None):
+    """Returns the command line to run the foreign shell and print its environment.
+
+    See `foreign_shell_data` for the parameters.
+
+    Returns
+    -------
+    cmd : list of str
+        The command line.
+    tmpfile : str or None
+        The temporary file with the commands, which has to be removed after running cmd.
+    """
     cmd = [shell]
     cmd.extend(extra_args)  # needs to come here for GNU long options
     if interactive:
@@ -418,29 +694,12 @@ def foreign_shell_data(shell, interactive=True, login=False, envcmd=None,
 
     if not use_tmpfile:
         cmd.append(command)
-    else:
-        tmpfile = NamedTemporaryFile(suffix=tmpfile_ext, delete=False)
-        tmpfile.write(command.encode('utf8'))
-        tmpfile.close()
-        cmd.append(tmpfile.name)
-
-    if currenv is not None:
-        currenv = os.environ
-    try:
-        s = subprocess.check_output(cmd, stderr=subprocess.PIPE, env=currenv,
-                                    # start new session to avoid hangs
-                                    start_new_session=True,
-                                    universal_newlines=True)
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        if not safe:
-            raise
-        return None, None
-    finally:
-        if use_tmpfile:
-            pass
-            os.remove(tmpfile.name)
-    env = parse_env(s)
-    return env
+        return cmd, None
+    tmpfile = NamedTemporaryFile(suffix=tmpfile_ext, delete=False)
+    tmpfile.write(command.encode('utf8'))
+    tmpfile.close()
+    cmd.append(tmpfile.name)
+    return cmd, tmpfile.name
 
 def to_bool(x):
     """"Converts to a boolean in a semantically meaningful way."""
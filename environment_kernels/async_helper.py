@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""asyncio engine to run the probe and activation subprocesses without a thread per process"""
+from __future__ import absolute_import
+
+import asyncio
+import collections
+import os
+import subprocess
+import time
+
+from .subprocess_helper import (MEMORY_CHECK_INTERVAL, MemoryLimitExceeded, RusagePopen,
+                                TimeoutExpired, background_work, count_cpu, governor,
+                                kill_process_group, output_size)
+from .tracing import span
+from .utils import ON_WINDOWS
+
+# With pidfds, the engine waits for (and reaps) its processes itself, which keeps their
+# resource usage. Elsewhere, asyncio reaps them and their CPU time is not known.
+_REAP_WITH_PIDFD = hasattr(os, "pidfd_open") and hasattr(os, "wait4")
+
+
+class _PrioritySemaphore(object):
+    """An asyncio semaphore which hands a released slot to interactive waiters first"""
+
+    def __init__(self, value):
+        self._value = value
+        # interactive -> waiting futures
+        self._waiters = {True: collections.deque(), False: collections.deque()}
+
+    async def acquire(self, interactive):
+        if self._value > 0 and not self._waiters[True] and \
+                (interactive or not self._waiters[False]):
+            self._value -= 1
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters[interactive].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # got the slot, but nobody uses it
+                self.release()
+            elif waiter in self._waiters[interactive]:
+                self._waiters[interactive].remove(waiter)
+            raise
+
+    def release(self):
+        for interactive in (True, False):
+            waiters = self._waiters[interactive]
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self._value += 1
+
+
+class AsyncSubprocessEngine(object):
+    """Runs subprocesses on the asyncio event loop.
+
+    At most `max_concurrency` subprocesses run at the same time, all others wait on a
+    semaphore shared by all callers of this engine; the subprocesses of interactive work get
+    a free slot before those of background work (see `subprocess_helper.background_work`).
+    The subprocesses are deprioritized and their memory is limited by the `governor`.
+    """
+
+    def __init__(self, max_concurrency=32, parent=None):
+        self.max_concurrency = max_concurrency
+        self.parent = parent
+        self._semaphore = None
+        self._loop = None
+
+    def limited(self, max_concurrency):
+        """Returns an engine which runs at most max_concurrency of the subprocesses of this engine"""
+        return AsyncSubprocessEngine(max_concurrency, parent=self)
+
+    @property
+    def semaphore(self):
+        # the semaphore has to be created in (and is bound to) the running loop
+        loop = asyncio.get_event_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore = _PrioritySemaphore(self.max_concurrency)
+            self._loop = loop
+        return self._semaphore
+
+    async def run(self, args, timeout=None, check=False, input=None,
+                  stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs):
+        """Like `subprocess_helper.run`, but as a coroutine.
+
+        Kills the whole process group and raises `subprocess.TimeoutExpired` if the
+        process did not finish within timeout seconds and `MemoryLimitExceeded` if it used
+        more memory than the `governor` allows.
+        """
+        interactive = not background_work.get()
+        if self.parent is not None:
+            semaphore = self.semaphore
+            await semaphore.acquire(interactive)
+            try:
+                return await self.parent.run(args, timeout=timeout, check=check, input=input,
+                                             stdout=stdout, stderr=stderr, **kwargs)
+            finally:
+                semaphore.release()
+        if not ON_WINDOWS:
+            kwargs.setdefault('start_new_session', True)
+        stdin = subprocess.PIPE if input is not None else kwargs.pop('stdin', None)
+        with span("subprocess", "subprocess", argv=args, background=not interactive) as info:
+            semaphore = self.semaphore
+            queued = time.time()
+            await semaphore.acquire(interactive)
+            try:
+                info["queued"] = time.time() - queued
+                if _REAP_WITH_PIDFD:
+                    p = RusagePopen(args, stdin=stdin, stdout=stdout, stderr=stderr, **kwargs)
+                else:
+                    p = await asyncio.create_subprocess_exec(*args, stdin=stdin, stdout=stdout,
+                                                             stderr=stderr, **kwargs)
+                governor.started(p.pid, interactive)
+                try:
+                    out, err = await self._communicate(p, args, input, timeout)
+                except asyncio.TimeoutError:
+                    kill_process_group(p)
+                    await _wait(p)
+                    raise TimeoutExpired(args, timeout)
+                except BaseException:
+                    # e.g. cancelled or too much memory
+                    kill_process_group(p)
+                    if isinstance(p, subprocess.Popen):
+                        # nobody else reaps it
+                        asyncio.ensure_future(_wait(p))
+                    raise
+                finally:
+                    count_cpu(p)
+            finally:
+                semaphore.release()
+            info["returncode"] = p.returncode
+            info["output_bytes"] = output_size(out, err)
+        if check and p.returncode:
+            raise subprocess.CalledProcessError(p.returncode, args, output=out, stderr=err)
+        return subprocess.CompletedProcess(args, p.returncode, out, err)
+
+    @staticmethod
+    async def _communicate(p, args, input, timeout):
+        """`p.communicate` with a timeout, checking the memory of the process in between"""
+        if governor.max_memory <= 0:
+            return await asyncio.wait_for(_communicate(p, input), timeout or None)
+        deadline = time.time() + timeout if timeout else None
+        communicate = asyncio.ensure_future(_communicate(p, input))
+        try:
+            while True:
+                wait = MEMORY_CHECK_INTERVAL
+                if deadline is not None:
+                    wait = max(0, min(wait, deadline - time.time()))
+                done, _ = await asyncio.wait([communicate], timeout=wait)
+                if done:
+                    return communicate.result()
+                if deadline is not None and time.time() >= deadline:
+                    raise asyncio.TimeoutError()
+                rss = governor.memory_exceeded(p.pid)
+                if rss:
+                    raise MemoryLimitExceeded(args, governor.max_memory, rss)
+        finally:
+            communicate.cancel()
+
+    async def check_call(self, args, timeout=None, **kwargs):
+        """Like `subprocess.check_call`, but as a coroutine"""
+        kwargs.setdefault('stdout', subprocess.DEVNULL)
+        kwargs.setdefault('stderr', subprocess.DEVNULL)
+        await self.run(args, timeout=timeout, check=True, **kwargs)
+        return 0
+
+    async def check_output(self, args, timeout=None, **kwargs):
+        """Like `subprocess.check_output`, but as a coroutine (always returns bytes)"""
+        kwargs['stdout'] = subprocess.PIPE
+        return (await self.run(args, timeout=timeout, check=True, **kwargs)).stdout
+
+
+async def _communicate(p, input):
+    """`communicate` of an asyncio process or of a `RusagePopen` reaped via its pidfd"""
+    if not isinstance(p, subprocess.Popen):
+        return await p.communicate(input)
+    loop = asyncio.get_event_loop()
+
+    async def read(pipe):
+        if pipe is None:
+            return None
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        try:
+            return await reader.read()
+        finally:
+            transport.close()
+
+    async def write(pipe):
+        if pipe is None:
+            return
+        transport, _ = await loop.connect_write_pipe(asyncio.Protocol, pipe)
+        if input:
+            transport.write(input)
+        # flushes the input first
+        transport.close()
+
+    _, out, err = await asyncio.gather(write(p.stdin), read(p.stdout), read(p.stderr))
+    await _wait(p)
+    return out, err
+
+
+async def _wait(p):
+    """Waits until the process exited and returns its returncode"""
+    if not isinstance(p, subprocess.Popen):
+        return await p.wait()
+    if p.returncode is not None:
+        return p.returncode
+    loop = asyncio.get_event_loop()
+    try:
+        pidfd = os.pidfd_open(p.pid)
+    except OSError:
+        # e.g. a kernel without pidfds
+        return await loop.run_in_executor(None, p.wait)
+    try:
+        exited = loop.create_future()
+        loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+    finally:
+        os.close(pidfd)
+    # reaps it without blocking
+    return p.wait()
+
+
+async def merge_async_iterators(*iterators):
+    """Yields the items of all async iterators in the order in which they become available"""
+    queue = asyncio.Queue()
+    done = object()
+
+    async def drain(iterator):
+        try:
+            async for item in iterator:
+                await queue.put(item)
+        finally:
+            await queue.put(done)
+
+    tasks = [asyncio.ensure_future(drain(iterator)) for iterator in iterators]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            item = await queue.get()
+            if item is done:
+                remaining -= 1
+            else:
+                yield item
+        # re-raise errors of the iterators
+        for task in tasks:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -1,21 +1,198 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
+import asyncio
+import contextvars
+import copy
+import hashlib
+import inspect
+import json
 import os
 import os.path
+import threading
+import time
 
 from jupyter_client.kernelspec import (KernelSpecManager, NoSuchKernel)
-from traitlets import List, Unicode, Bool, Int
+from traitlets import List, Unicode, Bool, Int, Float, Dict, Enum, default
 
+from .activate_helper import ACTIVATION_STRATEGIES
+from .async_helper import AsyncSubprocessEngine
+from .env_kernelspec import EnvironmentKernelRecord, EnvironmentLoadingKernelSpec
+from .envs_common import set_probe_concurrency
 from .envs_conda import get_conda_env_data
 from .envs_virtualenv import get_virtualenv_env_data
-from .utils import FileNotFoundError, HAVE_CONDA
+from .envs_tools import (get_uv_env_data, get_pyenv_env_data, get_poetry_env_data,
+                         get_pipenv_env_data, default_pyenv_root, default_poetry_env_dirs,
+                         default_pipenv_env_dirs)
+from .probe_cache import ProbeCache
+from .registry import KernelRegistry
+from .scheduler import AdaptiveScheduler, ScanCPU, measure_thread_cpu, scan_cpu
+from .subprocess_helper import Quarantine, background_work, governor
+from .tracing import TRACE_FORMATS, Trace, current_trace, span, traced_span, write_trace
+from .usage import UsageStore, launch_recording
+from .utils import FileNotFoundError, have_conda
 
-ENV_SUPPLYER = [get_conda_env_data, get_virtualenv_env_data]
+ENV_SUPPLYER = [get_conda_env_data, get_virtualenv_env_data, get_uv_env_data, get_pyenv_env_data,
+                get_poetry_env_data, get_pipenv_env_data]
+
+# Additional suppliers can be registered by other packages under this entry point group.
+# The entry point must be a callable taking the manager and returning env_data or yielding
+# (name, (resource_dir, kernel spec or EnvironmentKernelRecord)) as soon as an environment is validated. It can also be a
+# coroutine function or async generator function taking the manager and an
+# `AsyncSubprocessEngine` or have such a function as `async_supplier` attribute, which is then
+# used by the asyncio engine.
+ENV_SUPPLYER_ENTRY_POINT = 'environment_kernels.suppliers'
 
 __all__ = ['EnvironmentKernelSpecManager']
 
 
+def _kernel_spec(value):
+    """Returns the kernel spec of a (resource_dir, kernel record or kernel spec) entry"""
+    kspec = value[1]
+    if isinstance(kspec, EnvironmentKernelRecord):
+        return kspec.kernel_spec()
+    return kspec
+
+
+def _supplyer_name(supplyer):
+    """Returns the name of a builtin supplier: `get_conda_env_data` -> `conda`"""
+    name = getattr(supplyer, '__name__', repr(supplyer))
+    if name.startswith('get_') and name.endswith('_env_data'):
+        name = name[len('get_'):-len('_env_data')]
+    return name
+
+
+def _kernel_dirs_state(kernel_dirs):
+    """Returns the mtimes of the kernel dirs and of the kernel.json files in them.
+
+    Installing, removing or editing a kernelspec changes it.
+    """
+    state = []
+    for kernel_dir in kernel_dirs:
+        try:
+            entries = list(os.scandir(kernel_dir))
+            state.append((kernel_dir, os.stat(kernel_dir).st_mtime_ns))
+        except OSError:
+            continue
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            try:
+                state.append((entry.name,
+                              os.stat(os.path.join(entry.path, 'kernel.json')).st_mtime_ns))
+            except OSError:
+                pass
+    return tuple(state)
+
+
+def _kernel_dirs_mtimes(kernel_dirs):
+    """Returns the mtimes of the kernel dirs.
+
+    Installing or removing a kernelspec changes it (editing one does not).
+    """
+    state = []
+    for kernel_dir in kernel_dirs:
+        try:
+            state.append(os.stat(kernel_dir).st_mtime_ns)
+        except OSError:
+            state.append(None)
+    return tuple(state)
+
+
+def _iter_env_data(result):
+    """Iterates over the (name, value) items of the env_data returned or yielded by a supplier"""
+    return iter(result.items()) if isinstance(result, dict) else iter(result)
+
+
+def _on_event_loop():
+    """True if called from the thread of a running asyncio loop (e.g. the server's)"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def get_env_supplyers(log=None):
+    """Returns a list of (name, supplier) of the builtin and all registered suppliers"""
+    supplyers = [(_supplyer_name(supplyer), supplyer) for supplyer in ENV_SUPPLYER]
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return supplyers
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        eps = eps.select(group=ENV_SUPPLYER_ENTRY_POINT)
+    else:
+        eps = eps.get(ENV_SUPPLYER_ENTRY_POINT, [])
+    known = set(name for name, _ in supplyers)
+    for ep in eps:
+        if ep.name in known:
+            continue
+        try:
+            supplyers.append((ep.name, ep.load()))
+            known.add(ep.name)
+        except Exception:
+            if log is not None:
+                log.exception("Couldn't load environment supplier '%s'.", ep.name)
+    return supplyers
+
+
+class _SupplyerRun(threading.Thread):
+    """Runs a single supplier in the background and keeps its result"""
+
+    def __init__(self, name, supplyer, mgr, concurrency):
+        super(_SupplyerRun, self).__init__(name="env-supplier-%s" % name)
+        # a hanging supplier must not keep the server from exiting
+        self.daemon = True
+        self.supplyer_name = name
+        self.supplyer = supplyer
+        self.mgr = mgr
+        self.concurrency = concurrency
+        # a supplier started by a background scan stays in the background (and in its trace)
+        self.context = contextvars.copy_context()
+        # the kernels validated so far
+        self.partial = {}
+        self.result = None
+        self.error = None
+        self.started = None
+        self.duration = None
+        # set when the supplier is done, also if it runs in an executor instead of as thread
+        self.finished = threading.Event()
+
+    def running(self):
+        """True from the start of the supplier until it is done"""
+        return self.started is not None and not self.finished.is_set()
+
+    def wait(self, timeout=None):
+        """Waits (up to timeout seconds) until the supplier is done"""
+        return self.finished.wait(timeout)
+
+    def start(self):
+        self.started = time.time()
+        super(_SupplyerRun, self).start()
+
+    def run(self):
+        # this might run in a thread of an executor, don't leave the context there
+        self.context.run(self._run)
+
+    def _run(self):
+        set_probe_concurrency(self.concurrency)
+        try:
+            with measure_thread_cpu(), \
+                    span("supplier", "supplier", supplier=self.supplyer_name) as info:
+                for name, value in _iter_env_data(self.supplyer(self.mgr)):
+                    self.partial[name] = value
+                    self.mgr._publish_env_kernel(name, value)
+                self.result = dict(self.partial)
+                info["kernels"] = len(self.result)
+        except Exception as e:
+            self.error = e
+            self.mgr.log.exception("Error while running the environment supplier '%s'.",
+                                   self.supplyer_name)
+        finally:
+            self.duration = time.time() - self.started
+            self.finished.set()
+
+
 class EnvironmentKernelSpecManager(KernelSpecManager):
     """
     A Jupyter Kernel manager which dyamically checks for Environments
@@ -31,24 +208,27 @@ class EnvironmentKernelSpecManager(KernelSpecManager):
     _default_conda_dirs = ['~/.conda/envs/']
     _default_virtualenv_dirs = ['~/.virtualenvs']
 
-    # Check for the CONDA_ENV_PATH variable and add it to the list if set.
-    if os.environ.get('CONDA_ENV_PATH', False):
-        _default_conda_dirs.append(os.environ['CONDA_ENV_PATH'].split('envs')[0])
-
-    # If we are running inside the root conda env can get all the env dirs:
-    if HAVE_CONDA:
-        import conda
-        _default_conda_dirs += conda.config.envs_dirs
-
-    # Remove any duplicates
-    _default_conda_dirs = list(set(map(os.path.expanduser,
-                                       _default_conda_dirs)))
-
     conda_env_dirs = List(
-        _default_conda_dirs,
         config=True,
         help="List of directories in which are conda environments.")
 
+    @default('conda_env_dirs')
+    def _conda_env_dirs_default(self):
+        # computed on first use: importing conda takes a while
+        conda_dirs = list(self._default_conda_dirs)
+
+        # Check for the CONDA_ENV_PATH variable and add it to the list if set.
+        if os.environ.get('CONDA_ENV_PATH', False):
+            conda_dirs.append(os.environ['CONDA_ENV_PATH'].split('envs')[0])
+
+        # If we are running inside the root conda env can get all the env dirs:
+        if have_conda():
+            import conda.config
+            conda_dirs += conda.config.envs_dirs
+
+        # Remove any duplicates
+        return list(set(map(os.path.expanduser, conda_dirs)))
+
     virtualenv_env_dirs = List(
         _default_virtualenv_dirs,
         config=True,
@@ -79,11 +259,38 @@ class EnvironmentKernelSpecManager(KernelSpecManager):
         config=True,
         help="Template for the virtualenv environment kernel name prefix in the UI. Needs to include {} for the name.")
 
+    uv_prefix_template = Unicode(
+        u"uv_{}",
+        config=True,
+        help="Template for the uv environment kernel name prefix in the UI. Needs to include {} for the name.")
+
+    pyenv_prefix_template = Unicode(
+        u"pyenv_{}",
+        config=True,
+        help="Template for the pyenv environment kernel name prefix in the UI. Needs to include {} for the name.")
+
+    poetry_prefix_template = Unicode(
+        u"poetry_{}",
+        config=True,
+        help="Template for the poetry environment kernel name prefix in the UI. Needs to include {} for the name.")
+
+    pipenv_prefix_template = Unicode(
+        u"pipenv_{}",
+        config=True,
+        help="Template for the pipenv environment kernel name prefix in the UI. Needs to include {} for the name.")
+
     find_conda_envs = Bool(
         True,
         config=True,
         help="Probe for conda environments, including calling conda itself.")
 
+    use_installed_kernelspecs = Bool(
+        True,
+        config=True,
+        help="Use the kernelspecs installed in the environments (share/jupyter/kernels): "
+             "envs with a python or R kernelspec are not probed and kernels for other "
+             "languages (Julia, xeus, ...) are added as well.")
+
     find_r_envs = Bool(
         True,
         config=True,
@@ -99,21 +306,322 @@ class EnvironmentKernelSpecManager(KernelSpecManager):
         config=True,
         help="Interval (in minutes) to refresh the list of environment kernels. Setting it to '0' disables the refresh.")
 
+    adaptive_refresh = Bool(
+        False,
+        config=True,
+        help="Adapt the interval between the periodic scans: back off (up to "
+             "'refresh_max_interval') while scans find no changes and go back to "
+             "'refresh_interval' when they do.")
+
+    refresh_max_interval = Int(
+        60,
+        config=True,
+        help="Maximum interval (in minutes) between scans with 'adaptive_refresh'.")
+
+    refresh_backoff = Float(
+        2.0,
+        config=True,
+        help="Factor by which the interval grows after a scan without changes with 'adaptive_refresh'.")
+
+    refresh_max_cpu_fraction = Float(
+        0.05,
+        config=True,
+        help="Maximum fraction of the CPU time the periodic scans may use with 'adaptive_refresh'. "
+             "Setting it to '0' disables the limit.")
+
     find_virtualenv_envs = Bool(True,
                                 config=True,
                                 help="Probe for virtualenv environments.")
 
+    find_uv_envs = Bool(
+        True,
+        config=True,
+        help="Look for the venvs created by uv (in 'uv_project_dirs' and the uv tool dir).")
+
+    uv_project_dirs = List(
+        [],
+        config=True,
+        help="Project directories (or directories containing projects) whose '.venv' is "
+             "used if it was created by uv.")
+
+    find_pyenv_envs = Bool(
+        True,
+        config=True,
+        help="Look for the python versions and virtualenvs managed by pyenv.")
+
+    pyenv_root = Unicode(
+        config=True,
+        help="Root directory of pyenv. Defaults to $PYENV_ROOT or '~/.pyenv'.")
+
+    @default('pyenv_root')
+    def _pyenv_root_default(self):
+        return default_pyenv_root()
+
+    find_poetry_envs = Bool(
+        True,
+        config=True,
+        help="Look for the environments poetry created for projects.")
+
+    poetry_env_dirs = List(
+        config=True,
+        help="List of directories in which are poetry environments. Defaults to "
+             "'virtualenvs.path' of the poetry config.")
+
+    @default('poetry_env_dirs')
+    def _poetry_env_dirs_default(self):
+        return default_poetry_env_dirs()
+
+    find_pipenv_envs = Bool(
+        True,
+        config=True,
+        help="Look for the environments pipenv created for projects.")
+
+    pipenv_env_dirs = List(
+        config=True,
+        help="List of directories in which are pipenv environments. Defaults to "
+             "$WORKON_HOME or '~/.local/share/virtualenvs'.")
+
+    @default('pipenv_env_dirs')
+    def _pipenv_env_dirs_default(self):
+        return default_pipenv_env_dirs()
+
+    supplier_timeout = Float(
+        120,
+        config=True,
+        help="Time (in seconds) after which a scan stops waiting for an environment supplier "
+             "and uses its last known results instead.")
+
+    supplier_concurrency = Int(
+        4,
+        config=True,
+        help="Number of environments a single supplier may probe in parallel.")
+
+    supplier_budgets = Dict(
+        {},
+        config=True,
+        help="Per-supplier overrides of 'timeout' and 'concurrency', e.g. "
+             "{'conda': {'timeout': 300, 'concurrency': 2}}.")
+
+    probe_timeout = Float(
+        30,
+        config=True,
+        help="Time (in seconds) after which a subprocess probing an environment (or calling "
+             "conda) is killed. Setting it to '0' disables the timeout.")
+
+    activation_timeout = Float(
+        60,
+        config=True,
+        help="Time (in seconds) after which activating an environment is aborted and the "
+             "kernel is started without activation. Setting it to '0' disables the timeout.")
+
+    probe_cache_size = Int(
+        10000,
+        config=True,
+        help="Number of probe results which are kept. An env is only probed again if its "
+             "interpreter or site-packages changed. Setting it to '0' disables the cache.")
+
+    quarantine_threshold = Int(
+        2,
+        config=True,
+        help="Number of consecutive probe timeouts after which an environment is skipped "
+             "during scans.")
+
+    quarantine_backoff = Float(
+        300,
+        config=True,
+        help="Time (in seconds) a quarantined environment is skipped. Doubles with every "
+             "further timeout.")
+
+    quarantine_max_backoff = Float(
+        6 * 3600,
+        config=True,
+        help="Maximum time (in seconds) a quarantined environment is skipped.")
+
+    static_activation = Bool(
+        True,
+        config=True,
+        help="Activate virtualenv environments without starting a shell, if their activate "
+             "script is the unchanged stock one, and conda environments without calling conda, "
+             "sourcing only their activate.d scripts (if any) in a minimal shell.")
+
+    activation_strategy = Enum(
+        ACTIVATION_STRATEGIES,
+        'hermetic',
+        config=True,
+        help="How the shell which sources an activate script is started: 'hermetic' skips "
+             "the rc files and passes only a minimal environment, 'login' starts a login "
+             "shell, 'interactive' an interactive one (reads .bashrc/.zshrc). If the "
+             "activation fails, the next (more expensive) strategy is tried.")
+
+    activation_strategies = Dict(
+        {},
+        config=True,
+        help="Activation strategies for single kernels or environments: a dict with kernel "
+             "names or env paths as keys and strategies as values, e.g. "
+             "{'conda_legacy': 'interactive'}.")
+
+    activation_profile_threshold = Float(
+        0,
+        config=True,
+        help="Time (in seconds) above which an activation is profiled (once per environment) "
+             "and the time spent in the startup files, activate scripts and hooks is logged. "
+             "Setting it to '0' disables the profiling.")
+
+    activation_mode = Enum(
+        ['server', 'launcher'],
+        'server',
+        config=True,
+        help="Where environments are activated: 'server' activates them in the notebook server "
+             "and starts the kernel with the resulting environment, 'launcher' starts the "
+             "kernel via 'python -m environment_kernels.launcher', which activates the "
+             "environment in the kernel process.")
+
+    scan_deadline = Float(
+        0,
+        config=True,
+        help="Time (in seconds) after which a scan returns the kernels found so far, while the "
+             "remaining environments are probed in the background. Setting it to '0' waits for "
+             "the complete scan.")
+
+    usage_file = Unicode(
+        None,
+        allow_none=True,
+        config=True,
+        help="File in which the launch counts of the environment kernels are kept. Defaults to "
+             "'environment_kernels_usage.json' in the Jupyter data dir, an empty string keeps "
+             "them only in memory.")
+
+    prewarm_kernels = Int(
+        3,
+        config=True,
+        help="Number of the most launched environment kernels which are activated in the "
+             "background after each scan, so that starting them does not wait for the "
+             "activation. Setting it to '0' disables the prewarming.")
+
+    use_async_engine = Bool(
+        False,
+        config=True,
+        help="Run the periodic scans on the asyncio event loop instead of in threads. All probes "
+             "and activations then run as asyncio subprocesses.")
+
+    async_max_subprocesses = Int(
+        32,
+        config=True,
+        help="Maximum number of subprocesses the asyncio engine runs at the same time.")
+
+    max_subprocesses = Int(
+        0,
+        config=True,
+        help="Maximum number of probe and activation subprocesses which run at the same time "
+             "(the asyncio engine is limited by 'async_max_subprocesses'). Subprocesses for a "
+             "kernel which is being started are started before those of background scans. "
+             "Setting it to '0' disables the limit.")
+
+    background_nice = Int(
+        10,
+        config=True,
+        help="Niceness added to the probe and activation subprocesses of background work "
+             "(periodic scans, prewarming, kernel pools). Setting it to '0' runs them with "
+             "the priority of the server.")
+
+    background_ionice = Enum(
+        ['idle', 'best-effort', 'none'],
+        'best-effort',
+        config=True,
+        help="I/O scheduling class of the subprocesses of background work: 'idle' only gets "
+             "disk time when nobody else needs it, 'best-effort' the lowest priority of the "
+             "normal class. Needs psutil and Linux.")
+
+    subprocess_max_memory = Int(
+        0,
+        config=True,
+        help="Maximum memory (in MB) a probe or activation subprocess (with its children) may "
+             "use before it is killed. Setting it to '0' disables the limit.")
+
+    missing_kernel_ttl = Float(
+        10,
+        config=True,
+        help="Time (in seconds) for which an unknown kernel name is remembered, so that "
+             "repeated lookups of it (e.g. from notebooks with a removed kernel) don't search "
+             "the kernel dirs again. Setting it to '0' disables it.")
+
+    scan_trace_file = Unicode(
+        None,
+        allow_none=True,
+        config=True,
+        help="File to which a trace of every scan and activation is appended, with a span per "
+             "supplier, probe, subprocess and activation step. Disabled if not set.")
+
+    scan_trace_format = Enum(
+        TRACE_FORMATS,
+        'jsonl',
+        config=True,
+        help="Format of the 'scan_trace_file': 'jsonl' writes a JSON object per span and line, "
+             "'chrome' the Chrome trace-event format, which chrome://tracing, Perfetto and "
+             "speedscope load.")
+
     def __init__(self, *args, **kwargs):
         super(EnvironmentKernelSpecManager, self).__init__(*args, **kwargs)
         self.log.info("Using EnvironmentKernelSpecManager...")
-        self._env_data_cache = {}
-        if self.refresh_interval > 0:
+        self.env_registry = KernelRegistry(log=self.log)
+        # (name, supplier), resolved from the entry points on the first scan
+        self._env_supplyers = None
+        self._supplyer_runs = {}
+        self._supplyer_results = {}
+        self.supplier_stats = {}
+        self.dedupe_stats = {}
+        self.probe_cache = ProbeCache(max_entries=self.probe_cache_size)
+        self.probe_quarantine = Quarantine(threshold=self.quarantine_threshold,
+                                           backoff=self.quarantine_backoff,
+                                           max_backoff=self.quarantine_max_backoff,
+                                           log=self.log)
+        self.async_engine = AsyncSubprocessEngine(self.async_max_subprocesses)
+        governor.max_subprocesses = self.max_subprocesses
+        governor.background_nice = self.background_nice
+        governor.background_ionice = None if self.background_ionice == 'none' else \
+            self.background_ionice
+        governor.max_memory = self.subprocess_max_memory * 2 ** 20
+        usage_file = self.usage_file
+        if usage_file is None:
+            from jupyter_core.paths import jupyter_data_dir
+            usage_file = os.path.join(jupyter_data_dir(), 'environment_kernels_usage.json')
+        self.kernel_usage = UsageStore(usage_file, log=self.log)
+        self._prewarmed = []
+        self.activation_profiles = {}
+        self._profiles_lock = threading.Lock()
+        # (state key, find_kernel_specs() result, get_all_specs() result, etag)
+        self._specs_cache = None
+        self.specs_cache_hits = 0
+        self.specs_cache_misses = 0
+        # (state key, lower case kernel name -> 'native' or 'env')
+        self._kernel_sources_cache = None
+        # lower case kernel name -> time until which it is known to be missing
+        self._missing_kernels = {}
+        self.kernel_lookups = {"env": 0, "native": 0, "missing": 0}
+        self._refresh_scheduler = None
+        if self.refresh_interval > 0 and self.adaptive_refresh:
+            try:
+                from tornado.ioloop import IOLoop
+                self._refresh_scheduler = AdaptiveScheduler(
+                    interval=60 * self.refresh_interval,
+                    max_interval=60 * self.refresh_max_interval,
+                    backoff=self.refresh_backoff,
+                    max_cpu_fraction=self.refresh_max_cpu_fraction)
+                # Initial loading NOW, later updates are scheduled after each scan
+                IOLoop.current().call_later(0, callback=self._scheduled_update, initial=True)
+                self.log.info("Started adaptive periodic updates of the kernel list "
+                              "(every %s to %s minutes).", self.refresh_interval,
+                              max(self.refresh_interval, self.refresh_max_interval))
+            except:
+                self.log.exception("Error while trying to enable periodic updates of the kernel list.")
+        elif self.refresh_interval > 0:
             try:
                 from tornado.ioloop import PeriodicCallback, IOLoop
                 # Initial loading NOW
-                IOLoop.current().call_later(0, callback=self._update_env_data, initial=True)
+                update = self._async_update_env_data if self.use_async_engine else self._update_env_data
+                IOLoop.current().call_later(0, callback=update, initial=True)
                 # Later updates
-                updater = PeriodicCallback(callback=self._update_env_data,
+                updater = PeriodicCallback(callback=update,
                                            callback_time=1000 * 60 * self.refresh_interval)
                 updater.start()
                 if not updater.is_running():
@@ -148,31 +656,502 @@ class EnvironmentKernelSpecManager(KernelSpecManager):
             self.log.info("Starting initial scan of virtual environments...")
         else:
             self.log.debug("Starting periodic scan of virtual environments...")
-        self._get_env_data(reload=True)
+        token = background_work.set(True)
+        try:
+            self._get_env_data(reload=True)
+        finally:
+            background_work.reset(token)
         self.log.debug("done.")
 
+    def _measured_update_env_data(self, initial=False):
+        # the scan blocks this thread, so its CPU time is all the scan's
+        with measure_thread_cpu():
+            self._update_env_data(initial=initial)
+
+    async def _scheduled_update(self, initial=False):
+        """Scans for environments and schedules the next scan with the adaptive scheduler"""
+        from tornado.ioloop import IOLoop
+        generation = self.env_registry.generation
+        started = time.time()
+        # only the threads and subprocesses of the scan count, not the rest of the server
+        scan = ScanCPU()
+        token = scan_cpu.set(scan)
+        try:
+            if self.use_async_engine:
+                await self._async_update_env_data(initial=initial)
+            else:
+                # in a thread: the scan waits for its suppliers, which must not block the loop
+                await asyncio.get_event_loop().run_in_executor(
+                    None, contextvars.copy_context().run, self._measured_update_env_data,
+                    initial)
+        except Exception:
+            self.log.exception("Error while scanning for environment kernels.")
+        finally:
+            scan_cpu.reset(token)
+            scheduler = self._refresh_scheduler
+            interval = scheduler.record_scan(duration=time.time() - started,
+                                             cpu=scan.seconds,
+                                             changed=generation != self.env_registry.generation)
+            self.log.debug("Next scan for environment kernels in %d seconds: %s.",
+                           interval, scheduler.reason)
+            IOLoop.current().call_later(interval, callback=self._scheduled_update)
+
+    def get_refresh_schedule(self):
+        """Returns a dict describing when the next periodic scan runs and why.
+
+        The dict contains the current 'interval' (in seconds) and the 'reason' for it. Returns
+        None if the adaptive scheduling is not enabled.
+        """
+        if self._refresh_scheduler is None:
+            return None
+        return self._refresh_scheduler.get_state()
+
+    async def _async_update_env_data(self, initial=False):
+        if initial:
+            self.log.info("Starting initial scan of virtual environments...")
+        else:
+            self.log.debug("Starting periodic scan of virtual environments...")
+        # the tasks of the scan inherit this
+        token = background_work.set(True)
+        try:
+            await self.async_refresh()
+        finally:
+            background_work.reset(token)
+        self.log.debug("done.")
+
+    async def async_refresh(self):
+        """Scans for environments on the asyncio engine and returns the new env_data.
+
+        Can be awaited from the event loop of the server without blocking it.
+        """
+        return await self._scan_async()
+
+    async def async_activate(self, kernel_name):
+        """Activates the environment of the kernel on the asyncio engine.
+
+        After this, starting the kernel does not block on the activation anymore.
+        """
+        kspec = self.get_kernel_spec(kernel_name)
+        if hasattr(kspec, "load_env_async"):
+            return await kspec.load_env_async(self.async_engine)
+        return kspec.env
+
     def _get_env_data(self, reload=False):
         """Get the data about the available environments.
 
-        env_data is a structure {name -> (resourcedir, kernel spec)}
+        env_data is a structure {name -> (resourcedir, kernel record or kernel spec)}
         """
 
         # This is called much too often and finding-process is really expensive :-(
-        if not reload and getattr(self, "_env_data_cache", {}):
-            return getattr(self, "_env_data_cache")
+        if not reload and self.env_registry.populated:
+            return self.env_registry.get_env_data()
 
-        env_data = {}
-        for supplyer in ENV_SUPPLYER:
-            env_data.update(supplyer(self))
+        return self._scan()
 
+    def _publish_env_kernel(self, name, value):
+        """Makes a kernel available as soon as a supplier validated it"""
+        if not self.validate_env(name):
+            return
+        change = self.env_registry.add(name, value)
+        if change is not None and change.added:
+            self.log.info("Found new kernel in environments: %s", name)
+
+    def _set_env_data(self, env_data):
+        """Filters the env_data found by the suppliers and makes it the current one"""
         env_data = {name: env_data[name] for name in env_data if self.validate_env(name)}
-        new_kernels = [env for env in list(env_data.keys()) if env not in list(self._env_data_cache.keys())]
-        if new_kernels:
-            self.log.info("Found new kernels in environments: %s", ", ".join(new_kernels))
+        change = self.env_registry.update(env_data)
+        if change.added:
+            self.log.info("Found new kernels in environments: %s", ", ".join(change.added))
+        if change.removed:
+            self.log.info("Environment kernels are gone: %s", ", ".join(change.removed))
+        self._prewarm()
+        return self.env_registry.get_env_data()
+
+    def _prewarm(self):
+        """Activates the most launched kernels in the background"""
+        if self.prewarm_kernels <= 0 or self.activation_mode == 'launcher':
+            return
+        names = self.kernel_usage.hottest(self.env_registry.get_env_data(), self.prewarm_kernels)
+        kspecs = []
+        for name in names:
+            kspec = _kernel_spec(self.env_registry.get(name))
+            if isinstance(kspec, EnvironmentLoadingKernelSpec) and not kspec.env_loaded:
+                kspecs.append(kspec)
+        self._prewarmed = names
+        if not kspecs:
+            return
+        self.log.debug("Prewarming the environments of %s", ", ".join(names))
+        if self.use_async_engine:
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                pass
+            else:
+                async def prewarm_async():
+                    background_work.set(True)
+                    await asyncio.gather(*[kspec.load_env_async(self.async_engine)
+                                           for kspec in kspecs])
+
+                # keep a reference, so that the task is not garbage collected
+                self._prewarm_task = asyncio.ensure_future(prewarm_async())
+                return
+
+        def prewarm():
+            background_work.set(True)
+            for kspec in kspecs:
+                kspec.load_env()
+
+        thread = threading.Thread(target=prewarm, name="env-prewarm")
+        thread.daemon = True
+        thread.start()
+
+    def profile_activation(self, kernel_name):
+        """Activates the environment of the kernel with profiling and returns the breakdown.
+
+        See `activate_helper.profile_shell`. Returns None if the environment is activated
+        without a shell. Raises `NoSuchKernel` if it is not an environment kernel.
+        """
+        self._get_env_data()
+        entry = self.env_registry.get(kernel_name)
+        if entry is None or not isinstance(entry[1], EnvironmentKernelRecord):
+            raise NoSuchKernel(kernel_name)
+        profile = entry[1].profile_activation()
+        if profile is not None:
+            self.activation_profiles[entry[1].env_path] = profile
+        return profile
+
+    def get_activation_profiles(self):
+        """Returns a dict env path -> profile of the profiled activations"""
+        return dict(self.activation_profiles)
+
+    def activation_finished(self, record, duration):
+        """Called after the environment of a record was activated in the server"""
+        if self.activation_profile_threshold <= 0 or duration < self.activation_profile_threshold:
+            return
+        with self._profiles_lock:
+            if record.env_path in self.activation_profiles:
+                return
+            # profiled only once
+            self.activation_profiles[record.env_path] = None
+
+        def profile():
+            background_work.set(True)
+            try:
+                result = record.profile_activation()
+            except Exception:
+                self.log.warning("Couldn't profile the activation of %s.", record.env_path,
+                                 exc_info=True)
+                return
+            self.activation_profiles[record.env_path] = result
+            if result is None:
+                return
+            breakdown = ", ".join("%s %.2fs" % (stats["file"], stats["time"])
+                                  for stats in result["scripts"][:5])
+            self.log.warning("Activating %s took %.1f seconds (profiled: shell startup %.2fs, "
+                             "%s).", record.env_path, duration, result["startup"], breakdown)
+
+        thread = threading.Thread(target=profile, name="activation-profile")
+        thread.daemon = True
+        thread.start()
+
+    def get_activation_strategy(self, env_path):
+        """Returns the activation strategy of the environment (see `activation_strategies`)"""
+        strategy = None
+        if self.activation_strategies:
+            for name in self.env_registry.find_by_env(env_path):
+                if name in self.activation_strategies:
+                    strategy = self.activation_strategies[name]
+                    break
+            else:
+                real_path = os.path.realpath(os.path.expanduser(env_path))
+                for key, value in self.activation_strategies.items():
+                    if os.path.realpath(os.path.expanduser(key)) == real_path:
+                        strategy = value
+                        break
+        if strategy is None:
+            return self.activation_strategy
+        if strategy not in ACTIVATION_STRATEGIES:
+            self.log.warning("Unknown activation strategy '%s' for %s, using '%s'.",
+                             strategy, env_path, self.activation_strategy)
+            return self.activation_strategy
+        return strategy
+
+    def record_launch(self, kernel_name):
+        """Records that the environment kernel was launched"""
+        if not launch_recording.get():
+            return
+        entry = self.env_registry.get(kernel_name)
+        env_path = getattr(entry[1], 'env_path', None) if entry is not None else None
+        self.kernel_usage.record_launch(kernel_name, env_path=env_path)
+
+    def subscribe(self, callback):
+        """Calls callback(change) whenever a scan added, removed or changed environment kernels.
+
+        change is a `KernelRegistryChange` with the new registry generation and the lists of
+        added, removed and changed kernel names. Returns a function to unsubscribe.
+        """
+        return self.env_registry.subscribe(callback)
+
+    def trace_span(self, name, category, **args):
+        """Returns a context manager recording the block as span of the current trace or, if
+        there is none, as a new trace written to `scan_trace_file`"""
+        return traced_span(name, category, self.scan_trace_file, self.scan_trace_format,
+                           self.log, **args)
 
-        self._env_data_cache = env_data
+    def _start_scan_trace(self):
+        """Returns a new Trace for a scan or None, if no trace is written"""
+        if not self.scan_trace_file or current_trace.get() is not None:
+            return None
+        return Trace("scan", "scan", background=background_work.get())
+
+    def _finish_scan_trace(self, trace, env_data):
+        if trace is None:
+            return
+        trace.finish(kernels=len(env_data))
+        try:
+            write_trace(trace, self.scan_trace_file, self.scan_trace_format)
+        except OSError:
+            self.log.warning("Couldn't write the scan trace to %s.", self.scan_trace_file,
+                             exc_info=True)
+
+    def get_env_supplyers(self):
+        """Returns the list of (name, supplier), which is resolved only once"""
+        supplyers = self._env_supplyers
+        if supplyers is None:
+            supplyers = self._env_supplyers = get_env_supplyers(self.log)
+        return supplyers
+
+    def refresh_supplyers(self):
+        """Resolves the registered suppliers again, e.g. after installing a package with a
+        supplier. They are used from the next scan on."""
+        self._env_supplyers = get_env_supplyers(self.log)
+        return self._env_supplyers
+
+    def _get_supplyer_budget(self, name):
+        """Returns (timeout, concurrency) for the supplier with that name"""
+        budget = self.supplier_budgets.get(name, {})
+        return (float(budget.get('timeout', self.supplier_timeout)),
+                int(budget.get('concurrency', self.supplier_concurrency)))
+
+    def _scan(self):
+        """Runs all suppliers concurrently and returns the merged env_data.
+
+        A supplier which fails or does not finish within its timeout does not hold back
+        the others: the last known results of that supplier are used instead. If the scan
+        takes longer than `scan_deadline`, the kernels found so far are returned and the
+        scan is finished in the background.
+        """
+        runs = []
+        trace = self._start_scan_trace()
+        # the suppliers record their spans in the trace
+        token = current_trace.set(trace) if trace is not None else None
+        try:
+            for name, supplyer in self.get_env_supplyers():
+                timeout, concurrency = self._get_supplyer_budget(name)
+                run = self._supplyer_runs.get(name)
+                if run is not None and run.running():
+                    self.log.warning("Environment supplier '%s' is still running from a "
+                                     "previous scan, not starting it again.", name)
+                else:
+                    run = _SupplyerRun(name, supplyer, self, concurrency)
+                    run.start()
+                    self._supplyer_runs[name] = run
+                runs.append((run, timeout))
+        finally:
+            if token is not None:
+                current_trace.reset(token)
+
+        if _on_event_loop():
+            # waiting would block the server: the kernels found so far are returned and the
+            # scan is finished in the background
+            deadline = time.time()
+        elif self.scan_deadline > 0:
+            deadline = time.time() + self.scan_deadline
+        else:
+            deadline = None
+        for run, timeout in runs:
+            end = run.started + timeout
+            if deadline is not None:
+                end = min(end, deadline)
+            run.wait(max(0, end - time.time()))
+
+        pending = [run for run, timeout in runs
+                   if run.running() and run.started + timeout > time.time()]
+        if pending:
+            for run in pending:
+                self.supplier_stats[run.supplyer_name] = {
+                    "status": "running",
+                    "duration": time.time() - run.started,
+                    "kernels": len(run.partial),
+                }
+            self.log.info("Scan deadline reached, continuing to scan %s in the background.",
+                          ", ".join(run.supplyer_name for run in pending))
+            finisher = threading.Thread(target=self._finish_scan, args=(runs, trace),
+                                        name="env-scan-finisher")
+            finisher.daemon = True
+            finisher.start()
+            # the partial results count as a scan, don't start another one on the next request
+            self.env_registry.populated = True
+            return self.env_registry.get_env_data()
+        env_data = self._set_env_data(self._collect_supplyer_runs(runs))
+        self._finish_scan_trace(trace, env_data)
         return env_data
 
+    def _finish_scan(self, runs, trace=None):
+        """Waits for the suppliers still running after the deadline and completes the scan"""
+        for run, timeout in runs:
+            run.wait(max(0, run.started + timeout - time.time()))
+        env_data = self._set_env_data(self._collect_supplyer_runs(runs))
+        self._finish_scan_trace(trace, env_data)
+        self.log.debug("Background scan of virtual environments done.")
+
+    def _collect_supplyer_runs(self, runs):
+        env_data = {}
+        for run, timeout in runs:
+            if run.running():
+                status = "timeout"
+            elif run.error is not None:
+                status = "error"
+            else:
+                status = "ok"
+            duration = run.duration if run.duration is not None else time.time() - run.started
+            env_data.update(self._collect_supplyer_result(run.supplyer_name, status, duration,
+                                                          timeout, run.result, run.partial))
+        return env_data
+
+    async def _scan_async(self):
+        """Like `_scan`, but on the asyncio engine.
+
+        Suppliers without an asyncio variant run in a thread.
+        """
+        loop = asyncio.get_event_loop()
+
+        async def consume(supplyer_name, async_supplyer, engine, partial):
+            with span("supplier", "supplier", supplier=supplyer_name) as info:
+                if inspect.isasyncgenfunction(async_supplyer):
+                    async for name, value in async_supplyer(self, engine):
+                        partial[name] = value
+                        self._publish_env_kernel(name, value)
+                else:
+                    for name, value in _iter_env_data(await async_supplyer(self, engine)):
+                        partial[name] = value
+                        self._publish_env_kernel(name, value)
+                info["kernels"] = len(partial)
+            return partial
+
+        async def run_supplyer(name, supplyer, timeout, concurrency):
+            if asyncio.iscoroutinefunction(supplyer) or inspect.isasyncgenfunction(supplyer):
+                async_supplyer = supplyer
+            else:
+                async_supplyer = getattr(supplyer, "async_supplier", None)
+            started = time.time()
+            partial = {}
+            run = None
+            if async_supplyer is not None:
+                work = consume(name, async_supplyer, self.async_engine.limited(concurrency),
+                               partial)
+            else:
+                run = self._supplyer_runs.get(name)
+                if run is not None and run.running():
+                    self.log.warning("Environment supplier '%s' is still running from a "
+                                     "previous scan, not starting it again.", name)
+
+                    def run_in_thread(run=run):
+                        # its timeout counts from its start
+                        run.wait(max(0, run.started + timeout - time.time()))
+                        return run.result
+                else:
+                    run = _SupplyerRun(name, supplyer, self, concurrency)
+                    run.started = started
+                    self._supplyer_runs[name] = run
+
+                    def run_in_thread(run=run):
+                        # errors are logged by the run itself
+                        run.run()
+                        return run.result
+
+                partial = run.partial
+                work = loop.run_in_executor(None, run_in_thread)
+            result = None
+            try:
+                result = await asyncio.wait_for(work, timeout)
+                if result is not None:
+                    status = "ok"
+                else:
+                    status = "timeout" if run is not None and run.running() else "error"
+            except asyncio.TimeoutError:
+                status = "timeout"
+            except Exception:
+                self.log.exception("Error while running the environment supplier '%s'.", name)
+                status = "error"
+            return self._collect_supplyer_result(name, status, time.time() - started, timeout,
+                                                 dict(result) if status == "ok" else None,
+                                                 partial)
+
+        runs = []
+        trace = self._start_scan_trace()
+        # the tasks of the suppliers record their spans in the trace
+        token = current_trace.set(trace) if trace is not None else None
+        try:
+            for name, supplyer in self.get_env_supplyers():
+                timeout, concurrency = self._get_supplyer_budget(name)
+                runs.append(asyncio.ensure_future(run_supplyer(name, supplyer, timeout,
+                                                               concurrency)))
+        finally:
+            if token is not None:
+                current_trace.reset(token)
+
+        async def finish():
+            env_data = {}
+            for result in await asyncio.gather(*runs):
+                env_data.update(result)
+            env_data = self._set_env_data(env_data)
+            self._finish_scan_trace(trace, env_data)
+            return env_data
+
+        if self.scan_deadline > 0:
+            _, pending = await asyncio.wait(runs, timeout=self.scan_deadline)
+            if pending:
+                self.log.info("Scan deadline reached, continuing to scan in the background.")
+                # keep a reference, so that the task is not garbage collected
+                self._background_scan = asyncio.ensure_future(finish())
+                self.env_registry.populated = True
+                return self.env_registry.get_env_data()
+        return await finish()
+
+    def _collect_supplyer_result(self, name, status, duration, timeout, result, partial=None):
+        """Records the outcome of a supplier run and returns the env_data to use for it"""
+        if status == "ok":
+            self._supplyer_results[name] = result
+        elif status == "timeout":
+            self.log.warning("Environment supplier '%s' did not finish within %s seconds, "
+                             "using its last known results.", name, timeout)
+        result = dict(self._supplyer_results.get(name, {}))
+        if status != "ok" and partial:
+            # the kernels validated before the timeout/error are still good
+            result.update(partial)
+        self.supplier_stats[name] = {
+            "status": status,
+            "duration": duration,
+            "kernels": len(result),
+        }
+        self.log.debug("Environment supplier '%s': %s after %.2f seconds, %s kernels.",
+                       name, status, duration, len(result))
+        return result
+
+    def get_scan_metrics(self):
+        """Returns a dict with statistics about the last scan for environment kernels"""
+        return {"suppliers": {name: dict(stats) for name, stats in self.supplier_stats.items()},
+                "quarantine": self.probe_quarantine.get_state(),
+                "schedule": self.get_refresh_schedule(),
+                "prewarmed": list(self._prewarmed),
+                "dedupe": {source: dict(stats) for source, stats in self.dedupe_stats.items()},
+                "probe_cache": self.probe_cache.get_state(),
+                "subprocesses": governor.get_state(),
+                "specs_cache": {"hits": self.specs_cache_hits,
+                                "misses": self.specs_cache_misses},
+                "kernel_lookups": dict(self.kernel_lookups)}
+
     def find_kernel_specs_for_envs(self):
         """Returns a dict mapping kernel names to resource directories."""
         data = self._get_env_data()
@@ -182,38 +1161,136 @@ class EnvironmentKernelSpecManager(KernelSpecManager):
         """Returns the dict of name -> kernel_spec for all environments"""
 
         data = self._get_env_data()
-        return {name: data[name][1] for name in data}
+        return {name: _kernel_spec(data[name]) for name in data}
+
+    def _merged_specs(self):
+        """Returns the cached (find_kernel_specs, get_all_specs, etag) of the env kernels
+        merged with the installed kernels.
+
+        The cache is invalidated by a new registry generation and by changes in the
+        Jupyter kernel dirs, so that polling the kernelspecs does not rescan the kernel
+        dirs every time.
+        """
+        # scans if no kernels were found yet
+        self._get_env_data()
+        # a kernel published between reading the kernels and their generation would else
+        # be missing under the new generation
+        generation, data = self.env_registry.snapshot()
+        key = (generation, _kernel_dirs_state(self.kernel_dirs))
+        cached = self._specs_cache
+        if cached is not None and cached[0] == key:
+            self.specs_cache_hits += 1
+            return cached[1:]
+        self.specs_cache_misses += 1
 
-    def find_kernel_specs(self):
-        """Returns a dict mapping kernel names to resource directories."""
         # let real installed kernels overwrite envs with the same name:
         # this is the same order as the get_kernel_spec way, which also prefers
         # kernels from the jupyter dir over env kernels.
-        specs = self.find_kernel_specs_for_envs()
-        specs.update(super(EnvironmentKernelSpecManager,
-                           self).find_kernel_specs())
-        return specs
+        dirs = {name: data[name][0] for name in data}
+        # The env kernels are serialized from their records, listing them must not create
+        # (or activate) a kernel spec for each of them.
+        specs = {name: {"resource_dir": resource_dir, "spec": kspec.to_dict()}
+                 for name, (resource_dir, kspec) in data.items()}
+        native = super(EnvironmentKernelSpecManager, self).find_kernel_specs()
+        dirs.update(native)
+        for name, resource_dir in native.items():
+            try:
+                kspec = super(EnvironmentKernelSpecManager, self).get_kernel_spec(name)
+            except (NoSuchKernel, FileNotFoundError):
+                continue
+            except Exception:
+                self.log.warning("Error loading kernelspec %r", name, exc_info=True)
+                continue
+            specs[name] = {"resource_dir": resource_dir, "spec": kspec.to_dict()}
+        etag = hashlib.sha1(json.dumps(specs, sort_keys=True, default=str).encode("utf-8"))
+        self._specs_cache = (key, dirs, specs, '"%s"' % etag.hexdigest())
+        return self._specs_cache[1:]
+
+    def find_kernel_specs(self):
+        """Returns a dict mapping kernel names to resource directories."""
+        return dict(self._merged_specs()[0])
 
     def get_all_specs(self):
-        """Returns a dict mapping kernel names and resource directories.
+        """Returns a dict mapping kernel names to {'resource_dir': ..., 'spec': {...}}.
         """
         # This is new in 4.1 -> https://github.com/jupyter/jupyter_client/pull/93
-        specs = self.get_all_kernel_specs_for_envs()
-        specs.update(super(EnvironmentKernelSpecManager, self).get_all_specs())
-        return specs
+        return copy.deepcopy(self._merged_specs()[1])
 
-    def get_kernel_spec(self, kernel_name):
-        """Returns a :class:`KernelSpec` instance for the given kernel_name.
+    def get_specs_etag(self):
+        """Returns a hash of the content of `get_all_specs()`, for use as an HTTP ETag.
 
-        Raises :exc:`NoSuchKernel` if the given kernel name is not found.
+        It only changes if a kernel is added, removed or changed.
         """
+        return self._merged_specs()[2]
+
+    def _kernel_sources(self):
+        """Returns a dict lower case kernel name -> 'native' (installed in a Jupyter kernel
+        dir) or 'env' (environment kernel).
+
+        It is rebuilt when the registry or the list of installed kernels changes, which also
+        forgets the missing kernels.
+        """
+        generation, data = self.env_registry.snapshot()
+        key = (generation, _kernel_dirs_mtimes(self.kernel_dirs))
+        cached = self._kernel_sources_cache
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        sources = {name: 'env' for name in data}
+        # installed kernels win, like in find_kernel_specs()
+        native = super(EnvironmentKernelSpecManager, self).find_kernel_specs()
+        sources.update((name.lower(), 'native') for name in native)
+        self._kernel_sources_cache = (key, sources)
+        self._missing_kernels = {}
+        return sources
+
+    def _get_env_kernel_spec(self, kernel_name):
+        entry = self.env_registry.get(kernel_name)
+        if entry is None:
+            raise NoSuchKernel(kernel_name)
+        kspec = _kernel_spec(entry)
+        if isinstance(kspec, EnvironmentLoadingKernelSpec) and kspec.on_launch is None:
+            name = kernel_name.lower()
+            kspec.on_launch = lambda: self.record_launch(name)
+        return kspec
+
+    def _search_kernel_spec(self, kernel_name):
+        """Searches the Jupyter kernel dirs and then the environment kernels"""
         try:
             return super(EnvironmentKernelSpecManager,
                          self).get_kernel_spec(kernel_name)
         except (NoSuchKernel, FileNotFoundError):
-            venv_kernel_name = kernel_name.lower()
-            specs = self.get_all_kernel_specs_for_envs()
-            if venv_kernel_name in specs:
-                return specs[venv_kernel_name]
-            else:
-                raise NoSuchKernel(kernel_name)
+            self._get_env_data()
+            return self._get_env_kernel_spec(kernel_name)
+
+    def get_kernel_spec(self, kernel_name):
+        """Returns a :class:`KernelSpec` instance for the given kernel_name.
+
+        Raises :exc:`NoSuchKernel` if the given kernel name is not found.
+        """
+        if not self.env_registry.populated:
+            # don't wait for a scan to find an installed kernel
+            return self._search_kernel_spec(kernel_name)
+
+        name = kernel_name.lower()
+        source = self._kernel_sources().get(name)
+        if source == 'env':
+            self.kernel_lookups["env"] += 1
+            return self._get_env_kernel_spec(kernel_name)
+        if source == 'native':
+            self.kernel_lookups["native"] += 1
+            return self._search_kernel_spec(kernel_name)
+
+        # not installed when the index was built or really missing
+        now = time.time()
+        if self._missing_kernels.get(name, 0) > now:
+            self.kernel_lookups["missing"] += 1
+            raise NoSuchKernel(kernel_name)
+        try:
+            return self._search_kernel_spec(kernel_name)
+        except NoSuchKernel:
+            if self.missing_kernel_ttl > 0:
+                if len(self._missing_kernels) >= 1000:
+                    self._missing_kernels = {key: until for key, until in
+                                             self._missing_kernels.items() if until > now}
+                self._missing_kernels[name] = now + self.missing_kernel_ttl
+            raise
@@ -2,29 +2,80 @@
 """Common function to deal with virtual environments"""
 from __future__ import absolute_import
 
+import asyncio
+import threading
+import time
+
 from jupyter_client.kernelspec import KernelSpec
 from traitlets import default
 
+from .tracing import span
+
 _nothing = object()
 
 class EnvironmentLoadingKernelSpec(KernelSpec):
     """A KernelSpec which loads `env` by activating the virtual environment"""
 
     _loader = None
+    _async_loader = None
     _env = _nothing
+    # path of the environment this kernel lives in
+    env_path = None
+    # called whenever the kernel is launched (= its env is requested)
+    on_launch = None
 
     @property
     def env(self):
+        if self.on_launch is not None:
+            self.on_launch()
+        return self.load_env()
+
+    @property
+    def env_loaded(self):
+        """True if the environment is already activated"""
+        return self._env is not _nothing
+
+    def load_env(self):
+        """Activates the environment (once) and returns the env vars"""
         if self._env is _nothing:
-            if self._loader:
-                try:
-                    self._env = self._loader()
-                except:
-                    self._env = {}
+            # prewarm threads, the kernel pool and launches can ask at the same time
+            with self._env_lock:
+                if self._env is _nothing and self._loader:
+                    try:
+                        self._env = self._loader()
+                    except:
+                        self._env = {}
+        return self._env
+
+    async def load_env_async(self, engine):
+        """Activates the environment on the asyncio engine, so that `env` is already loaded.
+
+        Without an async loader (or while a thread activates the env), `load_env` runs in an
+        executor, so that the event loop is never blocked by the activation.
+        """
+        if self._env is not _nothing:
+            return self._env
+        if not self._async_loader or self._env_lock.locked():
+            return await asyncio.get_running_loop().run_in_executor(None, self.load_env)
+        if self._env_task is None:
+            # concurrent callers wait for the same activation
+            self._env_task = asyncio.ensure_future(self._async_loader(engine))
+        task = self._env_task
+        try:
+            env = await asyncio.shield(task)
+        except Exception:
+            env = {}
+        with self._env_lock:
+            if self._env is _nothing:
+                self._env = env
         return self._env
 
-    def __init__(self, loader, **kwargs):
+    def __init__(self, loader, async_loader=None, env_path=None, **kwargs):
         self._loader = loader
+        self._async_loader = async_loader
+        self._env_lock = threading.Lock()
+        self._env_task = None
+        self.env_path = env_path
         super(EnvironmentLoadingKernelSpec, self).__init__(**kwargs)
 
 
@@ -39,3 +90,110 @@ class EnvironmentLoadingKernelSpec(KernelSpec):
 
         return d
 
+
+class EnvironmentKernelRecord(object):
+    """What a scan knows about an environment kernel.
+
+    Much smaller and faster to create than a `KernelSpec`; the
+    `EnvironmentLoadingKernelSpec` is only created when the kernel is requested via
+    `kernel_spec()` (and then kept, so that the activation is done only once).
+    """
+
+    __slots__ = ('argv', 'language', 'display_name', 'resource_dir', 'metadata', 'env_path',
+                 '_mgr', '_activate_func', '_async_activate_func', '_kernel_spec')
+
+    def __init__(self, argv, language, display_name, resource_dir, metadata, env_path,
+                 mgr, activate_func, async_activate_func=None):
+        self.argv = argv
+        self.language = language
+        self.display_name = display_name
+        self.resource_dir = resource_dir
+        self.metadata = metadata
+        self.env_path = env_path
+        self._mgr = mgr
+        self._activate_func = activate_func
+        self._async_activate_func = async_activate_func
+        self._kernel_spec = None
+
+    @property
+    def env_loaded(self):
+        """True if the environment is already activated"""
+        return self._kernel_spec is not None and self._kernel_spec.env_loaded
+
+    def _launcher_kind(self):
+        """Returns the kind of activation for the launcher or None if the env is activated
+        by the server"""
+        if getattr(self._mgr, 'activation_mode', 'server') != 'launcher':
+            return None
+        return getattr(self._activate_func, 'launcher_kind', None)
+
+    def launch_argv(self):
+        """Returns the argv the kernel is started with"""
+        kind = self._launcher_kind()
+        if kind is None:
+            return self.argv
+        from .launcher import launcher_argv
+        return launcher_argv(kind, self.env_path, self.argv,
+                             timeout=self._mgr.activation_timeout,
+                             static=self._mgr.static_activation,
+                             strategy=self._mgr.get_activation_strategy(self.env_path))
+
+    def kernel_spec(self):
+        """Returns the `EnvironmentLoadingKernelSpec` of this kernel"""
+        if self._kernel_spec is None and self._launcher_kind() is not None:
+            # the launcher activates the env in the kernel process
+            self._kernel_spec = EnvironmentLoadingKernelSpec(
+                dict, env_path=self.env_path, argv=self.launch_argv(), language=self.language,
+                display_name=self.display_name, resource_dir=self.resource_dir,
+                metadata=self.metadata)
+        if self._kernel_spec is None:
+            mgr, env_dir = self._mgr, self.env_path
+            activated = getattr(mgr, "activation_finished", None)
+            # activations outside of a scan are written as traces of their own
+            trace_span = getattr(mgr, "trace_span", span)
+
+            def loader(activate_func=self._activate_func):
+                mgr.log.debug("Loading env data for %s" % env_dir)
+                start = time.time()
+                with trace_span("activation", "activation", env=env_dir) as info:
+                    env = activate_func(mgr, env_dir)
+                    info["variables"] = len(env)
+                if activated is not None:
+                    activated(self, time.time() - start)
+                return env
+
+            async_loader = None
+            if self._async_activate_func is not None:
+                async def async_loader(engine, async_activate_func=self._async_activate_func):
+                    mgr.log.debug("Loading env data for %s" % env_dir)
+                    start = time.time()
+                    with trace_span("activation", "activation", env=env_dir) as info:
+                        env = await async_activate_func(mgr, engine, env_dir)
+                        info["variables"] = len(env)
+                    if activated is not None:
+                        activated(self, time.time() - start)
+                    return env
+
+            self._kernel_spec = EnvironmentLoadingKernelSpec(
+                loader, async_loader=async_loader, env_path=env_dir, argv=self.argv,
+                language=self.language, display_name=self.display_name,
+                resource_dir=self.resource_dir, metadata=self.metadata)
+        return self._kernel_spec
+
+    def profile_activation(self):
+        """Activates the environment with profiling and returns the breakdown.
+
+        See `activate_helper.profile_shell`. Returns None if the activation doesn't run a
+        shell (or can't be profiled).
+        """
+        profile_func = getattr(self._activate_func, "profile_func", None)
+        if profile_func is None:
+            return None
+        return profile_func(self._mgr, self.env_path)
+
+    def to_dict(self):
+        return dict(argv=self.launch_argv(),
+                    display_name=self.display_name,
+                    language=self.language,
+                    metadata=self.metadata,
+                    )
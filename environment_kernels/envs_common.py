@@ -2,107 +2,591 @@
 """Common function to deal with virtual environments"""
 from __future__ import absolute_import
 
+import collections
+import contextvars
 import platform
 import os
 import glob
+import json
+import threading
 
-from .env_kernelspec import EnvironmentLoadingKernelSpec
+from .activate_helper import (ACTIVATION_STRATEGIES, source_env_vars_from_command,
+                              source_env_vars_from_command_async)
+from .env_kernelspec import EnvironmentKernelRecord
+from .probe_cache import interpreter_state_key
+from .scheduler import measure_thread_cpu
+from .subprocess_helper import MemoryLimitExceeded, TimeoutExpired, check_call, check_output
+from .tracing import span
 
 JLAB_MINVERSION_3 = None
 
+# Per-thread settings of the supplier which is currently running in this thread
+_supplier_context = threading.local()
+
+
+def set_probe_concurrency(concurrency):
+    """Sets how many envs the supplier running in this thread may probe in parallel"""
+    _supplier_context.concurrency = max(1, int(concurrency))
+
+
+def get_probe_concurrency():
+    """Returns how many envs the supplier running in this thread may probe in parallel"""
+    return getattr(_supplier_context, "concurrency", 1)
+
 def find_env_paths_in_basedirs(base_dirs):
     """Returns all potential envs in a basedir"""
     # get potential env path in the base_dirs
     env_path = []
     for base_dir in base_dirs:
-        env_path.extend(glob.glob(os.path.join(
-            os.path.expanduser(base_dir), '*', '')))
+        # sorted: glob returns the directory order of the file system
+        env_path.extend(sorted(glob.glob(os.path.join(
+            os.path.expanduser(base_dir), '*', ''))))
     # self.log.info("Found the following kernels from config: %s", ", ".join(venvs))
 
     return env_path
 
 
+def dedupe_env_paths(mgr, env_paths, source, probes_per_env=1):
+    """Removes env paths which point to the same environment as an earlier one.
+
+    Paths are compared by the device and inode of the directory they point to (by their
+    real path if they can't be stat'ed), so trailing slashes, symlinks and bind mounts
+    don't lead to probing the same env twice. Of the paths to the same env, the one which
+    is not a symlink wins (else the first in sort order), so that the name derived from it
+    doesn't depend on the order of the directory listing. It takes the place of the first
+    of these paths. The number of dropped paths is recorded for `source` in
+    `mgr.dedupe_stats`.
+    """
+    # key -> the paths to that env, in the order of the first one
+    groups = collections.OrderedDict()
+    for env_path in env_paths:
+        try:
+            st = os.stat(env_path)
+            key = (st.st_dev, st.st_ino)
+        except OSError:
+            key = os.path.normcase(os.path.realpath(env_path))
+        groups.setdefault(key, []).append(env_path)
+    result = []
+    for paths in groups.values():
+        env_path = min(paths, key=lambda path: (not _is_real_path(path), path))
+        for path in paths:
+            if path != env_path:
+                mgr.log.debug("Skipping %s, it is the same environment as %s.", path, env_path)
+        result.append(env_path)
+    duplicates = len(env_paths) - len(result)
+    mgr.dedupe_stats[source] = {"duplicate_envs": duplicates,
+                                "probes_avoided": duplicates * probes_per_env}
+    return result
+
+
+def _is_real_path(path):
+    """Whether path is the real path of the directory (no symlink on the way)"""
+    return os.path.normcase(os.path.realpath(path)) == os.path.normcase(os.path.abspath(path))
+
+
 def convert_to_env_data(mgr, env_paths, validator_func, activate_func,
                         name_template, display_name_template, name_prefix):
     """Converts a list of paths to environments to env_data.
 
-    env_data is a structure {name -> (ressourcedir, kernel spec)}
+    env_data is a structure {name -> (ressourcedir, kernel record)}
+    """
+    return dict(iter_env_data(mgr, env_paths, validator_func, activate_func,
+                              name_template, display_name_template, name_prefix))
+
+
+def iter_env_data(mgr, env_paths, validator_func, activate_func,
+                  name_template, display_name_template, name_prefix):
+    """Like `convert_to_env_data`, but yields (name, (ressourcedir, kernel record)) as soon as
+    the env is validated."""
+    candidates = _get_env_candidates(mgr, env_paths, name_template, name_prefix)
+
+    # probing means starting interpreters, so do it in parallel if the supplier is allowed to
+    concurrency = min(get_probe_concurrency(), len(candidates))
+    if concurrency > 1:
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        futures = {}
+        try:
+            # the probes keep the priority of the scan (see `background_work`)
+            futures = {executor.submit(contextvars.copy_context().run, _probe_env, mgr, venv_dir,
+                                       validator_func): (kernel_name, venv_dir)
+                       for kernel_name, venv_dir in candidates}
+            for future in as_completed(futures):
+                kernel_name, venv_dir = futures[future]
+                entry = _make_env_entry(mgr, venv_dir, future.result(), activate_func,
+                                        display_name_template.format(kernel_name))
+                if entry is not None:
+                    yield kernel_name, entry
+        finally:
+            # don't wait for the remaining probes if we are not interested anymore
+            # (`shutdown(cancel_futures=True)` needs python 3.9)
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+    else:
+        for kernel_name, venv_dir in candidates:
+            entry = _make_env_entry(mgr, venv_dir, _probe_env(mgr, venv_dir, validator_func),
+                                    activate_func, display_name_template.format(kernel_name))
+            if entry is not None:
+                yield kernel_name, entry
+
+
+async def convert_to_env_data_async(mgr, engine, env_paths, validator_func, activate_func,
+                                    name_template, display_name_template, name_prefix,
+                                    async_activate_func=None):
+    """Like `convert_to_env_data`, but probes all envs concurrently on the asyncio engine.
+
+    validator_func has to be a coroutine function taking (engine, venv_dir, timeout, cache).
     """
     env_data = {}
+    async for kernel_name, entry in iter_env_data_async(
+            mgr, engine, env_paths, validator_func, activate_func, name_template,
+            display_name_template, name_prefix, async_activate_func=async_activate_func):
+        env_data[kernel_name] = entry
+    return env_data
+
+
+async def iter_env_data_async(mgr, engine, env_paths, validator_func, activate_func,
+                              name_template, display_name_template, name_prefix,
+                              async_activate_func=None):
+    """Like `iter_env_data`, but probes all envs concurrently on the asyncio engine."""
+    import asyncio
+    candidates = _get_env_candidates(mgr, env_paths, name_template, name_prefix)
+
+    async def probe(kernel_name, venv_dir):
+        # the same as `_probe_env`, only the validator is awaited
+        with span("probe", "probe", env=venv_dir, validator=_func_name(validator_func)) as info:
+            result, key = _probe_without_validator(mgr, venv_dir, validator_func, info)
+            if result is None:
+                try:
+                    result = await validator_func(engine, venv_dir, timeout=mgr.probe_timeout,
+                                                  cache=mgr.probe_cache)
+                except (TimeoutExpired, MemoryLimitExceeded) as e:
+                    result = _probe_failed(mgr, venv_dir, key, e, info)
+                else:
+                    result = _probe_succeeded(mgr, key, result, info)
+            return kernel_name, venv_dir, result
+
+    tasks = [asyncio.ensure_future(probe(kernel_name, venv_dir))
+             for kernel_name, venv_dir in candidates]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            kernel_name, venv_dir, result = await next_done
+            entry = _make_env_entry(mgr, venv_dir, result, activate_func,
+                                    display_name_template.format(kernel_name),
+                                    async_activate_func=async_activate_func)
+            if entry is not None:
+                yield kernel_name, entry
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _get_env_candidates(mgr, env_paths, name_template, name_prefix):
+    """Returns a list of (kernel_name, env_path), duplicates are resolved in the order of env_paths"""
+    candidates = []
+    seen = set()
     for venv_dir in env_paths:
-        venv_name = os.path.split(os.path.abspath(venv_dir))[1]
-        kernel_name = name_template.format(name_prefix + venv_name)
-        kernel_name = kernel_name.lower()
-        if kernel_name in env_data:
+        kernel_name = _env_kernel_name(venv_dir, name_template, name_prefix)
+        if kernel_name in seen:
             mgr.log.debug(
                 "Found duplicate env kernel: %s, which would again point to %s. Using the first!",
                 kernel_name, venv_dir)
             continue
-        argv, language, resource_dir, metadata = validator_func(venv_dir)
-        if not argv:
-            # probably does not contain the kernel type (e.g. not R or python or does not contain
-            # the kernel code itself)
-            continue
-        display_name = display_name_template.format(kernel_name)
-        kspec_dict = {"argv": argv, "language": language,
-                      "display_name": display_name,
-                      "resource_dir": resource_dir,
-                      "metadata": metadata
-                      }
-
-        # the default vars are needed to save the vars in the function context
-        def loader(env_dir=venv_dir, activate_func=activate_func, mgr=mgr):
-            mgr.log.debug("Loading env data for %s" % env_dir)
-            res = activate_func(mgr, env_dir)
-            # mgr.log.info("PATH: %s" % res['PATH'])
-            return res
-
-        kspec = EnvironmentLoadingKernelSpec(loader, **kspec_dict)
-        env_data.update({kernel_name: (resource_dir, kspec)})
-    return env_data
+        seen.add(kernel_name)
+        candidates.append((kernel_name, venv_dir))
+    # probe the envs which are launched most first, they should be available first
+    return mgr.kernel_usage.sort_env_paths(candidates, key=lambda candidate: candidate[1])
+
+
+def _env_kernel_name(venv_dir, name_template, name_prefix):
+    parent, venv_name = os.path.split(os.path.abspath(venv_dir))
+    if venv_name == ".venv":
+        # an in-project env (uv, poetry, ...) is named after its project
+        venv_name = os.path.basename(parent)
+    return name_template.format(name_prefix + venv_name).lower()
+
+
+def _probe_env(mgr, venv_dir, validator_func):
+    """Runs the validator on the env, unless the env is quarantined"""
+    # probes in threads of their own count for the CPU time of the scan
+    with measure_thread_cpu(), \
+            span("probe", "probe", env=venv_dir, validator=_func_name(validator_func)) as info:
+        result, key = _probe_without_validator(mgr, venv_dir, validator_func, info)
+        if result is not None:
+            return result
+        try:
+            result = validator_func(venv_dir, timeout=mgr.probe_timeout, cache=mgr.probe_cache)
+        except (TimeoutExpired, MemoryLimitExceeded) as e:
+            return _probe_failed(mgr, venv_dir, key, e, info)
+        return _probe_succeeded(mgr, key, result, info)
+
+
+def _probe_without_validator(mgr, venv_dir, validator_func, info):
+    """Returns (result, quarantine key); result is None if the validator has to run.
+
+    An installed kernelspec is used without probing, a quarantined env is skipped.
+    """
+    installed = _installed_kernel_result(mgr, venv_dir, validator_func)
+    if installed is not None:
+        info["outcome"] = "installed kernelspec"
+        return installed, None
+    key = _quarantine_key(venv_dir, validator_func)
+    if mgr.probe_quarantine.is_quarantined(key):
+        mgr.log.debug("Skipping quarantined environment %s", venv_dir)
+        info["outcome"] = "quarantined"
+        return ([], None, None, {}), key
+    return None, key
 
 
-def validate_IPykernel(venv_dir):
-    """Validates that this env contains an IPython kernel and returns info to start it
+def _probe_succeeded(mgr, key, result, info):
+    mgr.probe_quarantine.record_success(key)
+    info["outcome"] = _probe_outcome(result)
+    return result
 
 
-    Returns: tuple
-        (ARGV, language, resource_dir)
+def _probe_failed(mgr, venv_dir, key, error, info):
+    """Records a probe which timed out or was killed and returns the result for the env"""
+    if isinstance(error, MemoryLimitExceeded):
+        # not cached as result of the probe, but quarantined like a hanging probe
+        mgr.log.warning("Probing environment %s was aborted: %s.", venv_dir, error)
+        info["outcome"] = "memory limit"
+    else:
+        mgr.log.warning("Probing environment %s timed out after %s seconds.",
+                        venv_dir, mgr.probe_timeout)
+        info["outcome"] = "timeout"
+    mgr.probe_quarantine.record_timeout(key)
+    return [], None, None, {}
+
+
+def _func_name(func):
+    return getattr(func, "__name__", repr(func))
+
+
+def _probe_outcome(result):
+    """Describes the result of a validator for a trace"""
+    return "kernel" if result[0] else "no kernel"
+
+
+def _quarantine_key(venv_dir, validator_func):
+    """Returns the key of the env in the quarantine.
+
+    Each kernel language is quarantined on its own, so that e.g. a quick R probe does not
+    release an env whose python hangs.
+    """
+    language = getattr(validator_func, "kernel_language", None) or _func_name(validator_func)
+    return "%s (%s)" % (os.path.abspath(venv_dir), language)
+
+
+def _make_env_entry(mgr, venv_dir, result, activate_func, display_name,
+                    async_activate_func=None):
+    """Returns (resource_dir, kernel record) from the result of the validator or None"""
+    argv, language, resource_dir, metadata = result
+    if not argv:
+        # probably does not contain the kernel type (e.g. not R or python or does not contain
+        # the kernel code itself)
+        return None
+    record = EnvironmentKernelRecord(argv, language, display_name, resource_dir, metadata,
+                                     os.path.abspath(venv_dir), mgr, activate_func,
+                                     async_activate_func=async_activate_func)
+    return resource_dir, record
+
+
+def find_installed_kernelspecs(venv_dir, cache=None):
+    """Returns [(name, resource_dir, spec dict)] of the kernelspecs installed in the env.
+
+    The kernelspecs are read from `share/jupyter/kernels/*/kernel.json` and their argv is
+    rewritten to start the executable of the env. Kernelspecs whose executable is not in
+    the env are skipped. With a `ProbeCache`, each kernel.json is only parsed again after
+    it changed.
+    """
+    kernels_dir = os.path.join(venv_dir, "share", "jupyter", "kernels")
+    try:
+        names = sorted(os.listdir(kernels_dir))
+    except OSError:
+        return []
+    specs = []
+    for name in names:
+        resource_dir = os.path.join(kernels_dir, name)
+        try:
+            spec = _read_kernel_json(os.path.join(resource_dir, "kernel.json"), cache)
+        except OSError:
+            continue
+        if not isinstance(spec, dict) or not spec.get("argv"):
+            continue
+        argv = _env_argv(venv_dir, spec["argv"])
+        if argv is not None:
+            specs.append((name, resource_dir, dict(spec, argv=argv)))
+    return specs
+
+
+def _read_kernel_json(path, cache=None):
+    """Returns the parsed kernel.json or None if it is not valid json"""
+    def parse():
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    if cache is None:
+        return parse()
+    st = os.stat(path)
+    key = ("kernel.json", os.path.realpath(path), st.st_dev, st.st_ino, st.st_mtime_ns,
+           st.st_size)
+    return cache.get_or_probe(key, parse)
+
+
+def _env_argv(venv_dir, argv):
+    """Returns argv with its executable replaced by the one in the env or None"""
+    exe = argv[0]
+    name = os.path.basename(exe)
+    if platform.system() == "Windows" and name.lower().endswith(".exe"):
+        name = name[:-len(".exe")]
+    env_exe = find_exe(venv_dir, name)
+    if env_exe is None:
+        if not (os.path.isabs(exe) and os.path.exists(exe) and _is_in_dir(exe, venv_dir)):
+            return None
+        env_exe = exe
+    return [env_exe] + list(argv[1:])
+
+
+def _is_in_dir(path, directory):
+    """Whether path is inside directory (as written or with the symlinks resolved)"""
+    for normalize in (os.path.abspath, os.path.realpath):
+        p, d = normalize(path), normalize(directory)
+        try:
+            if os.path.commonpath([p, d]) == d:
+                return True
+        except ValueError:
+            # e.g. on different drives
+            pass
+    return False
+
+
+# the kernelspec names ipykernel and IRkernel install, preferred over other ones
+_DEFAULT_KERNELSPEC_NAMES = ["python3", "python2", "ir"]
+
+
+def installed_kernel_info(venv_dir, language, cache=None):
+    """Returns (argv, language, resource_dir, metadata) of the kernelspec installed in the env
+    for that language (like a validator) or None"""
+    specs = [(name, resource_dir, spec) for name, resource_dir, spec
+             in find_installed_kernelspecs(venv_dir, cache=cache)
+             if (spec.get("language") or "").lower() == language]
+    if not specs:
+        return None
+    specs.sort(key=lambda item: item[0] not in _DEFAULT_KERNELSPEC_NAMES)
+    name, resource_dir, spec = specs[0]
+    return spec["argv"], spec.get("language"), resource_dir, spec.get("metadata") or {}
+
+
+def _installed_kernel_result(mgr, venv_dir, validator_func):
+    """Returns the result of the validator from the kernelspecs installed in the env or None"""
+    language = getattr(validator_func, "kernel_language", None)
+    if language is None or not mgr.use_installed_kernelspecs:
+        return None
+    return installed_kernel_info(venv_dir, language, cache=mgr.probe_cache)
+
+
+def iter_installed_kernel_data(mgr, env_paths, activate_func, name_template,
+                               display_name_template, skip_languages=("python",),
+                               async_activate_func=None):
+    """Yields (name, (resource_dir, kernel record)) for the kernelspecs installed in the envs.
+
+    Kernelspecs for languages in skip_languages are left out, the validators of the
+    supplier already use them. The kernels are named after the kernelspec and the env
+    (e.g. `conda_julia-1.9_myenv`).
     """
+    if not mgr.use_installed_kernelspecs:
+        return
+    for venv_dir in env_paths:
+        for spec_name, resource_dir, spec in find_installed_kernelspecs(venv_dir,
+                                                                        cache=mgr.probe_cache):
+            if (spec.get("language") or "").lower() in skip_languages:
+                continue
+            kernel_name = _env_kernel_name(venv_dir, name_template, spec_name + "_")
+            record = EnvironmentKernelRecord(spec["argv"], spec.get("language"),
+                                             display_name_template.format(kernel_name),
+                                             resource_dir, spec.get("metadata") or {},
+                                             os.path.abspath(venv_dir), mgr, activate_func,
+                                             async_activate_func=async_activate_func)
+            yield kernel_name, (resource_dir, record)
+
+
+async def iter_installed_kernel_data_async(*args, **kwargs):
+    """Like `iter_installed_kernel_data`, as async generator (reading the specs is cheap)"""
+    for item in iter_installed_kernel_data(*args, **kwargs):
+        yield item
+
+
+def _find_python_exe(venv_dir):
+    """Returns the python interpreter of an env which also has ipython installed"""
     python_exe_name = find_exe(venv_dir, "python")
     if python_exe_name is None:
         python_exe_name = find_exe(venv_dir, "python2")
     if python_exe_name is None:
         python_exe_name = find_exe(venv_dir, "python3")
     if python_exe_name is None:
-        return [], None, None, {}
+        return None
 
     # Make some checks for ipython first, because calling the import is expensive
     if find_exe(venv_dir, "ipython") is None:
         if find_exe(venv_dir, "ipython2") is None:
             if find_exe(venv_dir, "ipython3") is None:
-                return [], None, None, {}
+                return None
+    return python_exe_name
 
-    # check if this is really an ipython **kernel**
-    import subprocess
-    try:
-        subprocess.check_call([python_exe_name, '-c', 'import ipykernel'], stderr=subprocess.DEVNULL)
-    except:
-        # not installed? -> not useable in any case...
-        return [], None, None, {}
 
+def _ipykernel_info(python_exe_name, debugger):
     argv = [python_exe_name, "-m", "ipykernel", "-f", "{connection_file}"]
     resources_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logos", "python")
 
     metadata = {}
-    if is_jlab_minversion_3() and is_ipykernel_minversion_6(python_exe_name):
+    if debugger:
         metadata["debugger"] = True
     return argv, "python", resources_dir, metadata
 
 
-def validate_IRkernel(venv_dir):
+def _python_state_key(python_exe_name, venv_dir):
+    return interpreter_state_key("python", python_exe_name,
+                                 [os.path.join(venv_dir, "lib", "python*", "site-packages"),
+                                  os.path.join(venv_dir, "Lib", "site-packages")])
+
+
+def validate_IPykernel(venv_dir, timeout=None, cache=None):
+    """Validates that this env contains an IPython kernel and returns info to start it
+
+    Raises `subprocess.TimeoutExpired` if the interpreter does not answer within timeout seconds.
+    If a `ProbeCache` is given, the interpreter is only run if its state is not cached.
+
+
+    Returns: tuple
+        (ARGV, language, resource_dir)
+    """
+    python_exe_name = _find_python_exe(venv_dir)
+    if python_exe_name is None:
+        return [], None, None, {}
+
+    def probe():
+        # check if this is really an ipython **kernel**
+        import subprocess
+        try:
+            check_call([python_exe_name, '-c', 'import ipykernel'], stderr=subprocess.DEVNULL,
+                       timeout=timeout)
+        except (TimeoutExpired, MemoryLimitExceeded):
+            raise
+        except Exception:
+            # not installed? -> not useable in any case...
+            return None
+        # whether the debugger is supported
+        return is_jlab_minversion_3() and is_ipykernel_minversion_6(python_exe_name, timeout=timeout)
+
+    if cache is not None:
+        debugger = cache.get_or_probe(_python_state_key(python_exe_name, venv_dir), probe)
+    else:
+        debugger = probe()
+    if debugger is None:
+        return [], None, None, {}
+    return _ipykernel_info(python_exe_name, debugger)
+
+
+async def validate_IPykernel_async(engine, venv_dir, timeout=None, cache=None):
+    """Like `validate_IPykernel`, but runs the interpreter on the asyncio engine"""
+    python_exe_name = _find_python_exe(venv_dir)
+    if python_exe_name is None:
+        return [], None, None, {}
+
+    async def probe():
+        try:
+            await engine.check_call([python_exe_name, '-c', 'import ipykernel'], timeout=timeout)
+        except (TimeoutExpired, MemoryLimitExceeded):
+            raise
+        except Exception:
+            return None
+
+        debugger = False
+        if is_jlab_minversion_3():
+            try:
+                await engine.check_call([python_exe_name, '-c', _IPYKERNEL_MINVERSION_6_CODE],
+                                        timeout=timeout)
+                debugger = True
+            except (TimeoutExpired, MemoryLimitExceeded):
+                raise
+            except Exception:
+                pass
+        return debugger
+
+    if cache is not None:
+        debugger = await cache.get_or_probe_async(_python_state_key(python_exe_name, venv_dir),
+                                                  probe)
+    else:
+        debugger = await probe()
+    if debugger is None:
+        return [], None, None, {}
+    return _ipykernel_info(python_exe_name, debugger)
+
+
+def _site_packages_dirs(venv_dir):
+    return (glob.glob(os.path.join(venv_dir, "lib", "python*", "site-packages")) +
+            glob.glob(os.path.join(venv_dir, "Lib", "site-packages")))
+
+
+def installed_major_version(venv_dir, package):
+    """Returns the major version of a package in the site-packages of the env without
+    running its interpreter, 0 if the version is unknown or None if it is not installed"""
+    for site_packages in _site_packages_dirs(venv_dir):
+        for info in glob.glob(os.path.join(site_packages, package + "-*.dist-info")) + \
+                glob.glob(os.path.join(site_packages, package + "-*.egg-info")):
+            version = os.path.basename(info)[len(package) + 1:].split(".", 1)[0]
+            return int(version) if version.isdigit() else 0
+        if os.path.isfile(os.path.join(site_packages, package, "__init__.py")):
+            return 0
+    return None
+
+
+def validate_IPykernel_static(venv_dir, timeout=None, cache=None):
+    """Like `validate_IPykernel`, but looks for ipykernel in the site-packages of the env
+    instead of importing it, so no interpreter is started.
+
+    Only envs which can see the packages of their base interpreter
+    (`include-system-site-packages`) and don't have ipykernel themselves are probed with
+    `validate_IPykernel`.
+    """
+    python_exe_name = _find_python_exe(venv_dir)
+    if python_exe_name is None:
+        return [], None, None, {}
+    version = installed_major_version(venv_dir, "ipykernel")
+    if version is None:
+        cfg = read_pyvenv_cfg(venv_dir) or {}
+        if cfg.get("include-system-site-packages", "false").lower() == "true":
+            return validate_IPykernel(venv_dir, timeout=timeout, cache=cache)
+        return [], None, None, {}
+    return _ipykernel_info(python_exe_name, version >= 6 and is_jlab_minversion_3())
+
+
+_PRINT_IRKERNEL_RESOURCES = 'cat(as.character(system.file("kernelspec", package = "IRkernel")))'
+
+
+def _irkernel_info(r_exe_name, resources_dir):
+    argv = [r_exe_name, "--slave", "-e", "IRkernel::main()", "--args", "{connection_file}"]
+    if not os.path.exists(resources_dir.strip()):
+        # Fallback to our own log, but don't get the nice js goodies...
+        resources_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logos", "r")
+    return argv, "r", resources_dir, dict()
+
+
+def _r_state_key(r_exe_name, venv_dir):
+    return interpreter_state_key("r", r_exe_name, [os.path.join(venv_dir, "lib", "R", "library"),
+                                                   os.path.join(venv_dir, "Lib", "R", "library")])
+
+
+def validate_IRkernel(venv_dir, timeout=None, cache=None):
     """Validates that this env contains an IRkernel kernel and returns info to start it
 
+    Raises `subprocess.TimeoutExpired` if R does not answer within timeout seconds.
+    If a `ProbeCache` is given, R is only run if its state is not cached.
+
 
     Returns: tuple
         (ARGV, language, resource_dir, metadata)
@@ -111,21 +595,140 @@ def validate_IRkernel(venv_dir):
     if r_exe_name is None:
         return [], None, None, None
 
-    # check if this is really an IRkernel **kernel**
-    import subprocess
-    ressources_dir = None
-    try:
-        print_resources = 'cat(as.character(system.file("kernelspec", package = "IRkernel")))'
-        resources_dir_bytes = subprocess.check_output([r_exe_name, '--slave', '-e', print_resources])
-        resources_dir = resources_dir_bytes.decode(errors='ignore')
-    except:
-        # not installed? -> not useable in any case...
+    def probe():
+        # check if this is really an IRkernel **kernel**
+        try:
+            resources_dir_bytes = check_output([r_exe_name, '--slave', '-e', _PRINT_IRKERNEL_RESOURCES],
+                                               timeout=timeout)
+            return resources_dir_bytes.decode(errors='ignore')
+        except (TimeoutExpired, MemoryLimitExceeded):
+            raise
+        except Exception:
+            # not installed? -> not useable in any case...
+            return None
+
+    if cache is not None:
+        resources_dir = cache.get_or_probe(_r_state_key(r_exe_name, venv_dir), probe)
+    else:
+        resources_dir = probe()
+    if resources_dir is None:
         return [], None, None, None
-    argv = [r_exe_name, "--slave", "-e", "IRkernel::main()", "--args", "{connection_file}"]
-    if not os.path.exists(resources_dir.strip()):
-        # Fallback to our own log, but don't get the nice js goodies...
-        resources_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logos", "r")
-    return argv, "r", resources_dir, dict()
+    return _irkernel_info(r_exe_name, resources_dir)
+
+
+async def validate_IRkernel_async(engine, venv_dir, timeout=None, cache=None):
+    """Like `validate_IRkernel`, but runs R on the asyncio engine"""
+    r_exe_name = find_exe(venv_dir, "R")
+    if r_exe_name is None:
+        return [], None, None, None
+
+    async def probe():
+        try:
+            resources_dir_bytes = await engine.check_output(
+                [r_exe_name, '--slave', '-e', _PRINT_IRKERNEL_RESOURCES], timeout=timeout)
+            return resources_dir_bytes.decode(errors='ignore')
+        except (TimeoutExpired, MemoryLimitExceeded):
+            raise
+        except Exception:
+            return None
+
+    if cache is not None:
+        resources_dir = await cache.get_or_probe_async(_r_state_key(r_exe_name, venv_dir), probe)
+    else:
+        resources_dir = await probe()
+    if resources_dir is None:
+        return [], None, None, None
+    return _irkernel_info(r_exe_name, resources_dir)
+
+
+def _activation_strategies(mgr, env_path):
+    """Returns the strategies to try for env_path: the configured one and the fallbacks"""
+    strategy = mgr.get_activation_strategy(env_path)
+    return ACTIVATION_STRATEGIES[ACTIVATION_STRATEGIES.index(strategy):]
+
+
+def _is_activated(envs, expected_var, env_path):
+    if expected_var is None:
+        return True
+    value = envs.get(expected_var)
+    return bool(value) and os.path.realpath(value) == os.path.realpath(env_path)
+
+
+def _retry_activation(mgr, env_path, strategies, i, error):
+    """Whether to try the next strategy after strategies[i] failed with error.
+
+    Timeouts and memory kills are not retried, nor is the last strategy.
+    """
+    if isinstance(error, (TimeoutExpired, MemoryLimitExceeded)) or i == len(strategies) - 1:
+        return False
+    mgr.log.info("Activating %s with the '%s' strategy failed, trying '%s'.",
+                 env_path, strategies[i], strategies[i + 1], exc_info=error)
+    return True
+
+
+def _accept_activation(mgr, env_path, strategies, i, envs, expected_var):
+    """Whether the envs of strategies[i] are used (else the next strategy is tried)"""
+    if i == len(strategies) - 1 or _is_activated(envs, expected_var, env_path):
+        return True
+    mgr.log.info("Activating %s with the '%s' strategy didn't set %s, trying '%s'.",
+                 env_path, strategies[i], expected_var, strategies[i + 1])
+    return False
+
+
+def activate_in_shell(mgr, env_path, args, expected_var=None):
+    """Sources args in a shell and returns the resulting environment.
+
+    Starts with the activation strategy configured for env_path and falls back to the next
+    (more expensive) one if the shell fails or expected_var does not point to env_path
+    afterwards. Timeouts are not retried.
+    """
+    strategies = _activation_strategies(mgr, env_path)
+    for i, strategy in enumerate(strategies):
+        try:
+            with span("activate_shell", "activation", env=env_path, strategy=strategy):
+                envs = source_env_vars_from_command(args, timeout=mgr.activation_timeout,
+                                                    strategy=strategy)
+        except Exception as e:
+            if not _retry_activation(mgr, env_path, strategies, i, e):
+                raise
+            continue
+        if _accept_activation(mgr, env_path, strategies, i, envs, expected_var):
+            return envs
+
+
+async def activate_in_shell_async(mgr, engine, env_path, args, expected_var=None):
+    """Like `activate_in_shell`, but runs the shell on the asyncio engine"""
+    strategies = _activation_strategies(mgr, env_path)
+    for i, strategy in enumerate(strategies):
+        try:
+            with span("activate_shell", "activation", env=env_path, strategy=strategy):
+                envs = await source_env_vars_from_command_async(args, engine,
+                                                                timeout=mgr.activation_timeout,
+                                                                strategy=strategy)
+        except Exception as e:
+            if not _retry_activation(mgr, env_path, strategies, i, e):
+                raise
+            continue
+        if _accept_activation(mgr, env_path, strategies, i, envs, expected_var):
+            return envs
+
+
+def read_pyvenv_cfg(env_dir):
+    """Returns the settings in the `pyvenv.cfg` of a venv/virtualenv as dict.
+
+    Returns None if the env has no `pyvenv.cfg`.
+    """
+    try:
+        with open(os.path.join(env_dir, "pyvenv.cfg"), encoding="utf-8") as f:
+            lines = f.readlines()
+    except (OSError, UnicodeDecodeError):
+        return None
+    cfg = {}
+    for line in lines:
+        key, sep, value = line.partition("=")
+        if sep:
+            cfg[key.strip().lower()] = value.strip()
+    return cfg
 
 
 def find_exe(env_dir, name):
@@ -145,18 +748,23 @@ def find_exe(env_dir, name):
     return exe_name
 
 
-def is_ipykernel_minversion_6(python_exe_name):
-    import subprocess
-    try:
-        subprocess.check_call([python_exe_name, '-c', '''
+_IPYKERNEL_MINVERSION_6_CODE = '''
 import sys
 import ipykernel
 if int(ipykernel.__version__.split('.', maxsplit=1)[0]) >= 6:
     sys.exit(0)
 sys.exit(-1)
 '''
-        ], stderr=subprocess.DEVNULL)
+
+
+def is_ipykernel_minversion_6(python_exe_name, timeout=None):
+    import subprocess
+    try:
+        check_call([python_exe_name, '-c', _IPYKERNEL_MINVERSION_6_CODE],
+                   stderr=subprocess.DEVNULL, timeout=timeout)
         return True
+    except (TimeoutExpired, MemoryLimitExceeded):
+        raise
     except Exception as e:
         return False
 
@@ -166,9 +774,27 @@ def is_jlab_minversion_3():
     if JLAB_MINVERSION_3 is not None:
         return JLAB_MINVERSION_3
 
+    # the metadata is much cheaper to read than importing jupyterlab
     try:
-        import jupyterlab
-        JLAB_MINVERSION_3 = int(jupyterlab.__version__.split('.', maxsplit=1)[0]) >= 3
-    except ModuleNotFoundError:
-        JLAB_MINVERSION_3 = False
+        from importlib.metadata import version, PackageNotFoundError
+        try:
+            jlab_version = version('jupyterlab')
+        except PackageNotFoundError:
+            jlab_version = None
+    except ImportError:
+        try:
+            import jupyterlab
+            jlab_version = jupyterlab.__version__
+        except ModuleNotFoundError:
+            jlab_version = None
+    JLAB_MINVERSION_3 = jlab_version is not None and int(jlab_version.split('.', maxsplit=1)[0]) >= 3
     return JLAB_MINVERSION_3
+
+
+# the language of the kernels the validators look for: envs with an installed kernelspec
+# for it are not probed (see `installed_kernel_info`)
+validate_IPykernel.kernel_language = "python"
+validate_IPykernel_async.kernel_language = "python"
+validate_IPykernel_static.kernel_language = "python"
+validate_IRkernel.kernel_language = "r"
+validate_IRkernel_async.kernel_language = "r"
@@ -2,56 +2,156 @@
 """Functions related to finding conda environments (both Python and R based)"""
 from __future__ import absolute_import
 
-from .activate_helper import source_env_vars_from_command
-from .envs_common import (find_env_paths_in_basedirs, convert_to_env_data,
-                          validate_IPykernel, validate_IRkernel)
+import glob
+import json
+import os
+import shlex
+import subprocess
+
+from .activate_helper import (foreign_shell_data, foreign_shell_data_async, profile_shell,
+                              profile_source)
+from .async_helper import merge_async_iterators
+from .envs_common import (activate_in_shell, activate_in_shell_async, dedupe_env_paths,
+                          find_env_paths_in_basedirs, iter_env_data,
+                          iter_installed_kernel_data, iter_installed_kernel_data_async,
+                          iter_env_data_async, validate_IPykernel, validate_IRkernel,
+                          validate_IPykernel_async, validate_IRkernel_async)
+from .subprocess_helper import TimeoutExpired, run
+from .tracing import span
 from .utils import FileNotFoundError, ON_WINDOWS
 
 def get_conda_env_data(mgr):
     """Finds kernel specs from conda environments
 
-    env_data is a structure {name -> (resourcedir, kernel spec)}
+    Yields (name, (resourcedir, kernel record)) as soon as an environment is validated.
     """
     if not mgr.find_conda_envs:
-        return {}
+        return
 
     mgr.log.debug("Looking for conda environments in %s...", mgr.conda_env_dirs)
 
     # find all potential env paths
     env_paths = find_env_paths_in_basedirs(mgr.conda_env_dirs)
     env_paths.extend(_find_conda_env_paths_from_conda(mgr))
-    env_paths = list(set(env_paths)) # remove duplicates
+    env_paths = dedupe_env_paths(mgr, env_paths, 'conda',
+                                 probes_per_env=2 if mgr.find_r_envs else 1)
 
     mgr.log.debug("Scanning conda environments for python kernels...")
-    env_data = convert_to_env_data(mgr=mgr,
-                                   env_paths=env_paths,
-                                   validator_func=validate_IPykernel,
-                                   activate_func=_get_env_vars_for_conda_env,
-                                   name_template=mgr.conda_prefix_template,
-                                   display_name_template=mgr.display_name_template,
-                                   name_prefix="")  # lets keep the py kernels without a prefix...
+    for item in iter_env_data(mgr=mgr,
+                              env_paths=env_paths,
+                              validator_func=validate_IPykernel,
+                              activate_func=_get_env_vars_for_conda_env,
+                              name_template=mgr.conda_prefix_template,
+                              display_name_template=mgr.display_name_template,
+                              name_prefix=""):  # lets keep the py kernels without a prefix...
+        yield item
     if mgr.find_r_envs:
         mgr.log.debug("Scanning conda environments for R kernels...")
-        env_data.update(convert_to_env_data(mgr=mgr,
-                                            env_paths=env_paths,
-                                            validator_func=validate_IRkernel,
-                                            activate_func=_get_env_vars_for_conda_env,
-                                            name_template=mgr.conda_prefix_template,
-                                            display_name_template=mgr.display_name_template,
-                                            name_prefix="r_"))
-    return env_data
+        for item in iter_env_data(mgr=mgr,
+                                  env_paths=env_paths,
+                                  validator_func=validate_IRkernel,
+                                  activate_func=_get_env_vars_for_conda_env,
+                                  name_template=mgr.conda_prefix_template,
+                                  display_name_template=mgr.display_name_template,
+                                  name_prefix="r_"):
+            yield item
+    for item in iter_installed_kernel_data(mgr=mgr,
+                                           env_paths=env_paths,
+                                           activate_func=_get_env_vars_for_conda_env,
+                                           name_template=mgr.conda_prefix_template,
+                                           display_name_template=mgr.display_name_template,
+                                           skip_languages=_validated_languages(mgr)):
+        yield item
 
 
-def _get_env_vars_for_conda_env(mgr, env_path):
+async def get_conda_env_data_async(mgr, engine):
+    """Like `get_conda_env_data`, but runs all probes on the asyncio engine"""
+    if not mgr.find_conda_envs:
+        return
+
+    mgr.log.debug("Looking for conda environments in %s...", mgr.conda_env_dirs)
+
+    env_paths = find_env_paths_in_basedirs(mgr.conda_env_dirs)
+    env_paths.extend(await _find_conda_env_paths_from_conda_async(mgr, engine))
+    env_paths = dedupe_env_paths(mgr, env_paths, 'conda',
+                                 probes_per_env=2 if mgr.find_r_envs else 1)
+
+    mgr.log.debug("Scanning conda environments for python and R kernels...")
+    scans = [iter_env_data_async(mgr=mgr,
+                                 engine=engine,
+                                 env_paths=env_paths,
+                                 validator_func=validate_IPykernel_async,
+                                 activate_func=_get_env_vars_for_conda_env,
+                                 name_template=mgr.conda_prefix_template,
+                                 display_name_template=mgr.display_name_template,
+                                 name_prefix="",
+                                 async_activate_func=_get_env_vars_for_conda_env_async)]
+    if mgr.find_r_envs:
+        scans.append(iter_env_data_async(mgr=mgr,
+                                         engine=engine,
+                                         env_paths=env_paths,
+                                         validator_func=validate_IRkernel_async,
+                                         activate_func=_get_env_vars_for_conda_env,
+                                         name_template=mgr.conda_prefix_template,
+                                         display_name_template=mgr.display_name_template,
+                                         name_prefix="r_",
+                                         async_activate_func=_get_env_vars_for_conda_env_async))
+    scans.append(iter_installed_kernel_data_async(
+        mgr=mgr,
+        env_paths=env_paths,
+        activate_func=_get_env_vars_for_conda_env,
+        name_template=mgr.conda_prefix_template,
+        display_name_template=mgr.display_name_template,
+        skip_languages=_validated_languages(mgr),
+        async_activate_func=_get_env_vars_for_conda_env_async))
+    async for item in merge_async_iterators(*scans):
+        yield item
+
+
+get_conda_env_data.async_supplier = get_conda_env_data_async
+
+
+def _validated_languages(mgr):
+    """Returns the languages of the kernels the validators find in conda envs"""
+    return ("python", "r") if mgr.find_r_envs else ("python",)
+
+
+def _conda_activate_args(env_path):
     if ON_WINDOWS:
-        args = ['activate', env_path]
+        return ['activate', env_path]
     else:
-        args = ['source', 'activate', env_path]
+        return ['source', 'activate', env_path]
+
+
+def _get_env_vars_for_conda_env(mgr, env_path):
+    if mgr.static_activation:
+        with span("static_activation", "activation", env=env_path) as info:
+            static = get_static_conda_activation(env_path)
+            info["static"] = static is not None
+        if static is not None:
+            env, hooks = static
+            if not hooks:
+                return env
+            try:
+                return foreign_shell_data(currenv=env, timeout=mgr.activation_timeout,
+                                          **_conda_hooks_shell_kwargs(hooks))
+            except TimeoutExpired:
+                mgr.log.error("Running the activate.d scripts of %s timed out after %s seconds, "
+                              "not activating it.", env_path, mgr.activation_timeout)
+                return {}
+            except:
+                mgr.log.exception("Couldn't run the activate.d scripts of %s, "
+                                  "activating it via conda instead.", env_path)
+    args = _conda_activate_args(env_path)
 
     try:
-        envs = source_env_vars_from_command(args)
+        envs = activate_in_shell(mgr, env_path, args, expected_var='CONDA_PREFIX')
         #mgr.log.debug("PATH: %s", envs['PATH'])
         return envs
+    except TimeoutExpired:
+        mgr.log.error("Activating %s timed out after %s seconds, not activating it.",
+                      env_path, mgr.activation_timeout)
+        return {}
     except:
         # as a fallback, don't activate...
         mgr.log.exception(
@@ -59,6 +159,166 @@ def _get_env_vars_for_conda_env(mgr, env_path):
         return {}
 
 
+async def _get_env_vars_for_conda_env_async(mgr, engine, env_path):
+    if mgr.static_activation:
+        with span("static_activation", "activation", env=env_path) as info:
+            static = get_static_conda_activation(env_path)
+            info["static"] = static is not None
+        if static is not None:
+            env, hooks = static
+            if not hooks:
+                return env
+            try:
+                return await foreign_shell_data_async(engine, currenv=env,
+                                                      timeout=mgr.activation_timeout,
+                                                      **_conda_hooks_shell_kwargs(hooks))
+            except TimeoutExpired:
+                mgr.log.error("Running the activate.d scripts of %s timed out after %s seconds, "
+                              "not activating it.", env_path, mgr.activation_timeout)
+                return {}
+            except Exception:
+                mgr.log.exception("Couldn't run the activate.d scripts of %s, "
+                                  "activating it via conda instead.", env_path)
+    args = _conda_activate_args(env_path)
+
+    try:
+        return await activate_in_shell_async(mgr, engine, env_path, args,
+                                             expected_var='CONDA_PREFIX')
+    except TimeoutExpired:
+        mgr.log.error("Activating %s timed out after %s seconds, not activating it.",
+                      env_path, mgr.activation_timeout)
+        return {}
+    except Exception:
+        # as a fallback, don't activate...
+        mgr.log.exception(
+            "Couldn't get environment variables for commands: %s", args)
+        return {}
+
+
+def _profile_conda_activation(mgr, env_path):
+    """Profiles `_get_env_vars_for_conda_env`, see `activate_helper.profile_shell`"""
+    if mgr.static_activation:
+        static = get_static_conda_activation(env_path)
+        if static is not None:
+            env, hooks = static
+            # without hooks there is no shell to profile
+            if hooks:
+                kwargs = _conda_hooks_shell_kwargs(hooks)
+                return profile_shell(kwargs["prevcmd"], strategy=None, currenv=env,
+                                     timeout=mgr.activation_timeout)
+            return None
+    return profile_source(_conda_activate_args(env_path),
+                          strategy=mgr.get_activation_strategy(env_path),
+                          timeout=mgr.activation_timeout)
+
+
+# the name of the activation in the 'launcher' activation mode
+_get_env_vars_for_conda_env.launcher_kind = 'conda'
+_get_env_vars_for_conda_env.profile_func = _profile_conda_activation
+
+
+def get_static_conda_activation(env_path):
+    """Computes the environment of the activated conda env without calling conda.
+
+    Sets the variables `conda activate` sets (`CONDA_PREFIX`, `CONDA_DEFAULT_ENV`,
+    `CONDA_SHLVL`, the env's entries in `PATH`, ...) and the env vars configured via
+    `conda env config vars`.
+
+    Returns a tuple (env, hooks) with hooks being the `etc/conda/activate.d` scripts which
+    still have to be sourced with env as environment, or None if this is not a conda env
+    (or the hooks can't be run without conda). The latter is also the case if the server
+    runs in an activated conda env with `etc/conda/deactivate.d` scripts: only conda knows
+    how to undo them.
+    """
+    prefix = os.path.abspath(env_path)
+    if not os.path.isdir(os.path.join(prefix, "conda-meta")):
+        return None
+    hooks = _conda_hooks(prefix, "activate.d")
+    if hooks and ON_WINDOWS:
+        return None
+
+    env = os.environ.copy()
+    old_prefix = env.get("CONDA_PREFIX")
+    if old_prefix and _conda_hooks(old_prefix, "deactivate.d"):
+        return None
+    try:
+        old_shlvl = int(env.get("CONDA_SHLVL") or 0)
+    except ValueError:
+        old_shlvl = 0
+
+    path = env.get("PATH", "").split(os.pathsep)
+    if old_prefix:
+        # a plain `conda activate` replaces the currently active env
+        old_entries = set(os.path.normcase(p) for p in _conda_path_entries(old_prefix))
+        path = [p for p in path if os.path.normcase(p) not in old_entries]
+        env["CONDA_PREFIX_%d" % old_shlvl] = old_prefix
+        # ... and unsets its `conda env config vars`
+        for name in _conda_env_vars(old_prefix):
+            env.pop(name, None)
+    env["PATH"] = os.pathsep.join(_conda_path_entries(prefix) + path)
+
+    name = _conda_env_name(prefix)
+    env["CONDA_PREFIX"] = prefix
+    env["CONDA_DEFAULT_ENV"] = name
+    env["CONDA_SHLVL"] = str(old_shlvl + 1)
+    env["CONDA_PROMPT_MODIFIER"] = "(%s) " % name
+    env.pop("PYTHONHOME", None)
+
+    env.update(_conda_env_vars(prefix))
+    return env, hooks
+
+
+def _conda_hooks(prefix, kind):
+    """Returns the scripts in `etc/conda/<kind>` of the env which conda would source"""
+    return sorted(glob.glob(os.path.join(prefix, "etc", "conda", kind,
+                                         "*.bat" if ON_WINDOWS else "*.sh")))
+
+
+def _conda_env_vars(prefix):
+    """Returns the env vars set via `conda env config vars` for the env"""
+    try:
+        with open(os.path.join(prefix, "conda-meta", "state"), encoding="utf-8") as f:
+            env_vars = json.load(f).get("env_vars", {})
+        return {str(k): str(v) for k, v in env_vars.items()}
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+
+def _conda_path_entries(prefix):
+    if ON_WINDOWS:
+        return [prefix,
+                os.path.join(prefix, "Library", "mingw-w64", "bin"),
+                os.path.join(prefix, "Library", "usr", "bin"),
+                os.path.join(prefix, "Library", "bin"),
+                os.path.join(prefix, "Scripts"),
+                os.path.join(prefix, "bin")]
+    return [os.path.join(prefix, "bin")]
+
+
+def _conda_env_name(prefix):
+    """Returns the name conda would use for the env in CONDA_DEFAULT_ENV"""
+    if os.path.isdir(os.path.join(prefix, "condabin")):
+        return "base"
+    if os.path.basename(os.path.dirname(prefix)) == "envs":
+        return os.path.basename(prefix)
+    return prefix
+
+
+def _conda_hooks_shell_kwargs(hooks):
+    """Returns the foreign_shell_data arguments to source the hooks in a minimal shell"""
+    return dict(shell="bash",
+                interactive=False,
+                login=False,
+                # no rc files: the hooks only need the activated env
+                extra_args=("--norc", "--noprofile"),
+                prevcmd="\n".join("source %s" % shlex.quote(hook) for hook in hooks),
+                # conda does not stop the activation if a hook fails
+                seterrprevcmd="")
+
+
+_CONDA_ENV_LIST_ARGS = ['conda', 'env', 'list', '--json']
+
+
 def _find_conda_env_paths_from_conda(mgr):
     """Returns a list of path as given by `conda env list --json`.
 
@@ -68,23 +328,50 @@ def _find_conda_env_paths_from_conda(mgr):
     if not mgr.use_conda_directly:
         return []
     mgr.log.debug("Looking for conda environments by calling conda directly...")
-    import subprocess
-    import json
     try:
-        p = subprocess.Popen(
-            ['conda', 'env', 'list', '--json'],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE)
-        comm = p.communicate()
-        output = comm[0].decode()
-        if p.returncode != 0 or len(output) == 0:
-            mgr.log.error(
-                "Couldn't call 'conda' to get the environments. "
-                "Output:\n%s", str(comm))
-            return []
+        p = run(_CONDA_ENV_LIST_ARGS,
+                input=b'',
+                stdout=subprocess.PIPE,
+                timeout=mgr.probe_timeout)
+    except FileNotFoundError:
+        mgr.log.error("'conda' not found in path.")
+        return []
+    except TimeoutExpired:
+        mgr.log.error("Calling 'conda' to get the environments timed out after %s seconds.",
+                      mgr.probe_timeout)
+        return []
+    return _parse_conda_env_list(mgr, p)
+
+
+async def _find_conda_env_paths_from_conda_async(mgr, engine):
+    """Like `_find_conda_env_paths_from_conda`, but calls conda on the asyncio engine"""
+    if not mgr.use_conda_directly:
+        return []
+    mgr.log.debug("Looking for conda environments by calling conda directly...")
+    try:
+        p = await engine.run(_CONDA_ENV_LIST_ARGS,
+                             input=b'',
+                             stderr=None,
+                             timeout=mgr.probe_timeout)
     except FileNotFoundError:
         mgr.log.error("'conda' not found in path.")
         return []
+    except TimeoutExpired:
+        mgr.log.error("Calling 'conda' to get the environments timed out after %s seconds.",
+                      mgr.probe_timeout)
+        return []
+    return _parse_conda_env_list(mgr, p)
+
+
+def _parse_conda_env_list(mgr, p):
+    """Returns the env paths from the finished `conda env list --json` process"""
+    comm = (p.stdout, p.stderr)
+    output = comm[0].decode()
+    if p.returncode != 0 or len(output) == 0:
+        mgr.log.error(
+            "Couldn't call 'conda' to get the environments. "
+            "Output:\n%s", str(comm))
+        return []
     output = json.loads(output)
     envs = output["envs"]
     # self.log.info("Found the following kernels from conda: %s", ", ".join(envs))
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""Functions related to finding the environments of python tools (uv, pyenv, poetry, pipenv)
+
+All of them are found and identified without starting a subprocess: the envs are venvs,
+recognized by their `pyvenv.cfg` (pyenv versions by their interpreter), and ipykernel is
+looked up in their site-packages (or their installed kernelspecs are used).
+"""
+from __future__ import absolute_import
+
+import glob
+import os
+import re
+
+from .envs_common import (dedupe_env_paths, find_exe, iter_env_data,
+                          iter_installed_kernel_data, read_pyvenv_cfg, validate_IPykernel_static)
+from .envs_virtualenv import _get_env_vars_for_virtualenv_env
+from .utils import ON_DARWIN, ON_WINDOWS
+
+
+def _data_home():
+    return os.environ.get("XDG_DATA_HOME") or os.path.expanduser(os.path.join("~", ".local", "share"))
+
+
+def _venvs_in_dirs(base_dirs, pattern="*"):
+    """Returns the venvs (dirs with a pyvenv.cfg) matching pattern in the base dirs"""
+    env_paths = []
+    for base_dir in base_dirs:
+        cfgs = glob.glob(os.path.join(os.path.expanduser(base_dir), pattern, "pyvenv.cfg"))
+        env_paths.extend(os.path.dirname(cfg) for cfg in sorted(cfgs))
+    return env_paths
+
+
+def _without_virtualenv_dirs(mgr, base_dirs):
+    """Drops base dirs which the virtualenv supplier already scans"""
+    if not mgr.find_virtualenv_envs:
+        return list(base_dirs)
+    scanned = set(os.path.realpath(os.path.expanduser(d)) for d in mgr.virtualenv_env_dirs)
+    return [d for d in base_dirs if os.path.realpath(os.path.expanduser(d)) not in scanned]
+
+
+def _iter_tool_env_data(mgr, env_paths, source, name_template,
+                        activate_func=_get_env_vars_for_virtualenv_env):
+    env_paths = dedupe_env_paths(mgr, env_paths, source)
+    mgr.log.debug("Scanning %s environments for python kernels...", source)
+    for item in iter_env_data(mgr=mgr,
+                              env_paths=env_paths,
+                              validator_func=validate_IPykernel_static,
+                              activate_func=activate_func,
+                              name_template=name_template,
+                              display_name_template=mgr.display_name_template,
+                              name_prefix=""):
+        yield item
+    for item in iter_installed_kernel_data(mgr=mgr,
+                                           env_paths=env_paths,
+                                           activate_func=activate_func,
+                                           name_template=name_template,
+                                           display_name_template=mgr.display_name_template):
+        yield item
+
+
+def default_uv_tool_dirs():
+    """Returns the dir of the envs of `uv tool install`"""
+    if os.environ.get("UV_TOOL_DIR"):
+        return [os.environ["UV_TOOL_DIR"]]
+    if ON_WINDOWS:
+        return [os.path.join(os.environ.get("APPDATA", ""), "uv", "tools")]
+    return [os.path.join(_data_home(), "uv", "tools")]
+
+
+def get_uv_env_data(mgr):
+    """Finds kernel specs from the venvs created by uv.
+
+    These are the `.venv` dirs of the projects in `uv_project_dirs` and the tool envs. Only
+    venvs whose `pyvenv.cfg` says they were created by uv are used.
+    """
+    if not mgr.find_uv_envs:
+        return
+
+    env_paths = (_venvs_in_dirs(mgr.uv_project_dirs, ".venv") +
+                 _venvs_in_dirs(mgr.uv_project_dirs, os.path.join("*", ".venv")) +
+                 _venvs_in_dirs(default_uv_tool_dirs()))
+    env_paths = [env_path for env_path in env_paths if "uv" in (read_pyvenv_cfg(env_path) or {})]
+    for item in _iter_tool_env_data(mgr, env_paths, "uv", mgr.uv_prefix_template):
+        yield item
+
+
+def default_pyenv_root():
+    """Returns the root dir of pyenv (or pyenv-win)"""
+    root = os.environ.get("PYENV_ROOT") or os.path.expanduser(os.path.join("~", ".pyenv"))
+    if ON_WINDOWS and os.path.isdir(os.path.join(root, "pyenv-win")):
+        root = os.path.join(root, "pyenv-win")
+    return root
+
+
+def _get_env_vars_for_python_install(mgr, env_path):
+    """Activates a plain python installation: puts its bin dir first on PATH"""
+    env = os.environ.copy()
+    bin_dirs = [env_path, os.path.join(env_path, "Scripts")] if ON_WINDOWS else \
+        [os.path.join(env_path, "bin")]
+    env["PATH"] = os.pathsep.join(bin_dirs + [env.get("PATH", "")])
+    env.pop("PYTHONHOME", None)
+    return env
+
+
+# the name of the activation in the 'launcher' activation mode
+_get_env_vars_for_python_install.launcher_kind = 'python'
+
+
+def get_pyenv_env_data(mgr):
+    """Finds kernel specs from the python versions and virtualenvs managed by pyenv"""
+    if not mgr.find_pyenv_envs:
+        return
+
+    versions_dir = os.path.join(os.path.expanduser(mgr.pyenv_root), "versions")
+    # pyenv-virtualenv envs live in versions/<version>/envs/<name> and are also linked as
+    # versions/<name>, so they come first and the links are deduplicated
+    env_paths = _venvs_in_dirs([versions_dir], os.path.join("*", "envs", "*")) + \
+        _venvs_in_dirs([versions_dir])
+    for item in _iter_tool_env_data(mgr, env_paths, "pyenv", mgr.pyenv_prefix_template):
+        yield item
+
+    venvs = set(os.path.realpath(env_path) for env_path in env_paths)
+    installs = [env_path for env_path in sorted(glob.glob(os.path.join(versions_dir, "*")))
+                if os.path.realpath(env_path) not in venvs and find_exe(env_path, "python")]
+    for item in _iter_tool_env_data(mgr, installs, "pyenv_versions", mgr.pyenv_prefix_template,
+                                    activate_func=_get_env_vars_for_python_install):
+        yield item
+
+
+def _poetry_dirs():
+    """Returns (config dir, cache dir) of poetry"""
+    if ON_WINDOWS:
+        config_dir = os.path.join(os.environ.get("APPDATA", ""), "pypoetry")
+        cache_dir = os.path.join(os.environ.get("LOCALAPPDATA", ""), "pypoetry", "Cache")
+    elif ON_DARWIN:
+        config_dir = os.path.expanduser("~/Library/Application Support/pypoetry")
+        cache_dir = os.path.expanduser("~/Library/Caches/pypoetry")
+    else:
+        config_dir = os.path.join(os.environ.get("XDG_CONFIG_HOME") or
+                                  os.path.expanduser("~/.config"), "pypoetry")
+        cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME") or
+                                 os.path.expanduser("~/.cache"), "pypoetry")
+    return (os.environ.get("POETRY_CONFIG_DIR") or config_dir,
+            os.environ.get("POETRY_CACHE_DIR") or cache_dir)
+
+
+_POETRY_PATH_RE = re.compile(r'^\s*(?:virtualenvs\.)?path\s*=\s*["\']([^"\']+)["\']', re.MULTILINE)
+
+
+def _poetry_config_virtualenvs_path(config_dir):
+    """Returns `virtualenvs.path` of the poetry config or None"""
+    try:
+        with open(os.path.join(config_dir, "config.toml"), encoding="utf-8") as f:
+            text = f.read()
+    except (OSError, UnicodeDecodeError):
+        return None
+    try:
+        import tomllib
+    except ImportError:
+        # only the [virtualenvs] table and the dotted key
+        section = re.split(r'^\s*\[virtualenvs\]\s*$', text, maxsplit=1, flags=re.MULTILINE)
+        text = section[1].split("\n[", 1)[0] if len(section) == 2 else text
+        m = _POETRY_PATH_RE.search(text)
+        return m.group(1) if m else None
+    try:
+        return tomllib.loads(text).get("virtualenvs", {}).get("path")
+    except ValueError:
+        return None
+
+
+def default_poetry_env_dirs():
+    """Returns the dir in which poetry creates the envs of the projects"""
+    config_dir, cache_dir = _poetry_dirs()
+    path = os.environ.get("POETRY_VIRTUALENVS_PATH") or \
+        _poetry_config_virtualenvs_path(config_dir) or \
+        os.path.join("{cache-dir}", "virtualenvs")
+    return [path.replace("{cache-dir}", cache_dir)]
+
+
+def get_poetry_env_data(mgr):
+    """Finds kernel specs from the envs poetry created in its cache dir"""
+    if not mgr.find_poetry_envs:
+        return
+
+    env_paths = _venvs_in_dirs(_without_virtualenv_dirs(mgr, mgr.poetry_env_dirs))
+    for item in _iter_tool_env_data(mgr, env_paths, "poetry", mgr.poetry_prefix_template):
+        yield item
+
+
+def default_pipenv_env_dirs():
+    """Returns the dir in which pipenv creates the envs of the projects"""
+    if os.environ.get("WORKON_HOME"):
+        return [os.environ["WORKON_HOME"]]
+    if ON_WINDOWS:
+        return [os.path.expanduser(os.path.join("~", ".virtualenvs"))]
+    return [os.path.join(_data_home(), "virtualenvs")]
+
+
+def get_pipenv_env_data(mgr):
+    """Finds kernel specs from the envs pipenv created for the projects"""
+    if not mgr.find_pipenv_envs:
+        return
+
+    env_paths = _venvs_in_dirs(_without_virtualenv_dirs(mgr, mgr.pipenv_env_dirs))
+    for item in _iter_tool_env_data(mgr, env_paths, "pipenv", mgr.pipenv_prefix_template):
+        yield item
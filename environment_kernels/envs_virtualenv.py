@@ -2,50 +2,292 @@
 """Functions related to finding virtualenv environments (python only)"""
 from __future__ import absolute_import
 
+import glob
+import hashlib
 import os
+import re
+import shlex
+import threading
 
 from .utils import ON_WINDOWS
-from .activate_helper import source_env_vars_from_command
-from .envs_common import find_env_paths_in_basedirs, convert_to_env_data, validate_IPykernel
+from .activate_helper import profile_source
+from .envs_common import (activate_in_shell, activate_in_shell_async, dedupe_env_paths,
+                          find_env_paths_in_basedirs, iter_env_data,
+                          iter_installed_kernel_data, iter_installed_kernel_data_async,
+                          iter_env_data_async, validate_IPykernel, validate_IPykernel_async,
+                          read_pyvenv_cfg)
+from .subprocess_helper import TimeoutExpired
+from .tracing import span
 
 
 def get_virtualenv_env_data(mgr):
     """Finds kernel specs from virtualenv environments
 
-    env_data is a structure {name -> (resourcedir, kernel spec)}
+    Yields (name, (resourcedir, kernel record)) as soon as an environment is validated.
     """
 
     if not mgr.find_virtualenv_envs:
-        return {}
+        return
 
     mgr.log.debug("Looking for virtualenv environments in %s...", mgr.virtualenv_env_dirs)
 
     # find all potential env paths
-    env_paths = find_env_paths_in_basedirs(mgr.virtualenv_env_dirs)
+    env_paths = dedupe_env_paths(mgr, find_env_paths_in_basedirs(mgr.virtualenv_env_dirs),
+                                 'virtualenv')
 
     mgr.log.debug("Scanning virtualenv environments for python kernels...")
-    env_data = convert_to_env_data(mgr=mgr,
-                                   env_paths=env_paths,
-                                   validator_func=validate_IPykernel,
-                                   activate_func=_get_env_vars_for_virtualenv_env,
-                                   name_template=mgr.virtualenv_prefix_template,
-                                   display_name_template=mgr.display_name_template,
-                                   # virtualenv has only python, so no need for a prefix
-                                   name_prefix="")
-    return env_data
+    for item in iter_env_data(mgr=mgr,
+                              env_paths=env_paths,
+                              validator_func=validate_IPykernel,
+                              activate_func=_get_env_vars_for_virtualenv_env,
+                              name_template=mgr.virtualenv_prefix_template,
+                              display_name_template=mgr.display_name_template,
+                              # virtualenv has only python, so no need for a prefix
+                              name_prefix=""):
+        yield item
+    for item in iter_installed_kernel_data(mgr=mgr,
+                                           env_paths=env_paths,
+                                           activate_func=_get_env_vars_for_virtualenv_env,
+                                           name_template=mgr.virtualenv_prefix_template,
+                                           display_name_template=mgr.display_name_template):
+        yield item
 
 
-def _get_env_vars_for_virtualenv_env(mgr, env_path):
+async def get_virtualenv_env_data_async(mgr, engine):
+    """Like `get_virtualenv_env_data`, but runs all probes on the asyncio engine"""
+    if not mgr.find_virtualenv_envs:
+        return
+
+    mgr.log.debug("Looking for virtualenv environments in %s...", mgr.virtualenv_env_dirs)
+
+    env_paths = dedupe_env_paths(mgr, find_env_paths_in_basedirs(mgr.virtualenv_env_dirs),
+                                 'virtualenv')
+
+    mgr.log.debug("Scanning virtualenv environments for python kernels...")
+    async for item in iter_env_data_async(mgr=mgr,
+                                          engine=engine,
+                                          env_paths=env_paths,
+                                          validator_func=validate_IPykernel_async,
+                                          activate_func=_get_env_vars_for_virtualenv_env,
+                                          name_template=mgr.virtualenv_prefix_template,
+                                          display_name_template=mgr.display_name_template,
+                                          name_prefix="",
+                                          async_activate_func=_get_env_vars_for_virtualenv_env_async):
+        yield item
+    async for item in iter_installed_kernel_data_async(
+            mgr=mgr,
+            env_paths=env_paths,
+            activate_func=_get_env_vars_for_virtualenv_env,
+            name_template=mgr.virtualenv_prefix_template,
+            display_name_template=mgr.display_name_template,
+            async_activate_func=_get_env_vars_for_virtualenv_env_async):
+        yield item
+
+
+get_virtualenv_env_data.async_supplier = get_virtualenv_env_data_async
+
+
+def _virtualenv_activate_args(env_path):
     if ON_WINDOWS:
-        args = [os.path.join(env_path, "Shell", "activate")]
+        return [os.path.join(env_path, "Shell", "activate")]
     else:
-        args = ['source', os.path.join(env_path, "bin", "activate")]
+        return ['source', os.path.join(env_path, "bin", "activate")]
+
+
+def _get_env_vars_for_virtualenv_env(mgr, env_path):
+    if mgr.static_activation:
+        with span("static_activation", "activation", env=env_path) as info:
+            envs = get_static_env_vars_for_virtualenv_env(env_path)
+            info["static"] = envs is not None
+        if envs is not None:
+            return envs
+        mgr.log.debug("Activate script of %s is customized, activating it in a shell.", env_path)
+    args = _virtualenv_activate_args(env_path)
     try:
-        envs = source_env_vars_from_command(args)
+        envs = activate_in_shell(mgr, env_path, args, expected_var='VIRTUAL_ENV')
         # mgr.log.debug("Environment variables: %s", envs)
         return envs
+    except TimeoutExpired:
+        mgr.log.error("Activating %s timed out after %s seconds, not activating it.",
+                      env_path, mgr.activation_timeout)
+        return {}
     except:
         # as a fallback, don't activate...
         mgr.log.exception(
             "Couldn't get environment variables for commands: %s", args)
         return {}
+
+
+async def _get_env_vars_for_virtualenv_env_async(mgr, engine, env_path):
+    if mgr.static_activation:
+        with span("static_activation", "activation", env=env_path) as info:
+            envs = get_static_env_vars_for_virtualenv_env(env_path)
+            info["static"] = envs is not None
+        if envs is not None:
+            return envs
+        mgr.log.debug("Activate script of %s is customized, activating it in a shell.", env_path)
+    args = _virtualenv_activate_args(env_path)
+    try:
+        return await activate_in_shell_async(mgr, engine, env_path, args,
+                                             expected_var='VIRTUAL_ENV')
+    except TimeoutExpired:
+        mgr.log.error("Activating %s timed out after %s seconds, not activating it.",
+                      env_path, mgr.activation_timeout)
+        return {}
+    except Exception:
+        # as a fallback, don't activate...
+        mgr.log.exception(
+            "Couldn't get environment variables for commands: %s", args)
+        return {}
+
+
+def _profile_virtualenv_activation(mgr, env_path):
+    """Profiles `_get_env_vars_for_virtualenv_env`, see `activate_helper.profile_shell`"""
+    if mgr.static_activation and get_static_env_vars_for_virtualenv_env(env_path) is not None:
+        # activated without a shell
+        return None
+    return profile_source(_virtualenv_activate_args(env_path),
+                          strategy=mgr.get_activation_strategy(env_path),
+                          timeout=mgr.activation_timeout)
+
+
+# the name of the activation in the 'launcher' activation mode
+_get_env_vars_for_virtualenv_env.launcher_kind = 'virtualenv'
+_get_env_vars_for_virtualenv_env.profile_func = _profile_virtualenv_activation
+
+
+def get_static_env_vars_for_virtualenv_env(env_path):
+    """Returns the environment of the activated virtualenv without running the activate script.
+
+    This is what the stock activate script does: set `VIRTUAL_ENV`, prepend the bin dir to
+    `PATH` and unset `PYTHONHOME`. Returns None if the env has no `pyvenv.cfg` or its activate
+    script differs from the stock template, so that the script has to be sourced in a shell.
+    """
+    env_path = os.path.abspath(env_path)
+    cfg = read_pyvenv_cfg(env_path)
+    if cfg is None:
+        return None
+    bin_name = "Scripts" if ON_WINDOWS else "bin"
+    script = os.path.join(env_path, bin_name, "activate.bat" if ON_WINDOWS else "activate")
+    if not is_stock_activate_script(script, env_path, cfg):
+        return None
+
+    env = os.environ.copy()
+    env["VIRTUAL_ENV"] = env_path
+    env["PATH"] = os.pathsep.join([os.path.join(env_path, bin_name), env.get("PATH", "")])
+    env.pop("PYTHONHOME", None)
+    return env
+
+
+# (sha256 of the activate script, env path) -> whether it is a rendered stock template
+_STOCK_ACTIVATE_HASHES = {}
+_STOCK_ACTIVATE_LOCK = threading.Lock()
+
+_PLACEHOLDER_RE = re.compile(r'(__[A-Z_]+__)')
+
+
+def is_stock_activate_script(script, env_path, cfg):
+    """Checks that the activate script is the unchanged template of venv, virtualenv or uv.
+
+    The script is compared line by line to the templates (the placeholders replaced by the
+    values of this env); the result is remembered by the hash of the script and the env path,
+    as the same script only matches the template rendered for its own env.
+    """
+    try:
+        with open(script, "rb") as f:
+            content = f.read()
+    except OSError:
+        return False
+    key = (hashlib.sha256(content).hexdigest(), env_path)
+    with _STOCK_ACTIVATE_LOCK:
+        if key in _STOCK_ACTIVATE_HASHES:
+            return _STOCK_ACTIVATE_HASHES[key]
+
+    lines = _script_lines(content.decode("utf-8", errors="replace"))
+    is_stock = False
+    for template in _find_activate_templates(cfg):
+        patterns = _template_patterns(template, env_path)
+        if len(patterns) == len(lines) and all(p.match(l) for p, l in zip(patterns, lines)):
+            is_stock = True
+            break
+    with _STOCK_ACTIVATE_LOCK:
+        _STOCK_ACTIVATE_HASHES[key] = is_stock
+    return is_stock
+
+
+def _script_lines(text):
+    lines = [line.rstrip() for line in text.splitlines()]
+    while lines and not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def _find_activate_templates(cfg):
+    """Returns the texts of the activate templates which could have created the env"""
+    if ON_WINDOWS:
+        venv_template = os.path.join("venv", "scripts", "nt", "activate.bat")
+        virtualenv_template = os.path.join("virtualenv", "activation", "batch", "activate.bat")
+    else:
+        venv_template = os.path.join("venv", "scripts", "common", "activate")
+        virtualenv_template = os.path.join("virtualenv", "activation", "bash", "activate.sh")
+
+    candidates = []
+    if "uv" in cfg:
+        # uv embeds its template in the binary: use our copy of its bash template (other
+        # versions of uv, relocatable envs and Windows fall back to sourcing the script)
+        if not ON_WINDOWS:
+            candidates.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                           "activate_templates", "uv_activate.sh"))
+    elif "virtualenv" in cfg:
+        try:
+            import virtualenv
+            candidates.append(os.path.join(os.path.dirname(os.path.dirname(virtualenv.__file__)),
+                                           virtualenv_template))
+        except ImportError:
+            pass
+    else:
+        # the stdlib of the interpreter which created the env...
+        home = cfg.get("home")
+        if home:
+            prefix = home if ON_WINDOWS else os.path.dirname(home)
+            if ON_WINDOWS:
+                candidates.append(os.path.join(prefix, "Lib", venv_template))
+            else:
+                candidates.extend(glob.glob(os.path.join(prefix, "lib", "python*", venv_template)))
+        # ... and our own one
+        import venv
+        candidates.append(os.path.join(os.path.dirname(os.path.dirname(venv.__file__)),
+                                       venv_template))
+
+    templates = []
+    for candidate in candidates:
+        try:
+            with open(candidate, encoding="utf-8") as f:
+                templates.append(f.read())
+        except OSError:
+            pass
+    return templates
+
+
+def _template_patterns(template, env_path):
+    """Returns one regex per line of the template which matches that line of a rendered script"""
+    env_dir = "|".join(re.escape(v) for v in sorted({env_path, shlex.quote(env_path)}, key=len,
+                                                     reverse=True))
+    values = {
+        "__VENV_DIR__": env_dir,
+        "__VIRTUAL_ENV__": env_dir,
+        "__VENV_BIN_NAME__": re.escape("Scripts" if ON_WINDOWS else "bin"),
+        "__BIN_NAME__": re.escape("Scripts" if ON_WINDOWS else "bin"),
+        "__PATH_SEP__": re.escape(os.pathsep),
+    }
+    patterns = []
+    for line in _script_lines(template):
+        regex = ""
+        for i, part in enumerate(_PLACEHOLDER_RE.split(line)):
+            if i % 2:
+                # prompts, names, ... only influence the shell prompt
+                regex += "(?:%s)" % values.get(part, ".*")
+            else:
+                regex += re.escape(part)
+        patterns.append(re.compile(regex + r"\Z"))
+    return patterns
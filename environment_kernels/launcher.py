@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Activates an environment and starts the kernel in it.
+
+In the 'launcher' activation mode, the argv of an environment kernel runs this module
+instead of the kernel itself, so that the activation happens in the kernel process and
+not in the notebook server::
+
+    python -m environment_kernels.launcher [--timeout T] [--no-static] [--strategy S] \
+        KIND ENV_PATH -- ARGV...
+
+KIND is the `launcher_kind` of the activation function (`conda`, `virtualenv` or `python`).
+"""
+from __future__ import absolute_import
+
+import argparse
+import logging
+import os
+import subprocess
+import sys
+
+from .activate_helper import ACTIVATION_STRATEGIES
+from .utils import ON_WINDOWS
+
+__all__ = ['launcher_argv', 'main']
+
+
+def launcher_argv(kind, env_path, argv, timeout=None, static=True, strategy=None):
+    """Returns the argv which activates the env and then runs argv"""
+    launcher = [sys.executable, "-m", "environment_kernels.launcher"]
+    if timeout:
+        launcher += ["--timeout", str(timeout)]
+    if not static:
+        launcher.append("--no-static")
+    if strategy:
+        launcher += ["--strategy", strategy]
+    return launcher + [kind, env_path, "--"] + list(argv)
+
+
+def _activators():
+    from .envs_conda import _get_env_vars_for_conda_env
+    from .envs_virtualenv import _get_env_vars_for_virtualenv_env
+    from .envs_tools import _get_env_vars_for_python_install
+    return {func.launcher_kind: func
+            for func in (_get_env_vars_for_conda_env, _get_env_vars_for_virtualenv_env,
+                         _get_env_vars_for_python_install)}
+
+
+class _Settings(object):
+    """The settings of the manager which the activation functions use"""
+
+    def __init__(self, static_activation, activation_timeout, log,
+                 activation_strategy=ACTIVATION_STRATEGIES[0]):
+        self.static_activation = static_activation
+        self.activation_timeout = activation_timeout
+        self.activation_strategy = activation_strategy
+        self.log = log
+
+    def get_activation_strategy(self, env_path):
+        return self.activation_strategy
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m environment_kernels.launcher",
+                                     description="Activates an environment and starts the "
+                                                 "kernel in it.")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="seconds after which the activation is aborted")
+    parser.add_argument("--no-static", dest="static", action="store_false",
+                        help="always activate the env in a shell")
+    parser.add_argument("--strategy", choices=ACTIVATION_STRATEGIES,
+                        default=ACTIVATION_STRATEGIES[0],
+                        help="how the shell which activates the env is started")
+    parser.add_argument("kind", choices=sorted(_activators()))
+    parser.add_argument("env_path")
+    parser.add_argument("argv", nargs=argparse.REMAINDER)
+    ns = parser.parse_args(args)
+    argv = ns.argv[1:] if ns.argv[:1] == ["--"] else ns.argv
+    if not argv:
+        parser.error("no kernel command given")
+
+    logging.basicConfig(format="[environment_kernels.launcher] %(levelname)s | %(message)s")
+    log = logging.getLogger("environment_kernels.launcher")
+    settings = _Settings(ns.static, ns.timeout, log, ns.strategy)
+    env = dict(os.environ)
+    # a failed activation is logged and returns {}: start the kernel without activation
+    env.update(_activators()[ns.kind](settings, ns.env_path))
+
+    if ON_WINDOWS:
+        # no real exec on windows: the kernel manager would lose track of the kernel
+        sys.exit(subprocess.call(argv, env=env))
+    os.execve(argv[0], argv, env)
+
+
+if __name__ == "__main__":
+    main()
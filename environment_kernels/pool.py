@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""A kernel manager which keeps started kernels of the most used environment kernels ready"""
+from __future__ import absolute_import
+
+import asyncio
+import json
+import os
+import queue
+import time
+
+from jupyter_client.multikernelmanager import AsyncMultiKernelManager
+from jupyter_client.utils import ensure_async
+from traitlets import Int, List, Unicode
+from traitlets.config import LoggingConfigurable
+from traitlets.utils.importstring import import_item
+
+from .subprocess_helper import background_work, process_rss
+from .usage import launch_recording
+
+__all__ = ['KernelPoolMixin', 'EnvironmentKernelPoolManager']
+
+# code to change the working directory of an idle kernel, by language
+_CHDIR_CODE = {
+    "python": "import os as _os; _os.chdir(%s); del _os",
+    "r": "setwd(%s)",
+}
+
+
+def _kernel_pid(km):
+    pid = getattr(getattr(km, "provisioner", None), "pid", None)
+    if pid is None:
+        pid = getattr(getattr(km, "kernel", None), "pid", None)
+    return pid
+
+
+class _PooledKernelManagerMixin(object):
+    """Lets an already started kernel manager be "started" again by the multi kernel manager"""
+
+    _pool_warm = False
+    _pool_cwd = None
+    _pool_language = None
+
+    def start_kernel(self, **kw):
+        if not self._pool_warm:
+            return super(_PooledKernelManagerMixin, self).start_kernel(**kw)
+        self._pool_warm = False
+        return self._adopt(kw.get("cwd"))
+
+    async def _adopt(self, cwd):
+        """Moves the idle kernel to the working directory it was requested for"""
+        if not cwd or cwd == self._pool_cwd:
+            return
+        if isinstance(self._launch_args, dict):
+            # a restart should start in the new dir
+            self._launch_args["cwd"] = cwd
+        client = self.client()
+        client.start_channels()
+        try:
+            msg_id = client.execute(_CHDIR_CODE[self._pool_language] % json.dumps(cwd),
+                                    silent=True, store_history=False)
+            deadline = time.time() + 10
+            while True:
+                try:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        raise queue.Empty()
+                    reply = await ensure_async(client.get_shell_msg(timeout=timeout))
+                except queue.Empty:
+                    # the kernel works, it just might not be in that directory
+                    self.log.warning("Pooled kernel %s didn't confirm the change of its "
+                                     "directory to %s in time.", self.kernel_id, cwd)
+                    break
+                if reply["parent_header"].get("msg_id") == msg_id:
+                    if reply["content"].get("status") != "ok":
+                        self.log.warning("Couldn't change the directory of pooled kernel %s "
+                                         "to %s.", self.kernel_id, cwd)
+                    break
+        finally:
+            client.stop_channels()
+
+
+class KernelPoolMixin(LoggingConfigurable):
+    """Keeps `pool_size` idle, already started kernels for each of the `pool_kernels` most
+    launched environment kernels (and the kernels in `pool_kernel_names`).
+
+    A request for such a kernel gets one of the idle kernels, which is then replaced in the
+    background. Mix it into an asyncio multi kernel manager, e.g. the
+    `AsyncMappingKernelManager` of jupyter_server.
+    """
+
+    pool_size = Int(
+        1,
+        config=True,
+        help="Number of idle kernels kept for each pooled kernel. Setting it to '0' disables "
+             "the pool.")
+
+    pool_kernels = Int(
+        3,
+        config=True,
+        help="Number of the most launched environment kernels which are pooled.")
+
+    pool_kernel_names = List(
+        [],
+        config=True,
+        help="Kernels which are always pooled (in addition to the most launched ones).")
+
+    pool_max_memory = Int(
+        2048,
+        config=True,
+        help="Maximum memory (in MB) all idle pooled kernels may use together. Setting it to "
+             "'0' disables the limit.")
+
+    pool_cwd = Unicode(
+        None,
+        allow_none=True,
+        config=True,
+        help="Working directory of the idle kernels. A kernel requested for a different "
+             "directory changes its directory when it is handed out (Python and R kernels "
+             "only, other kernels are then started normally). Defaults to the current "
+             "directory.")
+
+    def __init__(self, **kwargs):
+        super(KernelPoolMixin, self).__init__(**kwargs)
+        # kernel name -> list of idle kernel managers
+        self._pool = {}
+        self._pool_filling = None
+        self._pooled_classes = {}
+        self.pool_hits = 0
+        self.pool_misses = 0
+        # the loop of the server: the pool is refilled from supplier and scan threads, which
+        # have no (running) loop of their own
+        self._pool_loop = None
+        if self.pool_size > 0:
+            try:
+                from tornado.ioloop import IOLoop
+                self._pool_loop = IOLoop.current()
+            except Exception:
+                self.log.exception("Couldn't get the event loop to fill the kernel pool.")
+                return
+            subscribe = getattr(self.kernel_spec_manager, "subscribe", None)
+            if subscribe is not None:
+                # the most launched kernels might be found only now
+                subscribe(lambda change: self._schedule_pool_fill())
+            self._schedule_pool_fill()
+
+    def _schedule_pool_fill(self):
+        if self._pool_loop is None:
+            return
+        try:
+            # add_callback is the only thread-safe method of the loop
+            self._pool_loop.add_callback(self.fill_pool)
+        except Exception:
+            self.log.exception("Couldn't schedule filling the kernel pool.")
+
+    def _pool_targets(self):
+        """Returns the names of the kernels which should be pooled, most launched first"""
+        names = []
+        ksm = self.kernel_spec_manager
+        registry = getattr(ksm, "env_registry", None)
+        usage = getattr(ksm, "kernel_usage", None)
+        if registry is not None and usage is not None and self.pool_kernels > 0:
+            # only already found kernels: filling the pool must not trigger a scan
+            names.extend(usage.hottest(registry.get_env_data(), self.pool_kernels))
+        for name in self.pool_kernel_names:
+            if name not in names:
+                names.append(name)
+        return names
+
+    def pool_memory(self):
+        """Returns the memory (in bytes) used by all idle pooled kernels"""
+        return sum(process_rss(_kernel_pid(km)) for kms in self._pool.values() for km in kms
+                   if _kernel_pid(km) is not None)
+
+    def _pool_memory_exceeded(self):
+        return self.pool_max_memory > 0 and self.pool_memory() >= self.pool_max_memory * 2 ** 20
+
+    async def fill_pool(self):
+        """Starts idle kernels until the pool is full (or its memory limit is reached)"""
+        if self.pool_size <= 0:
+            return
+        if self._pool_filling is not None and not self._pool_filling.done():
+            return await self._pool_filling
+        self._pool_filling = asyncio.ensure_future(self._fill_pool())
+        return await self._pool_filling
+
+    async def _fill_pool(self):
+        # these kernels are not launched by anyone yet
+        launch_recording.set(False)
+        # nobody waits for them either
+        background_work.set(True)
+        targets = self._pool_targets()
+        for name in list(self._pool):
+            if name not in targets:
+                for km in self._pool.pop(name):
+                    self.log.debug("Kernel %s is not pooled anymore.", name)
+                    await self._shutdown_pooled(km)
+
+        for name in targets:
+            kms = self._pool.setdefault(name, [])
+            while len(kms) < self.pool_size:
+                if self._pool_memory_exceeded():
+                    self.log.info("Kernel pool uses more than %s MB, not starting more kernels.",
+                                  self.pool_max_memory)
+                    return
+                try:
+                    km = await self._start_pooled(name)
+                except Exception:
+                    self.log.exception("Couldn't start a pooled kernel for %s.", name)
+                    break
+                kms.append(km)
+                self.log.debug("Started pooled kernel %s for %s.", km.kernel_id, name)
+
+    def _pooled_kernel_manager_class(self):
+        cls = import_item(self.kernel_manager_class)
+        pooled = self._pooled_classes.get(cls)
+        if pooled is None:
+            pooled = type("Pooled" + cls.__name__, (_PooledKernelManagerMixin, cls), {})
+            self._pooled_classes[cls] = pooled
+        return pooled
+
+    async def _activate_pooled(self, kernel_name):
+        """Activates the environment of the kernel without blocking the loop.
+
+        Otherwise the kernel provisioner would activate it synchronously when it reads the
+        env of the kernelspec.
+        """
+        async_activate = getattr(self.kernel_spec_manager, "async_activate", None)
+        if async_activate is not None:
+            await async_activate(kernel_name)
+
+    async def _start_pooled(self, kernel_name):
+        await self._activate_pooled(kernel_name)
+        kernel_id = self.new_kernel_id()
+        constructor_kwargs = {}
+        if self.kernel_spec_manager:
+            constructor_kwargs["kernel_spec_manager"] = self.kernel_spec_manager
+        km = self._pooled_kernel_manager_class()(
+            connection_file=os.path.join(self.connection_dir, "kernel-%s.json" % kernel_id),
+            parent=self,
+            log=self.log,
+            kernel_name=kernel_name,
+            kernel_id=kernel_id,
+            **constructor_kwargs)
+        cwd = self.pool_cwd or os.getcwd()
+        await ensure_async(km.start_kernel(kernel_id=kernel_id, cwd=cwd))
+        km._pool_cwd = cwd
+        km._pool_language = (km.kernel_spec.language or "").lower()
+        km._pool_warm = True
+        return km
+
+    async def _shutdown_pooled(self, km):
+        try:
+            await ensure_async(km.shutdown_kernel(now=True))
+        except Exception:
+            self.log.exception("Couldn't shut down pooled kernel %s.", km.kernel_id)
+
+    def _take_pooled(self, kernel_name, kwargs):
+        """Returns an idle kernel for that request or None"""
+        if "kernel_id" in kwargs or kernel_name not in self._pool:
+            return None
+        cwd = kwargs.get("cwd")
+        kms = self._pool[kernel_name]
+        while kms:
+            km = kms.pop(0)
+            if not km.has_kernel:
+                continue
+            if cwd and cwd != km._pool_cwd and km._pool_language not in _CHDIR_CODE:
+                # can't move it, keep it for a request for the pool dir
+                kms.insert(0, km)
+                return None
+            return km
+        return None
+
+    def pre_start_kernel(self, kernel_name, kwargs):
+        if kernel_name is None:
+            kernel_name = self.default_kernel_name
+        km = self._take_pooled(kernel_name, kwargs) if self.pool_size > 0 else None
+        if km is None:
+            if kernel_name in self._pool:
+                self.pool_misses += 1
+            return super(KernelPoolMixin, self).pre_start_kernel(kernel_name, kwargs)
+        self.pool_hits += 1
+        self.log.info("Using pooled kernel %s for %s.", km.kernel_id, kernel_name)
+        record_launch = getattr(self.kernel_spec_manager, "record_launch", None)
+        if record_launch is not None:
+            record_launch(kernel_name)
+        self._schedule_pool_fill()
+        return km, kernel_name, km.kernel_id
+
+    async def shutdown_pool(self):
+        """Shuts down all idle pooled kernels"""
+        pool, self._pool = self._pool, {}
+        await asyncio.gather(*[self._shutdown_pooled(km) for kms in pool.values() for km in kms])
+
+    async def shutdown_all(self, now=False):
+        await self.shutdown_pool()
+        await ensure_async(super(KernelPoolMixin, self).shutdown_all(now=now))
+
+    def get_pool_state(self):
+        """Returns a dict with the idle kernels per kernel name, their memory and the hits"""
+        return {"kernels": {name: [km.kernel_id for km in kms] for name, kms in self._pool.items()},
+                "memory": self.pool_memory(),
+                "hits": self.pool_hits,
+                "misses": self.pool_misses}
+
+
+class EnvironmentKernelPoolManager(KernelPoolMixin, AsyncMultiKernelManager):
+    """An `AsyncMultiKernelManager` with a pool of idle kernels"""
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Cache of the results of probing interpreters, shared by all suppliers"""
+from __future__ import absolute_import
+
+import asyncio
+import glob
+import os
+import threading
+
+__all__ = ['ProbeCache', 'interpreter_state_key']
+
+
+def interpreter_state_key(kind, exe, lib_dirs):
+    """Returns a key which changes whenever the interpreter or its libraries change.
+
+    The key consists of the real path, inode and mtime of the interpreter and of the
+    library dirs (e.g. site-packages: installing or removing a package changes its mtime).
+    Envs which resolve to the same interpreter and libraries (symlinks) get the same key.
+    Returns None if there are no library dirs or they can't be stat'ed.
+    """
+    lib_dirs = [lib_dir for pattern in lib_dirs for lib_dir in sorted(glob.glob(pattern))]
+    if not lib_dirs:
+        return None
+    key = [kind]
+    try:
+        for path in [exe] + lib_dirs:
+            path = os.path.realpath(path)
+            st = os.stat(path)
+            key.append((path, st.st_dev, st.st_ino, st.st_mtime_ns))
+    except OSError:
+        return None
+    return tuple(key)
+
+
+class ProbeCache(object):
+    """Remembers probe results by interpreter state (see `interpreter_state_key`).
+
+    Concurrent probes of the same key are run only once, the others wait for the result.
+    Timeouts and other errors are not cached. At most `max_entries` results are kept.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._key_locks = {}
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key):
+        # needs self._lock
+        if key in self._entries:
+            self.hits += 1
+            return True, self._entries[key]
+        return False, None
+
+    def _store(self, key, result):
+        # needs self._lock
+        self.misses += 1
+        self._entries[key] = result
+        while len(self._entries) > self.max_entries:
+            # dicts are ordered: drop the oldest result
+            del self._entries[next(iter(self._entries))]
+
+    def get_or_probe(self, key, probe):
+        """Returns the cached result for key or calls probe() and caches its result"""
+        if key is None or self.max_entries <= 0:
+            return probe()
+        with self._lock:
+            found, result = self._lookup(key)
+            if found:
+                return result
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                found, result = self._lookup(key)
+                if found:
+                    return result
+            try:
+                result = probe()
+                with self._lock:
+                    self._store(key, result)
+                return result
+            finally:
+                with self._lock:
+                    self._key_locks.pop(key, None)
+
+    async def get_or_probe_async(self, key, probe):
+        """Like `get_or_probe`, but probe is a coroutine function"""
+        if key is None or self.max_entries <= 0:
+            return await probe()
+        with self._lock:
+            found, result = self._lookup(key)
+            if found:
+                return result
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                future = asyncio.get_event_loop().create_future()
+                self._pending[key] = future
+        if not owner:
+            try:
+                result = await asyncio.shield(future)
+                with self._lock:
+                    self.hits += 1
+                return result
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # the probe we waited for was cancelled, not we
+                return await probe()
+        try:
+            result = await probe()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # only the waiters (if any) are interested in the error
+            future.exception()
+            raise
+        else:
+            with self._lock:
+                self._store(key, result)
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_state(self):
+        """Returns a dict with the number of cached results, hits and misses"""
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""Registry of the environment kernels found by the scans"""
+from __future__ import absolute_import
+
+import collections
+import os
+import threading
+
+__all__ = ['KernelRegistry', 'KernelRegistryChange']
+
+KernelRegistryChange = collections.namedtuple('KernelRegistryChange',
+                                              ['generation', 'added', 'removed', 'changed'])
+KernelRegistryChange.__doc__ = """A change of the registry: lists of the added, removed and
+changed kernel names and the generation of the registry after the change."""
+
+
+def _normpath(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+class KernelRegistry(object):
+    """The environment kernels, indexed by kernel name, env path and interpreter.
+
+    Kernel names are case-insensitive. Every update which changes the kernels increases
+    the `generation` and is sent to the subscribers as a `KernelRegistryChange`.
+    """
+
+    def __init__(self, log=None):
+        self.log = log
+        self._lock = threading.RLock()
+        # lower case name -> (resource_dir, kernel record or kernel spec)
+        self._env_data = {}
+        self._by_env = {}
+        self._by_interpreter = {}
+        self._subscribers = []
+        self.generation = 0
+        # False until the first update, even if that found nothing
+        self.populated = False
+
+    def __len__(self):
+        return len(self._env_data)
+
+    def __contains__(self, name):
+        return name.lower() in self._env_data
+
+    def get(self, name, default=None):
+        """Returns (resource_dir, kernel spec) of the kernel with that name"""
+        return self._env_data.get(name.lower(), default)
+
+    def get_env_data(self):
+        """Returns a dict name -> (resource_dir, kernel spec) of all kernels"""
+        with self._lock:
+            return dict(self._env_data)
+
+    def snapshot(self):
+        """Returns (generation, dict name -> (resource_dir, kernel spec)), taken together"""
+        with self._lock:
+            return self.generation, dict(self._env_data)
+
+    def find_by_env(self, env_path):
+        """Returns the names of the kernels of the environment"""
+        with self._lock:
+            return sorted(self._by_env.get(_normpath(env_path), ()))
+
+    def find_by_interpreter(self, exe):
+        """Returns the names of the kernels started by that interpreter"""
+        with self._lock:
+            return sorted(self._by_interpreter.get(_normpath(exe), ()))
+
+    def subscribe(self, callback):
+        """Calls callback(change) after every update which changed the kernels.
+
+        Returns a function to unsubscribe again.
+        """
+        with self._lock:
+            self._subscribers.append(callback)
+
+        def unsubscribe():
+            with self._lock:
+                if callback in self._subscribers:
+                    self._subscribers.remove(callback)
+        return unsubscribe
+
+    def add(self, name, value):
+        """Adds or replaces a single kernel while a scan is still running.
+
+        Returns the `KernelRegistryChange` or None if the kernel is already known unchanged.
+        """
+        name = name.lower()
+        with self._lock:
+            old = self._env_data.get(name)
+            if old is not None and _fingerprint(old) == _fingerprint(value):
+                return None
+            # copy on write: readers might iterate over the current dict
+            env_data = dict(self._env_data)
+            env_data[name] = value
+            if old is not None:
+                _remove_from_indexes(self._by_env, self._by_interpreter, name, old)
+            _add_to_indexes(self._by_env, self._by_interpreter, name, value)
+            self._env_data = env_data
+            self.generation += 1
+            if old is None:
+                change = KernelRegistryChange(self.generation, [name], [], [])
+            else:
+                change = KernelRegistryChange(self.generation, [], [], [name])
+            subscribers = list(self._subscribers)
+        self._notify(subscribers, change)
+        return change
+
+    def update(self, env_data):
+        """Replaces all kernels with the ones in env_data (name -> (resource_dir, kernel spec)).
+
+        Unchanged kernels keep their current kernel record or spec.
+
+        Returns the `KernelRegistryChange`.
+        """
+        env_data = {name.lower(): value for name, value in env_data.items()}
+        with self._lock:
+            old = self._env_data
+            added = sorted(name for name in env_data if name not in old)
+            removed = sorted(name for name in old if name not in env_data)
+            changed = sorted(name for name in env_data
+                             if name in old and _fingerprint(old[name]) != _fingerprint(env_data[name]))
+            # keep the old specs of unchanged kernels, they might already be activated
+            for name in env_data:
+                if name in old and name not in changed:
+                    env_data[name] = old[name]
+            self.populated = True
+            if added or removed or changed:
+                self.generation += 1
+            self._env_data = env_data
+            self._by_env, self._by_interpreter = _build_indexes(env_data)
+            change = KernelRegistryChange(self.generation, added, removed, changed)
+            subscribers = list(self._subscribers)
+
+        if added or removed or changed:
+            self._notify(subscribers, change)
+        return change
+
+    def _notify(self, subscribers, change):
+        for callback in subscribers:
+            try:
+                callback(change)
+            except Exception:
+                if self.log is not None:
+                    self.log.exception("Error in a subscriber of the kernel registry.")
+
+
+def _fingerprint(value):
+    resource_dir, kspec = value
+    return (resource_dir, list(kspec.argv), kspec.language, kspec.display_name,
+            repr(sorted(kspec.metadata.items())), getattr(kspec, 'env_path', None))
+
+
+def _index_keys(value):
+    kspec = value[1]
+    env_path = getattr(kspec, 'env_path', None)
+    return (_normpath(env_path) if env_path else None,
+            _normpath(kspec.argv[0]) if kspec.argv else None)
+
+
+def _add_to_indexes(by_env, by_interpreter, name, value):
+    env_key, interpreter_key = _index_keys(value)
+    if env_key:
+        by_env.setdefault(env_key, set()).add(name)
+    if interpreter_key:
+        by_interpreter.setdefault(interpreter_key, set()).add(name)
+
+
+def _remove_from_indexes(by_env, by_interpreter, name, value):
+    for index, key in zip((by_env, by_interpreter), _index_keys(value)):
+        names = index.get(key)
+        if names is not None:
+            names.discard(name)
+            if not names:
+                del index[key]
+
+
+def _build_indexes(env_data):
+    by_env = {}
+    by_interpreter = {}
+    for name, value in env_data.items():
+        _add_to_indexes(by_env, by_interpreter, name, value)
+    return by_env, by_interpreter
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Adaptive scheduling of the periodic scans for environment kernels"""
+from __future__ import absolute_import
+
+import contextlib
+import contextvars
+import threading
+import time
+
+__all__ = ['AdaptiveScheduler', 'ScanCPU', 'scan_cpu', 'measure_thread_cpu']
+
+# The `ScanCPU` the CPU time of the scan of this context is added to (None: not measured)
+scan_cpu = contextvars.ContextVar('scan_cpu', default=None)
+
+# whether the CPU time of this thread is already measured by an outer block
+_measuring = threading.local()
+
+
+class ScanCPU(object):
+    """The CPU time (in seconds) used by a scan.
+
+    Only the scan is counted: the threads working for it (see `measure_thread_cpu`) and its
+    reaped subprocesses (see `subprocess_helper.count_cpu`), not the rest of the server or
+    kernels exiting in the meantime.
+    """
+
+    def __init__(self):
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.seconds += seconds
+
+
+@contextlib.contextmanager
+def measure_thread_cpu():
+    """Adds the CPU time this thread spends in the block to the `scan_cpu` of the context"""
+    meter = scan_cpu.get()
+    if meter is None or getattr(_measuring, "active", False):
+        yield
+        return
+    _measuring.active = True
+    start = time.thread_time()
+    try:
+        yield
+    finally:
+        meter.add(time.thread_time() - start)
+        _measuring.active = False
+
+
+class AdaptiveScheduler(object):
+    """Decides how long to wait until the next scan.
+
+    Starts at `interval` seconds. After every scan without changes the interval is
+    multiplied by `backoff` (up to `max_interval`); a scan which found changes resets it
+    to `interval`. Independent of that, the interval is never so short that scanning
+    uses more than `max_cpu_fraction` of the CPU time (scan CPU time / (interval + scan
+    duration)), unless that would exceed `max_interval`.
+    """
+
+    def __init__(self, interval, max_interval, backoff=2.0, max_cpu_fraction=0.05):
+        self.min_interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.backoff = max(1.0, backoff)
+        self.max_cpu_fraction = max_cpu_fraction
+        self.interval = interval
+        self.reason = "initial interval"
+        self.unchanged_scans = 0
+        self.last_scan_duration = None
+        self.last_scan_cpu = None
+        self.last_scan = None
+
+    def record_scan(self, duration, cpu, changed):
+        """Records the cost and result of a scan and returns the interval until the next one"""
+        self.last_scan = time.time()
+        self.last_scan_duration = duration
+        self.last_scan_cpu = cpu
+        if changed:
+            self.unchanged_scans = 0
+            interval = self.min_interval
+            reason = "the last scan found changes"
+        else:
+            self.unchanged_scans += 1
+            interval = min(self.interval * self.backoff, self.max_interval)
+            reason = "no changes in the last %d scan(s)" % self.unchanged_scans
+            if interval == self.max_interval:
+                reason += ", at the maximum interval"
+
+        if self.max_cpu_fraction > 0:
+            # cpu / (interval + duration) <= max_cpu_fraction, but never beyond max_interval
+            min_interval = min(cpu / self.max_cpu_fraction - duration, self.max_interval)
+            if min_interval > interval:
+                interval = min_interval
+                reason = ("a scan costs %.1f CPU seconds, which must not exceed %d%% of the "
+                          "CPU time" % (cpu, self.max_cpu_fraction * 100))
+        self.interval = interval
+        self.reason = reason
+        return interval
+
+    def get_state(self):
+        """Returns a dict with the current interval (in seconds) and the reason for it"""
+        return {
+            "interval": self.interval,
+            "reason": self.reason,
+            "unchanged_scans": self.unchanged_scans,
+            "last_scan": self.last_scan,
+            "last_scan_duration": self.last_scan_duration,
+            "last_scan_cpu": self.last_scan_cpu,
+        }
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""Helpers to run the probe and activation subprocesses without hanging forever"""
+from __future__ import absolute_import
+
+import contextvars
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from .scheduler import scan_cpu
+from .tracing import span
+from .utils import ON_WINDOWS
+
+TimeoutExpired = subprocess.TimeoutExpired
+
+# Set to True in contexts which scan or prepare kernels nobody is waiting for (periodic
+# refreshes, prewarming, kernel pools): their subprocesses are deprioritized
+background_work = contextvars.ContextVar('background_work', default=False)
+
+# seconds between two checks of the memory of a subprocess
+MEMORY_CHECK_INTERVAL = 0.1
+
+
+class MemoryLimitExceeded(subprocess.SubprocessError):
+    """Raised when a subprocess was killed because it used more memory than allowed"""
+
+    def __init__(self, cmd, limit, rss):
+        self.cmd = cmd
+        self.limit = limit
+        self.rss = rss
+
+    def __str__(self):
+        return "Command '%s' was killed after using %d MB (limit: %d MB)" % (
+            self.cmd, self.rss // 2 ** 20, self.limit // 2 ** 20)
+
+
+class ResourceGovernor(object):
+    """Limits the probe and activation subprocesses.
+
+    At most `max_subprocesses` of them run at the same time in threads (0: no limit; the
+    asyncio engine has its own limit); subprocesses of interactive work (e.g. the
+    activation for a kernel start) are started before waiting ones of background work. Subprocesses of background work run with their
+    niceness increased by `background_nice` and in the `background_ionice` I/O scheduling
+    class ('idle', 'best-effort' at the lowest priority, or None; needs psutil). A
+    subprocess whose process tree uses more than `max_memory` bytes is killed (0: no limit).
+    """
+
+    def __init__(self, max_subprocesses=0, background_nice=0, background_ionice=None,
+                 max_memory=0):
+        self.max_subprocesses = max_subprocesses
+        self.background_nice = background_nice
+        self.background_ionice = background_ionice
+        self.max_memory = max_memory
+        self._condition = threading.Condition()
+        self._running = 0
+        self._waiting_interactive = 0
+        self._waiting_background = 0
+        self.memory_kills = 0
+
+    def _may_start(self, interactive):
+        if self.max_subprocesses <= 0:
+            return True
+        if self._running >= self.max_subprocesses:
+            return False
+        return interactive or not self._waiting_interactive
+
+    def acquire(self, interactive):
+        """Waits until a subprocess may be started"""
+        with self._condition:
+            if interactive:
+                self._waiting_interactive += 1
+            else:
+                self._waiting_background += 1
+            try:
+                while not self._may_start(interactive):
+                    self._condition.wait()
+            finally:
+                if interactive:
+                    self._waiting_interactive -= 1
+                else:
+                    self._waiting_background -= 1
+            self._running += 1
+
+    def release(self):
+        with self._condition:
+            self._running -= 1
+            self._condition.notify_all()
+
+    def started(self, pid, interactive):
+        """Deprioritizes the just started subprocess of background work"""
+        if interactive or ON_WINDOWS:
+            return
+        if self.background_nice > 0:
+            try:
+                niceness = os.getpriority(os.PRIO_PROCESS, pid) + self.background_nice
+                os.setpriority(os.PRIO_PROCESS, pid, min(19, niceness))
+            except OSError:
+                # already gone
+                pass
+        if self.background_ionice:
+            try:
+                import psutil
+                if self.background_ionice == 'idle':
+                    psutil.Process(pid).ionice(psutil.IOPRIO_CLASS_IDLE)
+                else:
+                    psutil.Process(pid).ionice(psutil.IOPRIO_CLASS_BE, 7)
+            except Exception:
+                # no psutil, no linux or already gone
+                pass
+
+    def memory_exceeded(self, pid):
+        """Returns the memory of the process tree if it exceeds `max_memory`, else 0"""
+        if self.max_memory <= 0:
+            return 0
+        rss = process_tree_rss(pid)
+        if rss <= self.max_memory:
+            return 0
+        with self._condition:
+            self.memory_kills += 1
+        return rss
+
+    def get_state(self):
+        """Returns a dict with the running and waiting subprocesses and the memory kills"""
+        with self._condition:
+            return {"running": self._running,
+                    "waiting_interactive": self._waiting_interactive,
+                    "waiting_background": self._waiting_background,
+                    "memory_kills": self.memory_kills}
+
+
+# the governor of all subprocesses started by `run` and the asyncio engine
+governor = ResourceGovernor()
+
+
+class RusagePopen(subprocess.Popen):
+    """A `subprocess.Popen` which keeps the resource usage of the process (`rusage`, including
+    the children it waited for) when it is reaped. Only on POSIX, else `rusage` stays None."""
+
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        # like Popen._try_wait, but with wait4 instead of waitpid
+        if not hasattr(os, "wait4"):
+            return super(RusagePopen, self)._try_wait(wait_flags)
+        try:
+            pid, sts, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return self.pid, 0
+        if pid == self.pid:
+            self.rusage = rusage
+        return pid, sts
+
+
+def count_cpu(p):
+    """Adds the CPU time of the reaped process to the `scan_cpu` of the context"""
+    meter = scan_cpu.get()
+    rusage = getattr(p, "rusage", None)
+    if meter is not None and rusage is not None:
+        meter.add(rusage.ru_utime + rusage.ru_stime)
+
+
+def kill_process_group(p):
+    """Kills the process and everything it started (e.g. the interpreter started by bash)"""
+    if ON_WINDOWS:
+        p.kill()
+        return
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        # already gone or not a group leader
+        p.kill()
+
+
+def run(args, timeout=None, check=False, input=None, **kwargs):
+    """Like `subprocess.run`, but kills the whole process group on a timeout.
+
+    The process is started in a new session, so that children which inherited the
+    pipes (e.g. the interpreter started by an activate script) are killed as well and
+    cannot keep us waiting for the output.
+
+    Raises `subprocess.TimeoutExpired` if the process did not finish within timeout
+    seconds (`None` or 0 means no timeout) and `MemoryLimitExceeded` if it used more
+    memory than the `governor` allows.
+    """
+    if not ON_WINDOWS:
+        kwargs.setdefault('start_new_session', True)
+    if input is not None:
+        kwargs['stdin'] = subprocess.PIPE
+    interactive = not background_work.get()
+    with span("subprocess", "subprocess", argv=args, background=not interactive) as info:
+        queued = time.time()
+        governor.acquire(interactive)
+        try:
+            info["queued"] = time.time() - queued
+            p = RusagePopen(args, **kwargs)
+            governor.started(p.pid, interactive)
+            try:
+                stdout, stderr = _communicate(p, args, input, timeout)
+            except subprocess.TimeoutExpired:
+                kill_process_group(p)
+                p.communicate()
+                raise
+            except:
+                kill_process_group(p)
+                raise
+            finally:
+                count_cpu(p)
+        finally:
+            governor.release()
+        info["returncode"] = p.returncode
+        info["output_bytes"] = output_size(stdout, stderr)
+    if check and p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, args, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(args, p.returncode, stdout, stderr)
+
+
+def output_size(*outputs):
+    """Returns the number of bytes (or characters) of the captured outputs"""
+    return sum(len(output) for output in outputs if output is not None)
+
+
+def _communicate(p, args, input, timeout):
+    """`p.communicate`, checking the memory of the process in between"""
+    if governor.max_memory <= 0:
+        return p.communicate(input, timeout=timeout or None)
+    deadline = time.time() + timeout if timeout else None
+    while True:
+        wait = MEMORY_CHECK_INTERVAL
+        if deadline is not None:
+            wait = max(0, min(wait, deadline - time.time()))
+        try:
+            # input is only sent by the first call
+            return p.communicate(input, timeout=wait)
+        except subprocess.TimeoutExpired:
+            if deadline is not None and time.time() >= deadline:
+                raise subprocess.TimeoutExpired(args, timeout)
+        rss = governor.memory_exceeded(p.pid)
+        if rss:
+            raise MemoryLimitExceeded(args, governor.max_memory, rss)
+
+
+def check_call(args, timeout=None, **kwargs):
+    """Like `subprocess.check_call`, but kills the whole process group on a timeout"""
+    run(args, timeout=timeout, check=True, **kwargs)
+    return 0
+
+
+def check_output(args, timeout=None, **kwargs):
+    """Like `subprocess.check_output`, but kills the whole process group on a timeout"""
+    kwargs['stdout'] = subprocess.PIPE
+    return run(args, timeout=timeout, check=True, **kwargs).stdout
+
+
+def process_rss(pid):
+    """Returns the resident memory (in bytes) of the process or 0 if it is unknown"""
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except Exception:
+            return 0
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return 0
+
+
+def process_tree_rss(pid):
+    """Returns the resident memory (in bytes) of the process and all its descendants.
+
+    Without psutil, only the memory of the process itself is known.
+    """
+    try:
+        import psutil
+    except ImportError:
+        return process_rss(pid)
+    try:
+        process = psutil.Process(pid)
+        processes = [process] + process.children(recursive=True)
+    except Exception:
+        return 0
+    rss = 0
+    for process in processes:
+        try:
+            rss += process.memory_info().rss
+        except Exception:
+            # gone in between
+            pass
+    return rss
+
+
+class Quarantine(object):
+    """Keeps track of envs whose probes timed out.
+
+    After `threshold` consecutive timeouts an env is quarantined: it is skipped for
+    `backoff` seconds, doubling with every further timeout up to `max_backoff`. A
+    successful probe releases the env again.
+    """
+
+    def __init__(self, threshold=2, backoff=300, max_backoff=6 * 3600, log=None):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.log = log
+        self._lock = threading.Lock()
+        # key -> [consecutive timeouts, quarantined until]
+        self._entries = {}
+
+    def is_quarantined(self, key, now=None):
+        """Returns True if the env should currently be skipped"""
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[1] > now
+
+    def record_timeout(self, key, now=None):
+        """Records a timeout and quarantines the env if it timed out too often"""
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.setdefault(key, [0, 0])
+            entry[0] += 1
+            if entry[0] < self.threshold:
+                return
+            duration = min(self.backoff * 2 ** (entry[0] - self.threshold), self.max_backoff)
+            entry[1] = now + duration
+            failures = entry[0]
+        if self.log is not None:
+            self.log.warning("Quarantining %s for %d seconds after %d consecutive timeouts.",
+                             key, duration, failures)
+
+    def record_success(self, key):
+        """Forgets all timeouts of the env"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None and entry[0] >= self.threshold and self.log is not None:
+            self.log.info("Released %s from quarantine.", key)
+
+    def get_state(self, now=None):
+        """Returns a dict key -> {'timeouts': n, 'quarantined_for': seconds}"""
+        now = time.time() if now is None else now
+        with self._lock:
+            return {key: {"timeouts": timeouts, "quarantined_for": max(0, until - now)}
+                    for key, (timeouts, until) in self._entries.items()}
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Structured traces of the scans and activations for offline analysis.
+
+While a `Trace` is the `current_trace` of a context, the suppliers, probes, subprocesses and
+activations record their spans in it. The spans are written as JSON lines or in the Chrome
+trace-event format (which chrome://tracing, Perfetto or speedscope load)::
+
+    {"trace": "...", "name": "subprocess", "category": "subprocess", "start": 1700000000.1,
+     "duration": 0.25, "track": 140000, "args": {"argv": [...], "returncode": 0, ...}}
+"""
+from __future__ import absolute_import
+
+import asyncio
+import contextlib
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+
+__all__ = ['Trace', 'current_trace', 'span', 'traced_span', 'write_trace', 'TRACE_FORMATS']
+
+TRACE_FORMATS = ['jsonl', 'chrome']
+
+# The trace the spans of this context are recorded in (None: nothing is recorded)
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+_trace_ids = itertools.count(1)
+_write_lock = threading.Lock()
+
+
+def _track():
+    """Returns the id of the asyncio task or thread the span runs in"""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return id(task) if task is not None else threading.get_ident()
+
+
+class Trace(object):
+    """The spans of one scan or activation"""
+
+    def __init__(self, name, category="run", **args):
+        self.name = name
+        self.category = category
+        self.id = "%d-%d-%d" % (os.getpid(), int(time.time()), next(_trace_ids))
+        self.args = args
+        self.start = time.time()
+        self.duration = None
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name, category, start, duration, args, track=None):
+        """Records a span (start in seconds since the epoch, duration in seconds)"""
+        record = {"trace": self.id, "name": name, "category": category, "start": start,
+                  "duration": duration, "track": _track() if track is None else track,
+                  "args": args}
+        with self._lock:
+            self.spans.append(record)
+
+    def finish(self, **args):
+        """Records the span of the whole trace"""
+        self.duration = time.time() - self.start
+        self.args.update(args)
+        self.add(self.name, self.category, self.start, self.duration, self.args)
+
+    def records(self):
+        """Returns the spans, ordered by their start"""
+        with self._lock:
+            return sorted(self.spans, key=lambda record: record["start"])
+
+    def chrome_events(self):
+        """Returns the spans as complete events ("ph": "X") of the Chrome trace-event format"""
+        pid = os.getpid()
+        return [{"name": record["name"], "cat": record["category"], "ph": "X",
+                 "ts": int(record["start"] * 1e6), "dur": int(record["duration"] * 1e6),
+                 "pid": pid, "tid": record["track"],
+                 "args": dict(record["args"], trace=record["trace"])}
+                for record in self.records()]
+
+
+@contextlib.contextmanager
+def span(name, category, **args):
+    """Records the time spent in the block as a span of the current trace.
+
+    Yields the dict of the args of the span, so that the block can add its results.
+    """
+    trace = current_trace.get()
+    if trace is None:
+        yield args
+        return
+    start = time.time()
+    try:
+        yield args
+    except BaseException as e:
+        args["error"] = type(e).__name__
+        raise
+    finally:
+        trace.add(name, category, start, time.time() - start, args)
+
+
+@contextlib.contextmanager
+def traced_span(name, category, path=None, format='jsonl', log=None, **args):
+    """Like `span`, but if no trace is being recorded and path is set, the block is recorded
+    in a new trace, which is then appended to path (see `write_trace`)."""
+    if current_trace.get() is not None or not path:
+        with span(name, category, **args) as info:
+            yield info
+        return
+    trace = Trace(name, category, **args)
+    token = current_trace.set(trace)
+    try:
+        yield trace.args
+    except BaseException as e:
+        trace.args["error"] = type(e).__name__
+        raise
+    finally:
+        current_trace.reset(token)
+        trace.finish()
+        try:
+            write_trace(trace, path, format)
+        except (OSError, ValueError):
+            if log is not None:
+                log.warning("Couldn't write the trace to %s.", path, exc_info=True)
+
+
+def write_trace(trace, path, format='jsonl'):
+    """Appends the spans of the trace to the file.
+
+    In the 'chrome' format, the file is a JSON array of events without the closing bracket,
+    which the trace viewers accept, so that further traces can be appended.
+    """
+    if format not in TRACE_FORMATS:
+        raise ValueError("Unknown trace format: %s" % format)
+    path = os.path.expanduser(path)
+    with _write_lock:
+        with open(path, "a", encoding="utf-8") as f:
+            if format == "chrome":
+                if f.tell() == 0:
+                    f.write("[\n")
+                for event in trace.chrome_events():
+                    f.write(json.dumps(event, default=str) + ",\n")
+            else:
+                for record in trace.records():
+                    f.write(json.dumps(record, default=str) + "\n")
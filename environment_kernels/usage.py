@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""Persistent statistics about which environment kernels are launched"""
+from __future__ import absolute_import
+
+import contextvars
+import json
+import os
+import threading
+import time
+
+__all__ = ['UsageStore', 'launch_recording']
+
+# Set to False in contexts which start kernels which nobody asked for yet (e.g. a kernel pool)
+launch_recording = contextvars.ContextVar('launch_recording', default=True)
+
+
+def _normpath(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+class UsageStore(object):
+    """Counts the launches of each kernel and remembers the last one.
+
+    The "heat" of a kernel is its number of launches, halved for every `half_life`
+    seconds since its last launch, so that kernels which are not used anymore cool down.
+    The statistics are saved as JSON in `path` after every launch (not at all if `path`
+    is empty).
+    """
+
+    def __init__(self, path=None, half_life=7 * 24 * 3600, log=None):
+        self.path = path
+        self.half_life = half_life
+        self.log = log
+        self._lock = threading.Lock()
+        # kernel name -> {'launches': n, 'last_launch': timestamp, 'env_path': path}
+        self._entries = {}
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+            self._entries = {name: entry for name, entry in entries.items()
+                             if isinstance(entry, dict)}
+        except (IOError, OSError, ValueError, AttributeError):
+            if self.log is not None:
+                self.log.warning("Couldn't read the kernel usage statistics from %s, "
+                                 "starting from scratch.", self.path)
+
+    def _save(self, entries):
+        if not self.path:
+            return
+        tmpfile = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(tmpfile, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmpfile, self.path)
+        except (IOError, OSError):
+            if self.log is not None:
+                self.log.warning("Couldn't save the kernel usage statistics to %s.", self.path)
+
+    def record_launch(self, name, env_path=None, now=None):
+        """Records that the kernel was launched"""
+        now = time.time() if now is None else now
+        name = name.lower()
+        with self._lock:
+            entry = self._entries.setdefault(name, {"launches": 0, "last_launch": None})
+            entry["launches"] += 1
+            entry["last_launch"] = now
+            if env_path:
+                entry["env_path"] = env_path
+            self._save(self._entries)
+
+    def _heat(self, entry, now):
+        if not entry.get("last_launch"):
+            return 0.0
+        age = max(0, now - entry["last_launch"])
+        return entry.get("launches", 0) * 0.5 ** (age / self.half_life)
+
+    def heat(self, name, now=None):
+        """Returns how often the kernel was launched recently (0 if never)"""
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(name.lower())
+            return self._heat(entry, now) if entry else 0.0
+
+    def hottest(self, names, n, now=None):
+        """Returns the (at most n) kernels of names which were launched most, hottest first"""
+        now = time.time() if now is None else now
+        heats = [(self.heat(name, now), name) for name in names]
+        heats = sorted((item for item in heats if item[0] > 0), key=lambda item: -item[0])
+        return [name for _, name in heats[:n]]
+
+    def sort_env_paths(self, env_paths, key=None, now=None):
+        """Sorts env_paths (or items with `key(item)` being an env path) hottest first.
+
+        Envs which were never launched keep their order at the end.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            heats = {}
+            for entry in self._entries.values():
+                if entry.get("env_path"):
+                    path = _normpath(entry["env_path"])
+                    heats[path] = heats.get(path, 0.0) + self._heat(entry, now)
+        if not heats:
+            return list(env_paths)
+        key = key or (lambda item: item)
+        return sorted(env_paths, key=lambda item: -heats.get(_normpath(key(item)), 0.0))
+
+    def get_state(self, now=None):
+        """Returns a dict name -> {'launches': n, 'last_launch': timestamp, 'heat': heat}"""
+        now = time.time() if now is None else now
+        with self._lock:
+            return {name: {"launches": entry.get("launches", 0),
+                           "last_launch": entry.get("last_launch"),
+                           "heat": self._heat(entry, now)}
+                    for name, entry in self._entries.items()}
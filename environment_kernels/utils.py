@@ -70,8 +70,26 @@ ON_ANACONDA = any(s in sys.version for s in {'Anaconda', 'Continuum'})
 
 ON_POSIX = (os.name == 'posix')
 
-try:
-    import conda.config
-    HAVE_CONDA = True
-except ImportError:
-    HAVE_CONDA = False
+_HAVE_CONDA = None
+
+
+def have_conda():
+    """Returns True if conda can be imported.
+
+    Importing conda is slow, so this is only checked on the first call.
+    """
+    global _HAVE_CONDA
+    if _HAVE_CONDA is None:
+        try:
+            import conda.config
+            _HAVE_CONDA = True
+        except ImportError:
+            _HAVE_CONDA = False
+    return _HAVE_CONDA
+
+
+def __getattr__(name):
+    # HAVE_CONDA used to be set on import
+    if name == 'HAVE_CONDA':
+        return have_conda()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
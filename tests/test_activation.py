@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import logging
+import os
+import shutil
+
+import pytest
+
+from environment_kernels import envs_common, envs_virtualenv
+from environment_kernels.envs_conda import get_static_conda_activation
+from environment_kernels.envs_virtualenv import get_static_env_vars_for_virtualenv_env
+from environment_kernels.subprocess_helper import TimeoutExpired
+from environment_kernels.utils import ON_WINDOWS
+
+pytestmark = pytest.mark.skipif(ON_WINDOWS, reason="uses the bash activate templates")
+
+UV_TEMPLATE = os.path.join(os.path.dirname(envs_virtualenv.__file__), "activate_templates",
+                           "uv_activate.sh")
+
+
+def make_uv_venv(env_path, extra=""):
+    """Creates a venv like `uv venv` does: pyvenv.cfg with a `uv` key and uv's activate script"""
+    os.makedirs(os.path.join(env_path, "bin"))
+    with open(os.path.join(env_path, "pyvenv.cfg"), "w") as f:
+        f.write("home = /usr/bin\nimplementation = CPython\nuv = 0.13.1\n")
+    with open(UV_TEMPLATE) as f:
+        script = f.read()
+    script = (script.replace("__VIRTUAL_ENV__", env_path).replace("__BIN_NAME__", "bin")
+              .replace("__VIRTUAL_PROMPT__", os.path.basename(env_path)))
+    with open(os.path.join(env_path, "bin", "activate"), "w") as f:
+        f.write(script + extra)
+
+
+def test_uv_venv_is_activated_statically(tmp_path):
+    env_path = str(tmp_path / "uv project" / ".venv")
+    make_uv_venv(env_path)
+    env = get_static_env_vars_for_virtualenv_env(env_path)
+    assert env is not None
+    assert env["VIRTUAL_ENV"] == env_path
+    assert env["PATH"].split(os.pathsep)[0] == os.path.join(env_path, "bin")
+
+
+def test_customized_uv_activate_script_is_sourced(tmp_path):
+    env_path = str(tmp_path / ".venv")
+    make_uv_venv(env_path, extra="export EXTRA=1\n")
+    assert get_static_env_vars_for_virtualenv_env(env_path) is None
+
+
+def test_activate_script_of_another_env_is_sourced(tmp_path):
+    env_path = str(tmp_path / "a" / ".venv")
+    make_uv_venv(env_path)
+    assert get_static_env_vars_for_virtualenv_env(env_path) is not None
+    # a copied env still points to the original one
+    copy_path = str(tmp_path / "b" / ".venv")
+    shutil.copytree(env_path, copy_path)
+    assert get_static_env_vars_for_virtualenv_env(copy_path) is None
+
+
+class FakeManager(object):
+    log = logging.getLogger("test")
+    activation_timeout = 5
+
+    def get_activation_strategy(self, env_path):
+        return "hermetic"
+
+
+def fake_shells(results):
+    """Returns sync and async replacements of the shell, answering per strategy"""
+    calls = []
+
+    def source(args, timeout=None, strategy=None):
+        calls.append(strategy)
+        result = results[strategy]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def source_async(args, engine, timeout=None, strategy=None):
+        return source(args, timeout=timeout, strategy=strategy)
+
+    return calls, source, source_async
+
+
+def activate_both_ways(monkeypatch, results, expected_var="VIRTUAL_ENV"):
+    """Returns [(calls, envs or exception)] of the sync and the async activation"""
+    outcomes = []
+    for is_async in (False, True):
+        calls, source, source_async = fake_shells(results)
+        monkeypatch.setattr(envs_common, "source_env_vars_from_command", source)
+        monkeypatch.setattr(envs_common, "source_env_vars_from_command_async", source_async)
+        try:
+            if is_async:
+                envs = asyncio.run(envs_common.activate_in_shell_async(
+                    FakeManager(), None, "/env", ["activate"], expected_var))
+            else:
+                envs = envs_common.activate_in_shell(FakeManager(), "/env", ["activate"],
+                                                     expected_var)
+        except Exception as e:
+            envs = e
+        outcomes.append((calls, envs))
+    return outcomes
+
+
+def test_activation_falls_back_until_the_env_is_activated(monkeypatch):
+    results = {"hermetic": RuntimeError("no bash"), "login": {},
+               "interactive": {"VIRTUAL_ENV": "/env"}}
+    for calls, envs in activate_both_ways(monkeypatch, results):
+        assert calls == ["hermetic", "login", "interactive"]
+        assert envs == {"VIRTUAL_ENV": "/env"}
+
+
+def test_activation_timeout_is_not_retried(monkeypatch):
+    results = {"hermetic": TimeoutExpired(["bash"], 5)}
+    for calls, envs in activate_both_ways(monkeypatch, results):
+        assert calls == ["hermetic"]
+        assert isinstance(envs, TimeoutExpired)
+
+
+def make_conda_env(env_path, env_vars=None):
+    os.makedirs(os.path.join(env_path, "conda-meta"))
+    with open(os.path.join(env_path, "conda-meta", "state"), "w") as f:
+        json.dump({"env_vars": env_vars or {}}, f)
+
+
+def test_conda_env_vars_of_the_active_env_are_unset(tmp_path, monkeypatch):
+    make_conda_env(str(tmp_path / "old"), {"OLD_VAR": "1"})
+    make_conda_env(str(tmp_path / "new"), {"NEW_VAR": "2"})
+    monkeypatch.setenv("CONDA_PREFIX", str(tmp_path / "old"))
+    monkeypatch.setenv("OLD_VAR", "1")
+    env, hooks = get_static_conda_activation(str(tmp_path / "new"))
+    assert (env["CONDA_PREFIX"], env["NEW_VAR"], hooks) == (str(tmp_path / "new"), "2", [])
+    assert "OLD_VAR" not in env
+
+
+def test_active_conda_env_with_deactivate_hooks_needs_conda(tmp_path, monkeypatch):
+    make_conda_env(str(tmp_path / "old"))
+    make_conda_env(str(tmp_path / "new"))
+    os.makedirs(str(tmp_path / "old" / "etc" / "conda" / "deactivate.d"))
+    with open(str(tmp_path / "old" / "etc" / "conda" / "deactivate.d" / "unset.sh"), "w") as f:
+        f.write("unset OLD_HOOK_VAR\n")
+    monkeypatch.delenv("CONDA_PREFIX", raising=False)
+    assert get_static_conda_activation(str(tmp_path / "new")) is not None
+    monkeypatch.setenv("CONDA_PREFIX", str(tmp_path / "old"))
+    assert get_static_conda_activation(str(tmp_path / "new")) is None
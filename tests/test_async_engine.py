@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import subprocess
+import sys
+import time
+
+import pytest
+
+from environment_kernels.async_helper import AsyncSubprocessEngine
+from environment_kernels.subprocess_helper import TimeoutExpired
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_output_and_input():
+    engine = AsyncSubprocessEngine()
+    p = run(engine.run([sys.executable, "-c", "import sys; sys.stdout.write(sys.stdin.read())"],
+                       input=b"hello"))
+    assert (p.returncode, p.stdout) == (0, b"hello")
+
+
+def test_failing_command_raises():
+    engine = AsyncSubprocessEngine()
+    with pytest.raises(subprocess.CalledProcessError):
+        run(engine.check_output([sys.executable, "-c", "raise SystemExit(3)"]))
+
+
+def test_hanging_command_is_killed():
+    engine = AsyncSubprocessEngine()
+    started = time.time()
+    with pytest.raises(TimeoutExpired):
+        run(engine.check_output([sys.executable, "-c", "import time; time.sleep(30)"],
+                                timeout=0.5))
+    assert time.time() - started < 10
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import types
+
+import pytest
+
+from environment_kernels.envs_common import dedupe_env_paths, find_env_paths_in_basedirs
+from environment_kernels.utils import ON_WINDOWS
+
+
+def make_mgr():
+    return types.SimpleNamespace(log=logging.getLogger("test"), dedupe_stats={})
+
+
+@pytest.mark.skipif(ON_WINDOWS, reason="needs symlinks")
+@pytest.mark.parametrize("reverse", [False, True])
+def test_real_path_wins_over_symlink(tmp_path, reverse):
+    base = tmp_path / "envs"
+    (base / "virtualenv_plain").mkdir(parents=True)
+    (base / "other").mkdir()
+    os.symlink(str(base / "virtualenv_plain"), str(base / "virtualenv_alias"))
+    env_paths = find_env_paths_in_basedirs([str(base)])
+    if reverse:
+        env_paths.reverse()
+    mgr = make_mgr()
+    result = dedupe_env_paths(mgr, env_paths, "virtualenv")
+    names = sorted(os.path.basename(os.path.normpath(path)) for path in result)
+    assert names == ["other", "virtualenv_plain"]
+    assert mgr.dedupe_stats["virtualenv"]["duplicate_envs"] == 1
+
+
+@pytest.mark.skipif(ON_WINDOWS, reason="needs symlinks")
+def test_first_symlink_in_sort_order_wins_without_real_path(tmp_path):
+    (tmp_path / "real" / "env").mkdir(parents=True)
+    for name in ("b", "a"):
+        os.symlink(str(tmp_path / "real" / "env"), str(tmp_path / name))
+    result = dedupe_env_paths(make_mgr(), [str(tmp_path / "b"), str(tmp_path / "a")], "conda")
+    assert result == [str(tmp_path / "a")]
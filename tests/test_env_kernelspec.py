@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+import time
+
+from environment_kernels.env_kernelspec import EnvironmentLoadingKernelSpec
+
+
+def make_kspec(loader, async_loader=None):
+    return EnvironmentLoadingKernelSpec(loader, async_loader=async_loader, env_path="/env",
+                                        argv=["python"], display_name="env", language="python")
+
+
+def test_env_is_activated_once_by_concurrent_threads():
+    calls = []
+
+    def loader():
+        calls.append(1)
+        time.sleep(0.2)
+        return {"A": "1"}
+
+    kspec = make_kspec(loader)
+    threads = [threading.Thread(target=kspec.load_env) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert kspec.env == {"A": "1"}
+
+
+def test_sync_activation_does_not_block_the_loop():
+    def loader():
+        time.sleep(0.5)
+        return {"A": "1"}
+
+    async def main():
+        kspec = make_kspec(loader)
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(time.time())
+                await asyncio.sleep(0.05)
+
+        ticker = asyncio.ensure_future(tick())
+        env = await kspec.load_env_async(None)
+        ticker.cancel()
+        return env, ticks
+
+    env, ticks = asyncio.run(main())
+    assert env == {"A": "1"}
+    assert len(ticks) > 3
+
+
+def test_concurrent_async_activations_share_one_activation():
+    calls = []
+
+    async def async_loader(engine):
+        calls.append(engine)
+        await asyncio.sleep(0.1)
+        return {"A": "1"}
+
+    async def main():
+        kspec = make_kspec(dict, async_loader)
+        return await asyncio.gather(*[kspec.load_env_async("engine") for _ in range(3)])
+
+    assert asyncio.run(main()) == [{"A": "1"}] * 3
+    assert calls == ["engine"]
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import stat
+import sys
+
+import pytest
+
+from environment_kernels import envs_common
+from environment_kernels.envs_common import find_installed_kernelspecs
+from environment_kernels.probe_cache import ProbeCache
+from environment_kernels.utils import ON_WINDOWS
+
+pytestmark = pytest.mark.skipif(ON_WINDOWS, reason="uses posix executables")
+
+
+def make_exe(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write("#!/bin/sh\n")
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+
+def install_kernelspec(env_path, name, argv):
+    kernel_dir = os.path.join(env_path, "share", "jupyter", "kernels", name)
+    os.makedirs(kernel_dir)
+    with open(os.path.join(kernel_dir, "kernel.json"), "w") as f:
+        json.dump({"argv": argv, "display_name": name, "language": "python"}, f)
+
+
+def test_executable_in_env_is_used(tmp_path):
+    env_path = str(tmp_path / "env")
+    make_exe(os.path.join(env_path, "bin", "python"))
+    kernel = os.path.join(env_path, "lib", "kernel", "run-kernel")
+    make_exe(kernel)
+    install_kernelspec(env_path, "python3", ["/usr/bin/python", "-m", "ipykernel_launcher"])
+    install_kernelspec(env_path, "other", [kernel, "{connection_file}"])
+    specs = {name: spec["argv"] for name, _, spec in find_installed_kernelspecs(env_path)}
+    assert specs == {"python3": [os.path.join(env_path, "bin", "python"), "-m",
+                                 "ipykernel_launcher"],
+                     "other": [kernel, "{connection_file}"]}
+
+
+def test_absolute_executable_outside_env_is_skipped(tmp_path):
+    env_path = str(tmp_path / "env")
+    os.makedirs(env_path)
+    outside = str(tmp_path / "elsewhere" / "run-kernel")
+    make_exe(outside)
+    install_kernelspec(env_path, "outside", [outside, "{connection_file}"])
+    install_kernelspec(env_path, "system", [sys.executable, "-m", "ipykernel_launcher"])
+    assert find_installed_kernelspecs(env_path) == []
+
+
+def test_kernel_json_is_parsed_once_until_it_changes(tmp_path, monkeypatch):
+    env_path = str(tmp_path / "env")
+    make_exe(os.path.join(env_path, "bin", "python"))
+    install_kernelspec(env_path, "python3", ["python", "-m", "ipykernel_launcher"])
+    loads = []
+    load = envs_common.json.load
+    monkeypatch.setattr(envs_common.json, "load", lambda f: loads.append(f.name) or load(f))
+    cache = ProbeCache()
+    for _ in range(3):
+        assert [name for name, _, _ in find_installed_kernelspecs(env_path, cache)] == ["python3"]
+        assert envs_common.installed_kernel_info(env_path, "python", cache) is not None
+    assert len(loads) == 1
+
+    kernel_json = os.path.join(env_path, "share", "jupyter", "kernels", "python3", "kernel.json")
+    with open(kernel_json, "w") as f:
+        json.dump({"argv": ["python", "-m", "ipykernel_launcher"], "display_name": "changed",
+                   "language": "python"}, f)
+    st = os.stat(kernel_json)
+    os.utime(kernel_json, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert find_installed_kernelspecs(env_path, cache)[0][2]["display_name"] == "changed"
+    assert len(loads) == 2
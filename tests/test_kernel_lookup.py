@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import time
+
+import pytest
+from jupyter_client.kernelspec import KernelSpec, NoSuchKernel
+
+from environment_kernels import EnvironmentKernelSpecManager
+
+
+def env_kernel(name):
+    return ("/envs/%s/logos" % name,
+            KernelSpec(argv=["/envs/%s/bin/python" % name, "-m", "ipykernel_launcher"],
+                       display_name=name, language="python"))
+
+
+def make_manager(tmp_path, **kwargs):
+    kernel_dir = tmp_path / "kernels"
+    kernel_dir.mkdir()
+    mgr = EnvironmentKernelSpecManager(refresh_interval=0, usage_file="", prewarm_kernels=0,
+                                       kernel_dirs=[str(kernel_dir)], **kwargs)
+    mgr.env_registry.update({"conda_a": env_kernel("a")})
+    return mgr
+
+
+def count_searches(mgr, monkeypatch):
+    searches = []
+    search = mgr._search_kernel_spec
+
+    def counted(kernel_name):
+        searches.append(kernel_name)
+        return search(kernel_name)
+
+    monkeypatch.setattr(mgr, "_search_kernel_spec", counted)
+    return searches
+
+
+def install_kernel(mgr, name):
+    path = os.path.join(mgr.kernel_dirs[0], name)
+    os.makedirs(path)
+    with open(os.path.join(path, "kernel.json"), "w") as f:
+        json.dump({"argv": ["python"], "display_name": name, "language": "python"}, f)
+
+
+def test_env_kernels_are_found_case_insensitively(tmp_path, monkeypatch):
+    mgr = make_manager(tmp_path)
+    searches = count_searches(mgr, monkeypatch)
+    assert mgr.get_kernel_spec("CONDA_A").display_name == "a"
+    assert searches == []
+    assert mgr.kernel_lookups["env"] == 1
+
+
+def test_missing_kernel_is_remembered(tmp_path, monkeypatch):
+    mgr = make_manager(tmp_path)
+    searches = count_searches(mgr, monkeypatch)
+    for _ in range(3):
+        with pytest.raises(NoSuchKernel):
+            mgr.get_kernel_spec("gone")
+    assert searches == ["gone"]
+    assert mgr.kernel_lookups["missing"] == 2
+
+
+def test_missing_kernel_is_forgotten_when_it_is_installed(tmp_path):
+    mgr = make_manager(tmp_path)
+    with pytest.raises(NoSuchKernel):
+        mgr.get_kernel_spec("native")
+    install_kernel(mgr, "native")
+    assert mgr.get_kernel_spec("native").display_name == "native"
+
+
+def test_missing_kernel_is_forgotten_when_an_env_provides_it(tmp_path):
+    mgr = make_manager(tmp_path)
+    with pytest.raises(NoSuchKernel):
+        mgr.get_kernel_spec("conda_b")
+    mgr.env_registry.add("conda_b", env_kernel("b"))
+    assert mgr.get_kernel_spec("conda_b").display_name == "b"
+
+
+def test_missing_kernel_is_searched_again_after_the_ttl(tmp_path, monkeypatch):
+    mgr = make_manager(tmp_path, missing_kernel_ttl=0.1)
+    searches = count_searches(mgr, monkeypatch)
+    for _ in range(2):
+        with pytest.raises(NoSuchKernel):
+            mgr.get_kernel_spec("gone")
+        time.sleep(0.2)
+    assert searches == ["gone", "gone"]
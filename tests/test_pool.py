@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import queue
+import threading
+from unittest import mock
+
+from jupyter_client.kernelspec import KernelSpecManager
+
+from environment_kernels.pool import EnvironmentKernelPoolManager, _PooledKernelManagerMixin
+
+
+def test_pool_fill_scheduled_from_other_thread():
+    async def main():
+        mgr = EnvironmentKernelPoolManager(pool_size=1)
+        filled = asyncio.Event()
+
+        async def fill_pool():
+            filled.set()
+
+        mgr.fill_pool = fill_pool
+        # e.g. the registry subscription, called in a supplier thread
+        thread = threading.Thread(target=mgr._schedule_pool_fill)
+        thread.start()
+        thread.join()
+        await asyncio.wait_for(filled.wait(), 5)
+
+    asyncio.run(main())
+
+
+class FakeClient(object):
+    def start_channels(self):
+        pass
+
+    def stop_channels(self):
+        pass
+
+    def execute(self, code, **kwargs):
+        return "msg-1"
+
+    def get_shell_msg(self, timeout=None):
+        raise queue.Empty()
+
+
+class FakeKernelManager(object):
+    def __init__(self):
+        self.log = logging.getLogger("test")
+        self.kernel_id = "kernel-1"
+        self._launch_args = {}
+
+    def start_kernel(self, **kw):
+        return "started"
+
+    def client(self):
+        return FakeClient()
+
+
+class PooledFakeKernelManager(_PooledKernelManagerMixin, FakeKernelManager):
+    pass
+
+
+def test_pooled_kernel_is_handed_out_if_it_does_not_answer():
+    km = PooledFakeKernelManager()
+    km._pool_warm = True
+    km._pool_cwd = "/pool"
+    km._pool_language = "python"
+    asyncio.run(km.start_kernel(cwd="/elsewhere"))
+    assert not km._pool_warm
+    assert km._launch_args["cwd"] == "/elsewhere"
+
+
+def test_env_is_activated_before_the_pooled_kernel_starts():
+    events = []
+
+    class EnvKernelSpecManager(KernelSpecManager):
+        async def async_activate(self, kernel_name):
+            events.append(("activate", kernel_name))
+
+    class KernelManager(FakeKernelManager):
+        kernel_spec = mock.Mock(language="python")
+
+        def __init__(self, **kwargs):
+            super(KernelManager, self).__init__()
+
+        async def start_kernel(self, **kw):
+            events.append(("start", kw["kernel_id"]))
+
+    async def main():
+        mgr = EnvironmentKernelPoolManager(pool_size=0)
+        mgr.kernel_spec_manager = EnvKernelSpecManager()
+        mgr._pooled_kernel_manager_class = lambda: KernelManager
+        return await mgr._start_pooled("conda_py")
+
+    km = asyncio.run(main())
+    assert [event for event, _ in events] == ["activate", "start"]
+    assert km._pool_warm
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import shutil
+import threading
+import time
+
+import pytest
+
+from environment_kernels.probe_cache import ProbeCache, interpreter_state_key
+from environment_kernels.utils import ON_WINDOWS
+
+
+def make_env(path):
+    os.makedirs(os.path.join(path, "bin"))
+    os.makedirs(os.path.join(path, "lib", "site-packages"))
+    with open(os.path.join(path, "bin", "python"), "w") as f:
+        f.write("#!/bin/sh\n")
+    return os.path.join(path, "bin", "python"), [os.path.join(path, "lib", "site-packages")]
+
+
+def touch_later(path):
+    """Changes the mtime of path (also on file systems with a coarse mtime)"""
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+
+def test_key_changes_when_a_package_is_installed(tmp_path):
+    exe, lib_dirs = make_env(str(tmp_path / "env"))
+    key = interpreter_state_key("python", exe, lib_dirs)
+    assert key == interpreter_state_key("python", exe, lib_dirs)
+    os.makedirs(os.path.join(lib_dirs[0], "ipykernel"))
+    touch_later(lib_dirs[0])
+    assert interpreter_state_key("python", exe, lib_dirs) != key
+
+
+def test_key_changes_when_the_interpreter_is_replaced(tmp_path):
+    exe, lib_dirs = make_env(str(tmp_path / "env"))
+    key = interpreter_state_key("python", exe, lib_dirs)
+    os.rename(exe, exe + ".old")
+    with open(exe, "w") as f:
+        f.write("#!/bin/sh\n")
+    assert interpreter_state_key("python", exe, lib_dirs) != key
+
+
+@pytest.mark.skipif(ON_WINDOWS, reason="needs symlinks")
+def test_symlinked_env_has_the_same_key(tmp_path):
+    exe, lib_dirs = make_env(str(tmp_path / "env"))
+    os.symlink(str(tmp_path / "env"), str(tmp_path / "alias"))
+    alias = str(tmp_path / "alias")
+    assert interpreter_state_key("python", exe, lib_dirs) == interpreter_state_key(
+        "python", os.path.join(alias, "bin", "python"),
+        [os.path.join(alias, "lib", "site-packages")])
+
+
+def test_no_key_without_library_dirs(tmp_path):
+    exe, _ = make_env(str(tmp_path / "env"))
+    assert interpreter_state_key("python", exe, [str(tmp_path / "missing" / "*")]) is None
+
+
+def test_results_are_cached_but_errors_are_not():
+    cache = ProbeCache()
+    calls = []
+
+    def probe():
+        calls.append(1)
+        return "kernel"
+
+    def failing_probe():
+        raise RuntimeError("timeout")
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_probe("key", failing_probe)
+    assert cache.get_or_probe("key", probe) == "kernel"
+    assert cache.get_or_probe("key", probe) == "kernel"
+    assert cache.get_or_probe(None, probe) == "kernel"
+    assert len(calls) == 2
+    assert cache.get_state() == {"entries": 1, "hits": 1, "misses": 1}
+
+
+def test_oldest_results_are_dropped():
+    cache = ProbeCache(max_entries=2)
+    for key in ("a", "b", "c"):
+        cache.get_or_probe(key, lambda: key)
+    assert cache.get_state()["entries"] == 2
+    assert cache.get_or_probe("a", lambda: "probed again") == "probed again"
+
+
+def test_concurrent_probes_of_a_key_run_once():
+    cache = ProbeCache()
+    calls = []
+
+    def probe():
+        calls.append(1)
+        time.sleep(0.2)
+        return "kernel"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_probe("k", probe)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ["kernel"] * 4
+    assert len(calls) == 1
+
+
+def test_concurrent_async_probes_of_a_key_run_once():
+    cache = ProbeCache()
+    calls = []
+
+    async def probe():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return "kernel"
+
+    async def main():
+        return await asyncio.gather(*[cache.get_or_probe_async("k", probe) for _ in range(4)])
+
+    assert asyncio.run(main()) == ["kernel"] * 4
+    assert len(calls) == 1
+
+
+def test_copied_env_has_its_own_key(tmp_path):
+    exe, lib_dirs = make_env(str(tmp_path / "env"))
+    shutil.copytree(str(tmp_path / "env"), str(tmp_path / "clone"))
+    clone = str(tmp_path / "clone")
+    assert interpreter_state_key("python", exe, lib_dirs) != interpreter_state_key(
+        "python", os.path.join(clone, "bin", "python"),
+        [os.path.join(clone, "lib", "site-packages")])
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import os
+import stat
+import sys
+
+import pytest
+
+from environment_kernels import EnvironmentKernelSpecManager
+from environment_kernels.subprocess_helper import governor
+from environment_kernels.utils import ON_WINDOWS
+
+pytestmark = pytest.mark.skipif(ON_WINDOWS, reason="uses a shell script as interpreter")
+
+
+def make_conda_env(env_path, python_script):
+    os.makedirs(os.path.join(env_path, "conda-meta"))
+    os.makedirs(os.path.join(env_path, "bin"))
+    for name in ("python", "ipython"):
+        exe = os.path.join(env_path, "bin", name)
+        with open(exe, "w") as f:
+            f.write("#!/bin/sh\n%s\n" % python_script)
+        os.chmod(exe, os.stat(exe).st_mode | stat.S_IEXEC)
+
+
+def make_manager(tmp_path, **kwargs):
+    kwargs.setdefault("probe_timeout", 5)
+    return EnvironmentKernelSpecManager(
+        refresh_interval=0, conda_env_dirs=[str(tmp_path / "envs")], find_conda_envs=True,
+        find_r_envs=True, use_conda_directly=False, find_virtualenv_envs=False,
+        find_uv_envs=False, find_pyenv_envs=False, find_poetry_envs=False,
+        find_pipenv_envs=False, quarantine_threshold=2, usage_file="",
+        prewarm_kernels=0, **kwargs)
+
+
+@pytest.fixture
+def reset_governor():
+    yield
+    governor.max_memory = 0
+
+
+def test_hanging_python_is_quarantined_with_r_probes(tmp_path):
+    env_path = str(tmp_path / "envs" / "hanging")
+    make_conda_env(env_path, "sleep 30")
+    mgr = make_manager(tmp_path, probe_timeout=0.5)
+    for _ in range(2):
+        mgr._get_env_data(reload=True)
+    quarantine = mgr.get_scan_metrics()["quarantine"]
+    key = "%s (python)" % os.path.abspath(env_path)
+    assert key in quarantine
+    assert quarantine[key]["quarantined_for"] > 0
+
+
+def test_memory_limit_is_not_cached_but_quarantined(tmp_path, reset_governor):
+    env_path = str(tmp_path / "envs" / "hungry")
+    make_conda_env(env_path, 'exec "%s" -c "import time; x = bytearray(200 * 2 ** 20); '
+                             'time.sleep(30)"' % sys.executable)
+    mgr = make_manager(tmp_path, subprocess_max_memory=50)
+    for _ in range(2):
+        assert "conda_hungry" not in mgr._get_env_data(reload=True)
+    metrics = mgr.get_scan_metrics()
+    assert metrics["probe_cache"]["entries"] == 0
+    assert metrics["subprocesses"]["memory_kills"] == 2
+    assert "%s (python)" % os.path.abspath(env_path) in metrics["quarantine"]
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import os
+
+from jupyter_client.kernelspec import KernelSpec
+
+from environment_kernels.registry import KernelRegistry
+
+
+def kernel(env, display_name=None):
+    kspec = KernelSpec(argv=["/envs/%s/bin/python" % env, "-m", "ipykernel_launcher"],
+                       display_name=display_name or env, language="python")
+    kspec.env_path = "/envs/%s" % env
+    return "/envs/%s/logos" % env, kspec
+
+
+def test_generation_changes_only_with_the_kernels():
+    registry = KernelRegistry()
+    assert not registry.populated
+    change = registry.update({"Conda_A": kernel("a")})
+    assert registry.populated
+    assert (change.generation, change.added) == (1, ["conda_a"])
+
+    old_spec = registry.get("conda_a")[1]
+    change = registry.update({"conda_a": kernel("a")})
+    assert change.generation == 1
+    assert (change.added, change.removed, change.changed) == ([], [], [])
+    # unchanged kernels keep their (maybe already activated) spec
+    assert registry.get("conda_a")[1] is old_spec
+
+    change = registry.update({"conda_a": kernel("a", "renamed"), "conda_b": kernel("b")})
+    assert (change.generation, change.added, change.changed) == (2, ["conda_b"], ["conda_a"])
+    change = registry.update({"conda_b": kernel("b")})
+    assert (change.generation, change.removed) == (3, ["conda_a"])
+
+
+def test_add_publishes_single_kernels():
+    registry = KernelRegistry()
+    change = registry.add("conda_a", kernel("a"))
+    assert (change.generation, change.added) == (1, ["conda_a"])
+    assert registry.add("conda_a", kernel("a")) is None
+    change = registry.add("CONDA_A", kernel("a", "renamed"))
+    assert (change.generation, change.changed) == (2, ["conda_a"])
+    assert registry.snapshot()[0] == 2
+
+
+def test_names_are_case_insensitive():
+    registry = KernelRegistry()
+    registry.update({"Conda_A": kernel("a")})
+    assert "CONDA_A" in registry
+    assert registry.get("conda_A") is not None
+    assert list(registry.get_env_data()) == ["conda_a"]
+
+
+def test_subscribers_get_the_changes():
+    registry = KernelRegistry()
+    changes = []
+
+    def broken(change):
+        raise ValueError("subscriber bug")
+
+    unsubscribe = registry.subscribe(changes.append)
+    registry.subscribe(broken)
+    registry.update({"conda_a": kernel("a")})
+    registry.update({"conda_a": kernel("a")})
+    registry.add("conda_b", kernel("b"))
+    unsubscribe()
+    registry.update({})
+    assert [(change.generation, change.added) for change in changes] == \
+        [(1, ["conda_a"]), (2, ["conda_b"])]
+
+
+def test_kernels_are_found_by_env_and_interpreter():
+    registry = KernelRegistry()
+    registry.update({"conda_a": kernel("a"), "conda_b": kernel("b")})
+    registry.add("conda_a_r", kernel("a"))
+    assert registry.find_by_env("/envs/a/") == ["conda_a", "conda_a_r"]
+    assert registry.find_by_interpreter(os.path.join("/envs", "b", "bin", "python")) == \
+        ["conda_b"]
+    registry.update({"conda_b": kernel("b")})
+    assert registry.find_by_env("/envs/a") == []
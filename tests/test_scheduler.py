@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import sys
+import threading
+import time
+
+import pytest
+
+from environment_kernels.async_helper import AsyncSubprocessEngine
+from environment_kernels.scheduler import (AdaptiveScheduler, ScanCPU, measure_thread_cpu,
+                                           scan_cpu)
+from environment_kernels.subprocess_helper import check_output
+from environment_kernels.utils import ON_WINDOWS
+
+BUSY = [sys.executable, "-c", "import time\nend = time.process_time() + 0.3\n"
+                              "while time.process_time() < end: pass"]
+
+
+def make_scheduler():
+    return AdaptiveScheduler(interval=60, max_interval=600, backoff=2.0, max_cpu_fraction=0.05)
+
+
+def test_unchanged_scans_back_off_up_to_the_max_interval():
+    scheduler = make_scheduler()
+    intervals = [scheduler.record_scan(duration=1, cpu=0.1, changed=False) for _ in range(5)]
+    assert intervals == [120, 240, 480, 600, 600]
+    assert "at the maximum interval" in scheduler.reason
+
+
+def test_changed_scan_resets_the_interval():
+    scheduler = make_scheduler()
+    for _ in range(3):
+        scheduler.record_scan(duration=1, cpu=0.1, changed=False)
+    assert scheduler.record_scan(duration=1, cpu=0.1, changed=True) == 60
+    assert scheduler.unchanged_scans == 0
+
+
+def test_cpu_heavy_scan_stretches_the_interval():
+    scheduler = make_scheduler()
+    # 6 CPU seconds need 120 seconds of scan + interval
+    assert scheduler.record_scan(duration=10, cpu=6, changed=True) == 110
+    assert "CPU seconds" in scheduler.reason
+
+
+def test_cpu_stretch_is_capped_by_the_max_interval():
+    scheduler = make_scheduler()
+    assert scheduler.record_scan(duration=10, cpu=600, changed=True) == 600
+
+
+def burn(seconds):
+    end = time.thread_time() + seconds
+    while time.thread_time() < end:
+        pass
+
+
+def test_only_the_threads_of_the_scan_are_measured():
+    scan = ScanCPU()
+    token = scan_cpu.set(scan)
+    try:
+        # e.g. request handlers of the server
+        other = threading.Thread(target=burn, args=(0.3,))
+        other.start()
+        with measure_thread_cpu():
+            # nested blocks are not counted twice
+            with measure_thread_cpu():
+                burn(0.1)
+        other.join()
+    finally:
+        scan_cpu.reset(token)
+    assert 0.1 <= scan.seconds < 0.3
+
+
+@pytest.mark.skipif(ON_WINDOWS, reason="needs wait4")
+def test_cpu_of_subprocesses_is_measured():
+    scan = ScanCPU()
+    token = scan_cpu.set(scan)
+    try:
+        check_output(BUSY, timeout=10)
+    finally:
+        scan_cpu.reset(token)
+    assert scan.seconds >= 0.25
+
+
+@pytest.mark.skipif(not hasattr(__import__("os"), "pidfd_open"), reason="needs pidfds")
+def test_cpu_of_async_subprocesses_is_measured():
+    async def main():
+        scan = ScanCPU()
+        scan_cpu.set(scan)
+        await AsyncSubprocessEngine().check_output(BUSY, timeout=10)
+        return scan.seconds
+
+    assert asyncio.run(main()) >= 0.25
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+from jupyter_client.kernelspec import KernelSpec
+
+from environment_kernels import EnvironmentKernelSpecManager
+
+
+def make_manager(tmp_path):
+    kernel_dir = tmp_path / "kernels"
+    kernel_dir.mkdir()
+    mgr = EnvironmentKernelSpecManager(refresh_interval=0, usage_file="", prewarm_kernels=0,
+                                       kernel_dirs=[str(kernel_dir)])
+    mgr.env_registry.update({"conda_a": env_kernel("a")})
+    return mgr
+
+
+def env_kernel(name):
+    return ("/envs/%s/logos" % name,
+            KernelSpec(argv=["/envs/%s/bin/python" % name, "-m", "ipykernel_launcher"],
+                       display_name="Environment (%s)" % name, language="python"))
+
+
+def install_kernel(mgr, name):
+    path = os.path.join(mgr.kernel_dirs[0], name)
+    os.makedirs(path)
+    with open(os.path.join(path, "kernel.json"), "w") as f:
+        json.dump({"argv": ["python"], "display_name": name, "language": "python"}, f)
+
+
+def test_specs_are_cached_until_the_registry_changes(tmp_path):
+    mgr = make_manager(tmp_path)
+    etag = mgr.get_specs_etag()
+    assert set(mgr.find_kernel_specs()) == {"conda_a"}
+    assert mgr.get_specs_etag() == etag
+    assert mgr.specs_cache_misses == 1
+    assert mgr.specs_cache_hits == 2
+
+    mgr.env_registry.add("conda_b", env_kernel("b"))
+    assert set(mgr.get_all_specs()) == {"conda_a", "conda_b"}
+    assert mgr.get_specs_etag() != etag
+    assert mgr.specs_cache_misses == 2
+
+
+def test_specs_cache_is_invalidated_by_installed_kernels(tmp_path):
+    mgr = make_manager(tmp_path)
+    etag = mgr.get_specs_etag()
+    install_kernel(mgr, "native")
+    assert set(mgr.find_kernel_specs()) == {"conda_a", "native"}
+    assert mgr.get_specs_etag() != etag
+
+
+def test_kernel_published_while_reading_is_not_lost(tmp_path):
+    mgr = make_manager(tmp_path)
+    get_env_data = mgr._get_env_data
+
+    def get_env_data_and_publish(reload=False):
+        data = get_env_data(reload)
+        # e.g. a streaming scan in another thread
+        mgr.env_registry.add("conda_b", env_kernel("b"))
+        return data
+
+    mgr._get_env_data = get_env_data_and_publish
+    mgr.find_kernel_specs()
+    mgr._get_env_data = get_env_data
+    assert set(mgr.find_kernel_specs()) == {"conda_a", "conda_b"}
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+import time
+
+from jupyter_client.kernelspec import KernelSpec
+
+from environment_kernels import EnvironmentKernelSpecManager, core
+
+
+def get_env_data(mgr):
+    return {}
+
+
+def test_supplier_entry_points_are_resolved_once(monkeypatch):
+    calls = []
+
+    def fake_get_env_supplyers(log=None):
+        calls.append(log)
+        return [("fake", get_env_data)]
+
+    monkeypatch.setattr(core, "get_env_supplyers", fake_get_env_supplyers)
+    mgr = EnvironmentKernelSpecManager(refresh_interval=0, usage_file="", prewarm_kernels=0)
+    for _ in range(3):
+        mgr._get_env_data(reload=True)
+    assert len(calls) == 1
+    assert "fake" in mgr.get_scan_metrics()["suppliers"]
+
+    mgr.refresh_supplyers()
+    mgr._get_env_data(reload=True)
+    assert len(calls) == 2
+
+
+def make_blocking_supplier(monkeypatch, release):
+    calls = []
+
+    def blocking_supplier(mgr):
+        calls.append(1)
+        release.wait(10)
+        return {"blocked_env": ("/envs/blocked",
+                                KernelSpec(argv=["/envs/blocked/bin/python"],
+                                           display_name="blocked", language="python"))}
+
+    monkeypatch.setattr(core, "get_env_supplyers",
+                        lambda log=None: [("blocking", blocking_supplier)])
+    return calls
+
+
+def test_async_scan_does_not_restart_a_running_supplier(monkeypatch):
+    release = threading.Event()
+    calls = make_blocking_supplier(monkeypatch, release)
+    mgr = EnvironmentKernelSpecManager(refresh_interval=0, usage_file="", prewarm_kernels=0,
+                                       supplier_timeout=0.2)
+    async def main():
+        try:
+            for _ in range(3):
+                await mgr._scan_async()
+            return len(calls), mgr.get_scan_metrics()["suppliers"]["blocking"]["status"]
+        finally:
+            release.set()
+
+    assert asyncio.run(main()) == (1, "timeout")
+
+
+def test_scan_on_the_event_loop_does_not_wait_for_suppliers(monkeypatch):
+    release = threading.Event()
+    make_blocking_supplier(monkeypatch, release)
+    mgr = EnvironmentKernelSpecManager(refresh_interval=0, usage_file="", prewarm_kernels=0,
+                                       supplier_timeout=10)
+
+    async def main():
+        started = time.time()
+        mgr._get_env_data(reload=True)
+        return time.time() - started
+
+    try:
+        assert asyncio.run(main()) < 2
+    finally:
+        release.set()
+    # finished in the background
+    deadline = time.time() + 5
+    while "blocked_env" not in mgr.env_registry and time.time() < deadline:
+        time.sleep(0.05)
+    assert "blocked_env" in mgr.env_registry